@@ -1,4 +1,10 @@
+import json
+
+import click
+
 from rmon.app import create_app
+from rmon.collector import collector
+from rmon.inventory import import_servers as bulk_import, export_servers as bulk_export
 from rmon.models import db 
 
 app = create_app()
@@ -9,5 +15,80 @@ def init_db():
     """
     initialize database
     """
-    print('sqlite3 database file is {}'.format(app.config['SQLALCHEMY_DATABASE_URI']))
-    db.create_all()
+    print('database is {}'.format(app.config['SQLALCHEMY_DATABASE_URI']))
+    for version, name in db.upgrade():
+        print('applied migration {} {}'.format(version, name))
+
+
+@app.cli.command()
+@click.option('--to', 'target', type=int, help='stop after this version')
+def upgrade_db(target):
+    """
+    apply the pending schema migrations
+    """
+    applied = db.upgrade(target)
+    for version, name in applied:
+        print('applied migration {} {}'.format(version, name))
+    if not applied:
+        print('database is up to date')
+
+
+@app.cli.command()
+def db_version():
+    """
+    show the schema version and the pending migrations
+    """
+    version, pending = db.schema_version()
+    print('schema version {}'.format(version))
+    for migration in pending:
+        print('pending migration {} {}'.format(migration.VERSION, migration.NAME))
+
+
+@app.cli.command()
+def run_collector():
+    """
+    probe every server and share the samples with the API workers
+    """
+    path = app.config.get('SHARED_STORE_PATH')
+    if not path:
+        raise click.UsageError('SHARED_STORE_PATH is not configured')
+    print('sharing samples of every server in {}'.format(path))
+    try:
+        collector.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+@app.cli.command()
+@click.argument('source', type=click.File('r'))
+@click.option('--no-ping', is_flag=True, help='do not check that servers can be reached')
+def import_servers(source, no_ping):
+    """
+    create or update servers from a JSON list or NDJSON file
+    """
+    content = source.read()
+    try:
+        items = json.loads(content)
+    except ValueError:
+        items = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    results = bulk_import(items, ping=not no_ping,
+                          timeout=app.config['HEALTH_CHECK_TIMEOUT'],
+                          deadline=app.config['BULK_PING_DEADLINE'],
+                          workers=app.config['HEALTH_CHECK_WORKERS'])
+
+    for index, result in enumerate(results):
+        if not result['ok']:
+            print('item {}: {}'.format(index, result['message']))
+    failed = sum(1 for result in results if not result['ok'])
+    print('{} servers imported, {} failed'.format(len(results) - failed, failed))
+
+
+@app.cli.command()
+@click.argument('target', type=click.File('w'), default='-')
+def export_servers(target):
+    """
+    export servers as NDJSON
+    """
+    for line in bulk_export():
+        target.write(line)
@@ -0,0 +1,139 @@
+""" benchmarks.fake_redis
+stand-in redis server for the benchmarks
+
+a real redis-server on a free port is used when one is installed,
+otherwise a threaded server speaking enough RESP for PING and INFO.
+"""
+
+import shutil
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+
+INFO = '\r\n'.join([
+    '# Server', 'redis_version:4.0.9', 'redis_mode:standalone', 'os:Linux 4.4.0 x86_64',
+    'arch_bits:64', 'process_id:1', 'tcp_port:6379', 'uptime_in_seconds:86400',
+    'uptime_in_days:1', 'hz:10', 'lru_clock:1000',
+    '', '# Clients', 'connected_clients:12', 'client_longest_output_list:0',
+    'client_biggest_input_buf:0', 'blocked_clients:0',
+    '', '# Memory', 'used_memory:1048576', 'used_memory_human:1.00M', 'used_memory_rss:4194304',
+    'used_memory_peak:2097152', 'used_memory_peak_human:2.00M', 'mem_fragmentation_ratio:4.00',
+    'maxmemory:0', 'maxmemory_policy:noeviction',
+    '', '# Persistence', 'loading:0', 'rdb_changes_since_last_save:0', 'rdb_bgsave_in_progress:0',
+    'rdb_last_save_time:1500000000', 'aof_enabled:0',
+    '', '# Stats', 'total_connections_received:1000', 'total_commands_processed:100000',
+    'instantaneous_ops_per_sec:250', 'total_net_input_bytes:1000000',
+    'total_net_output_bytes:2000000', 'rejected_connections:0', 'expired_keys:10',
+    'evicted_keys:0', 'keyspace_hits:9000', 'keyspace_misses:1000',
+    '', '# Replication', 'role:master', 'connected_slaves:0',
+    '', '# CPU', 'used_cpu_sys:10.50', 'used_cpu_user:20.25',
+    '', '# Keyspace', 'db0:keys=1000,expires=10,avg_ttl=0', 'db1:keys=20,expires=0,avg_ttl=0',
+    '',
+]).encode()
+
+
+def _bulk(value):
+    return b'$' + str(len(value)).encode() + b'\r\n' + value + b'\r\n'
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def reply(self, args):
+        command = args[0].upper() if args else b''
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command == b'INFO':
+            return _bulk(INFO)
+        if command == b'DBSIZE':
+            return b':1020\r\n'
+        if command in (b'AUTH', b'SELECT', b'CLIENT'):
+            return b'+OK\r\n'
+        return b'-ERR unknown command \'' + command + b'\'\r\n'
+
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except (ValueError, ConnectionError):
+                return
+            if args is None:
+                return
+            self.wfile.write(self.reply(args))
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.port = self.server_address[1]
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-redis')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class RedisProcess:
+    """redis-server without persistence on a free local port
+    """
+
+    def __init__(self, executable):
+        self.executable = executable
+        self.port = _free_port()
+        self._process = None
+
+    def start(self):
+        self._process = subprocess.Popen(
+            [self.executable, '--port', str(self.port), '--bind', '127.0.0.1',
+             '--save', '', '--appendonly', 'no'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError('redis-server did not start on port {}'.format(self.port))
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+
+def stand_in(fake=False):
+    """return a started redis stand-in, a real server unless fake is set
+    """
+    executable = None if fake else shutil.which('redis-server')
+    redis = RedisProcess(executable) if executable else FakeRedis()
+    redis.start()
+    return redis
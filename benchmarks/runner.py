@@ -0,0 +1,107 @@
+""" benchmarks.runner
+timing, allocation measurement and baseline comparison
+"""
+
+import gc
+import json
+import math
+import os
+import time
+import tracemalloc
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def percentile(values, fraction):
+    """nearest-rank percentile of sorted values
+    """
+    index = max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))
+    return values[index]
+
+
+def measure(func, number=200, warmup=20, alloc_number=20):
+    """run func and return its latency, throughput and allocation figures
+
+    timings are taken with tracemalloc off, allocations are measured in a
+    separate pass as the peak traced memory of one call.
+
+    Returns:
+        dict: p50, p99 and mean in milliseconds, rps, alloc_kb
+    """
+    for _ in range(warmup):
+        func()
+
+    gc.collect()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(number):
+        begin = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - begin)
+    total = time.perf_counter() - started
+    timings.sort()
+
+    peaks = []
+    for _ in range(alloc_number):
+        tracemalloc.start()
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    peaks.sort()
+
+    return {
+        'p50': percentile(timings, 0.5) * 1000,
+        'p99': percentile(timings, 0.99) * 1000,
+        'mean': total / number * 1000,
+        'rps': number / total if total else 0,
+        'alloc_kb': percentile(peaks, 0.5) / 1024,
+    }
+
+
+def load_baseline(path=BASELINE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results, baseline, tolerance=0.3, alloc_tolerance=0.1):
+    """return the regressions of results against baseline
+
+    a case regresses when its p50 is more than `tolerance` or its
+    allocations more than `alloc_tolerance` above the baseline. cases
+    without a baseline are never regressions.
+
+    Returns:
+        list: (case, figure, baseline value, measured value)
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p50'] > base['p50'] * (1 + tolerance):
+            regressions.append((name, 'p50', base['p50'], result['p50']))
+        if result['alloc_kb'] > base['alloc_kb'] * (1 + alloc_tolerance):
+            regressions.append((name, 'alloc_kb', base['alloc_kb'], result['alloc_kb']))
+    return regressions
+
+
+def report(results, baseline):
+    """format results as a table with the p50 ratio to the baseline
+    """
+    lines = ['{:<24} {:>9} {:>9} {:>9} {:>10} {:>10} {:>8}'.format(
+        'case', 'p50 ms', 'p99 ms', 'mean ms', 'rps', 'alloc KB', 'vs base')]
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        ratio = '{:.2f}x'.format(result['p50'] / base['p50']) if base and base['p50'] else '-'
+        lines.append('{:<24} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f} {:>10.1f} {:>8}'.format(
+            name, result['p50'], result['p99'], result['mean'], result['rps'],
+            result['alloc_kb'], ratio))
+    return '\n'.join(lines)
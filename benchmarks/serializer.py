@@ -0,0 +1,69 @@
+""" benchmarks.serializer
+compare RestView response encoding with the former dumps(data) + '\\n' path
+
+    python -m benchmarks.serializer
+"""
+
+import timeit
+
+from flask import make_response
+from flask.json import dumps
+
+from rmon.app import create_app
+from rmon.common.serializers import get_backend, serializer
+
+NUMBER = 20
+
+
+def info_payload():
+    """an INFO reply sized like a busy instance with many databases
+    """
+    info = {'field_{}'.format(i): i * 1.5 for i in range(300)}
+    info.update({'db{}'.format(i): {'keys': i * 1000, 'expires': i, 'avg_ttl': 0}
+                 for i in range(16)})
+    info['redis_version'] = '4.0.9'
+    return info
+
+
+def server_list(size):
+    return [{'id': i, 'name': 'redis {}'.format(i), 'description': 'server number {}'.format(i),
+             'host': '10.0.{}.{}'.format(i // 256 % 256, i % 256), 'port': 6379,
+             'password': None, 'created_at': '2017-10-01T00:00:00+00:00',
+             'updated_at': '2017-10-01T00:00:00+00:00'} for i in range(size)]
+
+
+def legacy_response(data):
+    return make_response(dumps(data) + '\n', 200).get_data()
+
+
+def run():
+    app = create_app()
+    payloads = [('INFO', info_payload()), ('1k servers', server_list(1000)),
+                ('10k servers', server_list(10000))]
+    backends = ['json']
+    if get_backend('auto')[0] != 'json':
+        backends.append(get_backend('auto')[0])
+
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        print('{:<12} {:<28} {:>10} {:>10}'.format('payload', 'path', 'ms/op', 'bytes'))
+        for name, data in payloads:
+            legacy = timeit.timeit(lambda: legacy_response(data), number=NUMBER) / NUMBER
+            print('{:<12} {:<28} {:>10.3f} {:>10}'.format(
+                name, 'dumps + newline (legacy)', legacy * 1000, len(legacy_response(data))))
+
+            for backend in backends:
+                for compress in (False, True):
+                    serializer.backend, serializer.dumps = get_backend(backend)
+                    serializer.compress = compress
+
+                    def encode():
+                        return b''.join(serializer.response(data).response)
+
+                    elapsed = timeit.timeit(encode, number=NUMBER) / NUMBER
+                    print('{:<12} {:<28} {:>10.3f} {:>10}'.format(
+                        name, '{}{}'.format(backend, ' + gzip' if compress else ''),
+                        elapsed * 1000, len(encode())))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,272 @@
+""" benchmarks.suite
+benchmarks of the API and redis probing hot paths
+
+    python -m benchmarks                 # run and compare with baseline.json
+    python -m benchmarks --save          # run and store a new baseline
+    python -m benchmarks -k list --fake  # only list cases, fake redis
+
+the app runs with DevConfig (in-memory sqlite) against a local redis
+stand-in. the run exits with status 1 when a case regresses.
+"""
+
+import argparse
+import os
+import sys
+
+from flask import json
+
+from benchmarks import runner
+from benchmarks.fake_redis import stand_in
+from rmon.alerts import AlertEngine
+from rmon.app import create_app
+from rmon.collector import Collector, collector
+from rmon.models import db, AlertRule, Server, ServerSchema, Tag, server_schema, server_tag
+from rmon.scheduler import Scheduler
+
+TABLE_SIZES = (10, 1000, 10000)
+
+
+def populate(size, port):
+    db.drop_all()
+    db.create_all()
+    db.session.bulk_insert_mappings(Server, [{
+        'name': 'redis {}'.format(i), 'description': 'benchmark server {}'.format(i),
+        'host': '127.0.0.1', 'port': port} for i in range(size)])
+    db.session.commit()
+
+
+def populate_tags(size):
+    """tag the servers with env (3 values), role (4) and team (50)
+    """
+    values = {'env': ('prod', 'staging', 'test'), 'role': ('cache', 'queue', 'session', 'lock'),
+              'team': tuple('team{}'.format(i) for i in range(50))}
+    tags = [{'key': key, 'value': value} for key in sorted(values) for value in values[key]]
+    db.session.bulk_insert_mappings(Tag, tags)
+    ids = {(tag.key, tag.value): tag.id for tag in Tag.query}
+    rows = []
+    for server_id in range(1, size + 1):
+        for key in values:
+            value = values[key][server_id % len(values[key])]
+            rows.append({'server_id': server_id, 'tag_id': ids[(key, value)]})
+    db.session.execute(server_tag.insert(), rows)
+    db.session.commit()
+
+
+def tag_selector_case(client, size, port):
+    def setup():
+        populate(size, port)
+        populate_tags(size)
+
+    def run():
+        resp = client.get('/servers?tags=env%3Dprod,role%20in%20(cache,lock),team!%3Dteam7')
+        assert resp.status_code == 200
+        resp.get_data()
+    return setup, run
+
+
+def list_case(client, size, port):
+    def setup():
+        populate(size, port)
+
+    def run():
+        resp = client.get('/servers?limit=1000')
+        assert resp.status_code == 200
+        resp.get_data()
+    return setup, run
+
+
+def detail_get_case(client, port):
+    def run():
+        resp = client.get('/servers/1')
+        assert resp.status_code == 200
+    return lambda: populate(10, port), run
+
+
+def detail_put_case(client, port):
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        resp = client.put('/servers/1', content_type='application/json',
+                          data=json.dumps({'description': 'updated {}'.format(counter[0])}))
+        assert resp.status_code == 200
+    return lambda: populate(10, port), run
+
+
+def model_case(method, port):
+    def run():
+        getattr(Server.query.get(1), method)()
+    return lambda: populate(10, port), run
+
+
+def schema_load_case(port):
+    schema = ServerSchema()
+
+    def run():
+        server, errors = schema.load({'name': 'redis new', 'host': '127.0.0.1', 'port': port})
+        assert not errors
+    return lambda: populate(10, port), run
+
+
+def schema_dump_case(port):
+    def setup():
+        populate(1000, port)
+        servers.extend(Server.query.all())
+        # like the list and export views, tags are not loaded per server
+        Server.preload_labels(servers)
+
+    servers = []
+    schema = server_schema()
+
+    def run():
+        schema.dump(servers, many=True)
+    return setup, run
+
+
+def fleet_metrics_case(client, size, port):
+    def setup():
+        populate(size, port)
+        info = Server.query.get(1).get_metrics()
+        for server_id in range(1, size + 1):
+            collector.store.record(server_id, info)
+
+    def run():
+        resp = client.get('/servers/metrics')
+        assert resp.status_code == 200
+        resp.get_data()
+    return setup, run
+
+
+def fleet_aggregate_case(client, size, port):
+    setup = fleet_metrics_case(client, size, port)[0]
+
+    def run():
+        resp = client.get('/servers/aggregate?fields=used_memory,instantaneous_ops_per_sec'
+                          '&stats=sum,avg,max,p99&group_by=role')
+        assert resp.status_code == 200
+        resp.get_data()
+    return setup, run
+
+
+def scheduler_case(size, port):
+    """one simulated second of scheduling `size` servers, without probing
+    """
+    scheduler = Scheduler(interval=5)
+    clock = [0]
+    info = {'blocked_clients': 0}
+
+    def setup():
+        populate(size, port)
+        scheduler.sync(now=0)
+
+    def run():
+        clock[0] += 1
+        for server in scheduler.due(clock[0]):
+            scheduler.complete(server.id, True, info, now=clock[0])
+    return setup, run
+
+
+def alerts_case(servers, rules_per_server, global_rules, port):
+    """one sample of every server evaluated by the alert engine
+    """
+    engine = AlertEngine(Collector())
+    clock = [0]
+    info = {}
+
+    def setup():
+        populate(1, port)
+        info.update(Server.query.get(1).get_metrics())
+        rules = [AlertRule(id=index, name='global{}'.format(index), enabled=True,
+                           condition='used_memory / (maxmemory + 1) > 0.9 or '
+                                     'rate(total_commands_processed) > 100000')
+                 for index in range(global_rules)]
+        for server_id in range(servers):
+            for index in range(rules_per_server):
+                rules.append(AlertRule(id=len(rules), name='rule{}'.format(len(rules)),
+                                       server_id=server_id, enabled=True, duration=60,
+                                       condition='connected_clients > {}'.format(index)))
+        engine.sinks = []
+        engine.load(rules)
+
+    def run():
+        clock[0] += 5
+        for server_id in range(servers):
+            engine.on_sample(server_id, clock[0], info)
+    return setup, run
+
+
+def cases(client, port):
+    """name -> (setup, run) of every benchmark
+    """
+    result = {}
+    for size in TABLE_SIZES:
+        result['list_servers_{}'.format(size)] = list_case(client, size, port)
+    result['list_servers_by_tags_20000'] = tag_selector_case(client, 20000, port)
+    result['scheduler_second_5000'] = scheduler_case(5000, port)
+    result['alerts_cycle_500x4'] = alerts_case(500, 4, 20, port)
+    result['fleet_metrics_1000'] = fleet_metrics_case(client, 1000, port)
+    result['fleet_aggregate_1000'] = fleet_aggregate_case(client, 1000, port)
+    result['server_detail_get'] = detail_get_case(client, port)
+    result['server_detail_put'] = detail_put_case(client, port)
+    result['server_ping'] = model_case('ping', port)
+    result['server_get_metrics'] = model_case('get_metrics', port)
+    result['schema_load'] = schema_load_case(port)
+    result['schema_dump_1000'] = schema_dump_case(port)
+    return result
+
+
+def run(number, selected=None, fake=False):
+    # benchmarks always use DevConfig and its in-memory database
+    os.environ.pop('RMON_ENV', None)
+    os.environ.pop('RMON_SETTINGS', None)
+
+    redis = stand_in(fake)
+    app = create_app()
+    results = {}
+    try:
+        with app.app_context():
+            client = app.test_client()
+            for name, (setup, func) in sorted(cases(client, redis.port).items()):
+                if selected and not any(pattern in name for pattern in selected):
+                    continue
+                setup()
+                results[name] = runner.measure(func, number, warmup=max(1, number // 10))
+                db.session.remove()
+    finally:
+        redis.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='selected', action='append',
+                        help='only run cases whose name contains this')
+    parser.add_argument('-n', '--number', type=int, default=200, help='runs per case')
+    parser.add_argument('--fake', action='store_true',
+                        help='use the fake redis server even if redis-server is installed')
+    parser.add_argument('--save', action='store_true', help='store results as the baseline')
+    parser.add_argument('--baseline', default=runner.BASELINE, help='baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help='allowed p50 increase over the baseline, 0.3 is 30%%')
+    parser.add_argument('--alloc-tolerance', type=float, default=0.1,
+                        help='allowed allocation increase over the baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.selected, args.fake)
+    baseline = runner.load_baseline(args.baseline)
+    print(runner.report(results, baseline))
+
+    if args.save:
+        runner.save_baseline(dict(baseline, **results), args.baseline)
+        print('baseline saved to {}'.format(args.baseline))
+        return 0
+
+    regressions = runner.compare(results, baseline, args.tolerance, args.alloc_tolerance)
+    for name, figure, expected, measured in regressions:
+        print('REGRESSION {} {}: {:.3f} -> {:.3f}'.format(name, figure, expected, measured))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,381 @@
+""" rmon.alerts
+alert rules evaluated on every collected sample, events sent to sinks
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+
+from sqlalchemy import func
+
+from rmon.collector import collector
+from rmon.common.expressions import Sample, compile_condition
+from rmon.models import AlertRule, discards
+
+logger = logging.getLogger(__name__)
+
+# seconds between two writes of the shared alerts while only values change
+SHARE_INTERVAL = 1
+
+
+class CompiledRule:
+    """an enabled AlertRule with its condition compiled
+    """
+
+    __slots__ = ('id', 'name', 'server_id', 'condition', 'duration', 'severity', 'code',
+                 'fields')
+
+    def __init__(self, rule):
+        self.id = rule.id
+        self.name = rule.name
+        self.server_id = rule.server_id
+        self.condition = rule.condition
+        self.duration = rule.duration or 0
+        self.severity = rule.severity or 'warning'
+        self.code, self.fields = compile_condition(rule.condition)
+
+
+class LogSink:
+    """log every event
+    """
+
+    def __call__(self, event):
+        logger.warning('alert %s %s on server %s: %s %s', event['rule'], event['state'],
+                       event['server_id'], event['condition'], event['values'])
+
+
+class FileSink:
+    """append every event as one JSON line to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class WebhookSink:
+    """POST every event as JSON from a background thread
+
+    the collector never waits for the webhook, events beyond `queue_size`
+    pending ones are dropped.
+    """
+
+    def __init__(self, url, timeout=5, queue_size=1000):
+        self.url = url
+        self.timeout = timeout
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+
+    def __call__(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('alert webhook queue is full, event dropped')
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='rmon-alert-webhook')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            request = urllib.request.Request(
+                self.url, data=json.dumps(event).encode(),
+                headers={'Content-Type': 'application/json'})
+            try:
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+            except Exception as e:
+                logger.warning('alert webhook %s failed: %s', self.url, e)
+
+
+class AlertEngine:
+    """evaluate alert rules as samples arrive
+
+    rules are compiled once when loaded and indexed by server, a sample
+    only evaluates the rules of its server and the rules of every server,
+    reading the fields they name and the previous sample of the server.
+    nothing is read back from the history.
+
+    a true condition makes an alert pending, it fires once it held for
+    the duration of the rule and resolves when the condition is false
+    again. only firing and resolved events are sent to the sinks, once
+    per transition.
+
+    with `SHARED_STORE_PATH` set, the collector process writes its alerts
+    to a file next to the shared store, renamed over the previous one,
+    and API workers read them from it.
+    """
+
+    def __init__(self, collector, app=None):
+        self.app = None
+        self.collector = collector
+        self.reload_interval = 30
+        # callables receiving every event dict
+        self.sinks = []
+        self.share_path = None
+
+        self._rules = {}
+        self._global = []
+        self._by_server = {}
+        # (rule id, server id) -> alert state
+        self._alerts = {}
+        self._previous = {}
+        self._version = None
+        self._checked = 0
+        self._lock = threading.RLock()
+        # an alert changed state / only its values changed since the last share
+        self._changed = False
+        self._dirty = False
+        self._shared = 0
+        # (inode, mtime) of the shared file read last and its alerts
+        self._read = None
+
+        collector.listeners.append(self.on_sample)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        config = app.config
+        self.reload_interval = config.get('ALERT_RELOAD_INTERVAL', self.reload_interval)
+        sinks = []
+        for name in config.get('ALERT_SINKS', ('log',)):
+            if name == 'log':
+                sinks.append(LogSink())
+            elif name == 'file':
+                sinks.append(FileSink(config['ALERT_FILE']))
+            elif name == 'webhook':
+                sinks.append(WebhookSink(config['ALERT_WEBHOOK_URL'],
+                                         config.get('ALERT_WEBHOOK_TIMEOUT', 5)))
+            else:
+                raise ValueError('unknown alert sink {}'.format(name))
+        self.sinks = sinks
+        path = config.get('SHARED_STORE_PATH')
+        self.share_path = path + '.alerts' if path else None
+        with self._lock:
+            self._rules, self._global, self._by_server = {}, [], {}
+            self._alerts.clear()
+            self._previous.clear()
+            self._version = None
+            self._checked = 0
+            self._read = None
+
+    def load(self, rules):
+        """compile the enabled rules, replacing the loaded ones
+
+        alerts of a rule which was removed, disabled or changed are
+        resolved.
+        """
+        compiled = {}
+        for rule in rules:
+            if not rule.enabled:
+                continue
+            try:
+                compiled[rule.id] = CompiledRule(rule)
+            except ValueError as e:
+                logger.warning('alert rule %s is invalid: %s', rule.name, e)
+
+        by_server, global_rules = {}, []
+        for rule in compiled.values():
+            if rule.server_id is None:
+                global_rules.append(rule)
+            else:
+                by_server.setdefault(rule.server_id, []).append(rule)
+
+        events = []
+        with self._lock:
+            for key, alert in list(self._alerts.items()):
+                rule = compiled.get(key[0])
+                previous = self._rules.get(key[0])
+                if rule is None or rule.condition != previous.condition or \
+                        rule.server_id not in (None, key[1]):
+                    del self._alerts[key]
+                    self._changed = True
+                    if alert['state'] == 'firing':
+                        events.append(self._event(previous, key[1], 'resolved', time.time(),
+                                                  alert, alert['values']))
+            self._rules, self._global, self._by_server = compiled, global_rules, by_server
+            self._share(time.time())
+        self._emit(events)
+
+    def reload(self):
+        """load the rules from the database, must run in an app context
+        """
+        self._version = AlertRule.query.with_entities(
+            func.count(AlertRule.id), func.max(AlertRule.updated_at)).one()
+        self.load(AlertRule.query.all())
+
+    def _check(self, now):
+        """reload the rules if one was added, changed or deleted
+        """
+        if self.app is None or now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            with self.app.app_context():
+                version = AlertRule.query.with_entities(
+                    func.count(AlertRule.id), func.max(AlertRule.updated_at)).one()
+                if version != self._version:
+                    self.reload()
+        except Exception:
+            logger.exception('alert rules reload failed')
+
+    def on_sample(self, server_id, timestamp, info):
+        """collector listener, evaluate the rules of the server
+        """
+        self._check(timestamp)
+        rules = self._by_server.get(server_id)
+        previous = self._previous.get(server_id)
+        self._previous[server_id] = (timestamp, info)
+        if not rules and not self._global:
+            return
+
+        sample = Sample(timestamp, info, previous)
+        events = []
+        with self._lock:
+            for group in (rules or (), self._global):
+                for rule in group:
+                    event = self._evaluate(rule, server_id, sample)
+                    if event is not None:
+                        events.append(event)
+            self._share(timestamp)
+        self._emit(events)
+
+    def _evaluate(self, rule, server_id, sample):
+        result = sample.evaluate(rule.code)
+        if result is None:
+            # a field is missing, keep the current state
+            return None
+
+        key = (rule.id, server_id)
+        alert = self._alerts.get(key)
+        if not result:
+            if alert is None:
+                return None
+            del self._alerts[key]
+            self._changed = True
+            if alert['state'] == 'firing':
+                return self._event(rule, server_id, 'resolved', sample.timestamp, alert,
+                                   self._values(rule, sample))
+            return None
+
+        if alert is None:
+            alert = self._alerts[key] = {'state': 'pending', 'since': sample.timestamp}
+            self._changed = True
+        alert['values'] = self._values(rule, sample)
+        self._dirty = True
+        if alert['state'] == 'pending' and sample.timestamp - alert['since'] >= rule.duration:
+            alert['state'] = 'firing'
+            self._changed = True
+            alert['fired_at'] = sample.timestamp
+            return self._event(rule, server_id, 'firing', sample.timestamp, alert,
+                               alert['values'])
+        return None
+
+    @staticmethod
+    def _values(rule, sample):
+        values = {}
+        for field in rule.fields:
+            try:
+                values[field] = sample.field(field)
+            except Exception:
+                values[field] = None
+        return values
+
+    @staticmethod
+    def _event(rule, server_id, state, timestamp, alert, values):
+        return {'rule_id': rule.id, 'rule': rule.name, 'server_id': server_id,
+                'severity': rule.severity, 'condition': rule.condition, 'state': state,
+                'since': alert['since'], 'timestamp': timestamp, 'values': values}
+
+    def _emit(self, events):
+        for event in events:
+            for sink in self.sinks:
+                try:
+                    sink(event)
+                except Exception:
+                    logger.exception('alert sink failed')
+
+    def _share(self, now):
+        """write the alerts for the API workers of the multi-process mode,
+        at once after a transition and at most every SHARE_INTERVAL seconds
+        while only values change. called with the lock held.
+        """
+        if self.share_path is None or not self.collector.store.writable:
+            return
+        if not self._changed and not (self._dirty and now - self._shared >= SHARE_INTERVAL):
+            return
+        self._changed = self._dirty = False
+        self._shared = now
+        temporary = '{}.{}'.format(self.share_path, os.getpid())
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(self._active(), f)
+            os.replace(temporary, self.share_path)
+        except OSError as e:
+            logger.warning('cannot share alerts: %s', e)
+
+    def _read_shared(self):
+        """alerts written by the collector process, [] before it wrote any
+        """
+        try:
+            stat = os.stat(self.share_path)
+        except OSError:
+            return []
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if self._read is None or self._read[0] != key:
+            try:
+                with open(self.share_path) as f:
+                    self._read = (key, json.load(f))
+            except (OSError, ValueError):
+                return []
+        return self._read[1]
+
+    def _active(self):
+        alerts = []
+        for (rule_id, server_id), alert in sorted(self._alerts.items()):
+            rule = self._rules[rule_id]
+            alerts.append({'rule_id': rule_id, 'rule': rule.name, 'server_id': server_id,
+                           'severity': rule.severity, 'condition': rule.condition,
+                           'state': alert['state'], 'since': alert['since'],
+                           'fired_at': alert.get('fired_at'), 'values': alert['values']})
+        return alerts
+
+    def active(self, server_id=None, state=None):
+        """pending and firing alerts, of the collector process in the
+        multi-process mode
+        """
+        with self._lock:
+            if self.share_path is not None and not self.collector.store.writable:
+                alerts = self._read_shared()
+            else:
+                alerts = self._active()
+        return [alert for alert in alerts
+                if (server_id is None or alert['server_id'] == server_id) and
+                (state is None or alert['state'] == state)]
+
+    def discard(self, server_id):
+        with self._lock:
+            self._previous.pop(server_id, None)
+            for key in [key for key in self._alerts if key[1] == server_id]:
+                del self._alerts[key]
+                self._changed = True
+            self._share(time.time())
+
+
+alerts = AlertEngine(collector)
+discards.append(alerts.discard)
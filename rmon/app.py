@@ -5,8 +5,21 @@ import os
 
 from flask import Flask
 
+from rmon.alerts import alerts
+from rmon.collector import collector
+from rmon.common.aioprobe import probes
+from rmon.common.cache import object_cache
+from rmon.common.clients import clients
+from rmon.common.serializers import serializer
 from rmon.config import DevConfig, ProductConfig
+from rmon.exporter import exporter
+from rmon.history import history
+from rmon.instrument import instrument
+from rmon.keyspace import analyzers
 from rmon.models import db
+from rmon.slowlog import slowlogs
+from rmon.stream import hub
+from rmon.topology import topology
 from rmon.views import api
 
 
@@ -25,13 +38,28 @@ def create_app():
 
     app.config.from_envvar('RMON_SETTINGS', silent=True)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False 
+    if os.environ.get('RMON_DATABASE_URL'):
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['RMON_DATABASE_URL']
 
     app.register_blueprint(api)
 
     db.init_app(app)
+    instrument.init_app(app)
+    clients.init_app(app)
+    probes.init_app(app)
+    object_cache.init_app(app)
+    serializer.init_app(app)
+    collector.init_app(app)
+    history.init_app(app)
+    exporter.init_app(app)
+    hub.init_app(app)
+    analyzers.init_app(app)
+    topology.init_app(app)
+    slowlogs.init_app(app)
+    alerts.init_app(app)
 
-    if app.debug:
+    if app.debug or app.config['DATABASE_AUTO_MIGRATE']:
         with app.app_context():
-            db.create_all()
+            db.upgrade()
 
     return app
\ No newline at end of file
@@ -0,0 +1,465 @@
+""" rmon.collector
+background polling of redis servers into in-memory time series
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rmon.common.aioprobe import probes
+from rmon.common.metrics import registry
+from rmon.common.rates import RateCalculator
+from rmon.common.rest import RestException
+from rmon.common.sharedmem import NAN, SlotFile
+from rmon.common.timeseries import TimeSeries
+from rmon.models import Server
+from rmon.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+CYCLE_SECONDS = registry.histogram(
+    'rmon_collector_cycle_seconds', 'Duration of one collection of every server.')
+
+# seconds between heartbeats of the collector process in the shared store
+# and without one after which API workers consider it stopped
+HEARTBEAT_INTERVAL = 1
+HEARTBEAT_TIMEOUT = 5
+
+
+def flatten_info(info):
+    """pick the numeric fields of an INFO reply
+
+    nested sections such as `db0` become `db0.keys`, `db0.expires`...
+    """
+    values = {}
+    for key, value in info.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                if isinstance(sub_value, (int, float)):
+                    values['{}.{}'.format(key, sub_key)] = float(sub_value)
+        elif isinstance(value, (int, float)):
+            values[key] = float(value)
+    return values
+
+
+class MetricsStore:
+    """latest INFO reply, its rates and a bounded history for every server
+    """
+
+    shared = False
+    writable = True
+
+    def __init__(self, capacity=360, series=None):
+        """
+        Args:
+            capacity (int): samples kept per server
+            series (list): numeric fields to keep history of, None for all
+        """
+        self.capacity = capacity
+        self.series = series
+        self._latest = {}
+        self._rates = {}
+        self._history = {}
+        self._calculator = RateCalculator()
+        self._lock = threading.Lock()
+
+    def record(self, server_id, info, timestamp=None):
+        """store an INFO reply of server_id
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        values = flatten_info(info)
+        if self.series is not None:
+            values = {name: values[name] for name in self.series if name in values}
+
+        with self._lock:
+            history = self._history.get(server_id)
+            if history is None:
+                history = self._history[server_id] = TimeSeries(self.capacity)
+            history.append(timestamp, values)
+            self._latest[server_id] = (timestamp, info)
+            self._rates[server_id] = self._calculator.update(server_id, timestamp, info)
+
+    def latest(self, server_id):
+        """return (timestamp, info) of the newest sample or None
+        """
+        return self._latest.get(server_id)
+
+    def rates(self, server_id):
+        """return rates derived from the two newest samples or None
+        """
+        return self._rates.get(server_id)
+
+    def history(self, server_id, start=None, end=None, names=None):
+        """return the samples of server_id between start and end
+        """
+        with self._lock:
+            history = self._history.get(server_id)
+            if history is None:
+                return {'timestamps': [], 'series': {}}
+            return history.range(start, end, names)
+
+    def server_ids(self):
+        return list(self._latest)
+
+    def discard(self, server_id):
+        with self._lock:
+            self._latest.pop(server_id, None)
+            self._rates.pop(server_id, None)
+            self._history.pop(server_id, None)
+            self._calculator.discard(server_id)
+
+
+class SharedMetricsStore:
+    """MetricsStore kept in a SlotFile shared by every process
+
+    the collector process is the only writer, API workers read the
+    latest sample, its rates and the history of `series` from the file.
+    a sample is decoded again only when its slot changed. the workers of
+    the collector record under a lock, so rates are computed and written
+    in the order of the samples.
+    """
+
+    shared = True
+
+    def __init__(self, path, writer=False, capacity=360, series=None, slots=1024,
+                 slot_size=16384):
+        self.writable = writer
+        self.slots = SlotFile(path, writer, slots, slot_size, capacity, series or ())
+        self._calculator = RateCalculator()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def record(self, server_id, info, timestamp=None):
+        if not self.writable:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        values = flatten_info(info)
+        row = [timestamp] + [values.get(name, NAN) for name in self.slots.columns]
+        try:
+            with self._lock:
+                rates = self._calculator.update(server_id, timestamp, info)
+                self.slots.write(server_id, json.dumps([timestamp, info, rates]).encode(), row)
+        except ValueError as e:
+            logger.warning('cannot share the sample of server %s: %s', server_id, e)
+
+    def _load(self, server_id):
+        """return [timestamp, info, rates] of server_id or None
+        """
+        result = self.slots.read(server_id)
+        if result is None:
+            return None
+        key = (self.slots.generation, result[0])
+        cached = self._cache.get(server_id)
+        if cached is None or cached[0] != key:
+            cached = self._cache[server_id] = (key, json.loads(result[1].decode()))
+        return cached[1]
+
+    def latest(self, server_id):
+        sample = self._load(server_id)
+        return None if sample is None else (sample[0], sample[1])
+
+    def rates(self, server_id):
+        sample = self._load(server_id)
+        return None if sample is None else sample[2]
+
+    def history(self, server_id, start=None, end=None, names=None):
+        return self.slots.range(server_id, start, end, names)
+
+    def server_ids(self):
+        return self.slots.server_ids()
+
+    def heartbeat(self, lag):
+        self.slots.heartbeat(lag)
+
+    def set_intervals(self, intervals):
+        self.slots.set_intervals(intervals)
+
+    def intervals(self):
+        return self.slots.intervals()
+
+    def writer_state(self):
+        return self.slots.writer_state()
+
+    def discard(self, server_id):
+        self._cache.pop(server_id, None)
+        if self.writable:
+            with self._lock:
+                self.slots.release(server_id)
+                self._calculator.discard(server_id)
+
+
+class Collector:
+    """probes every registered server on its own schedule
+
+    the background thread syncs the schedule with the database every
+    `sync_interval` seconds and hands due servers to a pool of workers,
+    see rmon.scheduler.Scheduler.
+
+    with `SHARED_STORE_PATH` set, probing belongs to a dedicated process
+    running `serve()` which writes samples to a shared SlotFile, API
+    workers only read it and never probe in the background.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 5
+        self.workers = 8
+        self.sync_interval = 30
+        self.tick = 0.05
+        self.store = MetricsStore()
+        self.scheduler = Scheduler()
+        # callables notified with (server_id, timestamp, info) of every sample
+        self.listeners = []
+        # callables servers -> servers narrowing a batch of due probes
+        self.filters = []
+
+        self._serving = False
+        self._thread = None
+        self._stopped = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('COLLECTOR_INTERVAL', self.interval)
+        self.workers = app.config.get('COLLECTOR_WORKERS', self.workers)
+        self.sync_interval = app.config.get('SCHEDULER_SYNC_INTERVAL', self.sync_interval)
+        self.tick = app.config.get('SCHEDULER_TICK', self.tick)
+        self.scheduler.init_app(app)
+        if app.config.get('SHARED_STORE_PATH'):
+            self.store = self.shared_store(app.config, writer=False)
+            return
+        self.store = MetricsStore(app.config.get('COLLECTOR_HISTORY_SIZE', 360),
+                                  app.config.get('COLLECTOR_SERIES'))
+
+        if app.config.get('COLLECTOR_ENABLED'):
+            self.start()
+
+    @staticmethod
+    def shared_store(config, writer):
+        return SharedMetricsStore(config['SHARED_STORE_PATH'], writer,
+                                  config.get('COLLECTOR_HISTORY_SIZE', 360),
+                                  config.get('COLLECTOR_SERIES'),
+                                  config.get('SHARED_STORE_SLOTS', 1024),
+                                  config.get('SHARED_STORE_SLOT_SIZE', 16384))
+
+    @property
+    def running(self):
+        if self.store.shared and not self.store.writable:
+            # the collector process is alive if its heartbeat is recent
+            return time.time() - self.store.writer_state()[0] < HEARTBEAT_TIMEOUT
+        return self._serving or self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """start polling in a daemon thread
+        """
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='rmon-collector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve(self):
+        """probe in the calling thread as the writer of the shared store,
+        until stop() is called
+        """
+        self.store = self.shared_store(self.app.config, writer=True)
+        self._stopped.clear()
+        self._serving = True
+        try:
+            self._run()
+        finally:
+            self._serving = False
+
+    @property
+    def lag(self):
+        """seconds the most overdue probe is behind its schedule
+        """
+        if not self.running:
+            return 0
+        if self.store.shared and not self.store.writable:
+            return self.store.writer_state()[1]
+        return self.scheduler.lag()
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        next_sync = next_heartbeat = 0
+        try:
+            while not self._stopped.is_set():
+                now = time.time()
+                if now >= next_sync:
+                    next_sync = now + self.sync_interval
+                    try:
+                        with self.app.app_context():
+                            for server_id in self.scheduler.sync(now=now):
+                                self.store.discard(server_id)
+                    except Exception:
+                        logger.exception('probe schedule sync failed')
+
+                servers = self.scheduler.due(now)
+                if servers:
+                    self._dispatch(executor, servers)
+                if self.store.shared:
+                    self.store.heartbeat(self.scheduler.lag(now))
+                    if now >= next_heartbeat:
+                        next_heartbeat = now + HEARTBEAT_INTERVAL
+                        self.store.set_intervals(self.scheduler.effective_intervals())
+
+                wake = min(next_sync, now + HEARTBEAT_INTERVAL)
+                next_due = self.scheduler.next_due()
+                if next_due is not None:
+                    wake = min(wake, next_due)
+                # due probes are batched per tick
+                self._stopped.wait(max(self.tick, wake - time.time()))
+        finally:
+            executor.shutdown(wait=False)
+
+    def _dispatch(self, executor, servers):
+        probed = servers
+        for narrow in self.filters:
+            probed = narrow(probed)
+        if len(probed) != len(servers):
+            kept = {server.id for server in probed}
+            for server in servers:
+                if server.id not in kept:
+                    self.scheduler.skip(server.id)
+
+        if probes.enabled:
+            executor.submit(self._probe_many, probed)
+        else:
+            for server in probed:
+                executor.submit(self._probe, server)
+
+    def _probe(self, server):
+        try:
+            info = self.poll(server)
+        except RestException as e:
+            logger.warning(e.message)
+            self.scheduler.complete(server.id, False)
+        except Exception:
+            logger.exception('probe of %s failed', server.host)
+            self.scheduler.complete(server.id, False)
+        else:
+            self.scheduler.complete(server.id, True, info)
+
+    def _probe_many(self, servers):
+        try:
+            results = probes.info_many(servers)
+        except Exception:
+            logger.exception('async probes failed')
+            results = [None] * len(servers)
+        for server, info in zip(servers, results):
+            if isinstance(info, dict):
+                self.record(server.id, info)
+                self.scheduler.complete(server.id, True, info)
+            else:
+                logger.warning('cannot connect to redis server %s: %s', server.host, info)
+                self.scheduler.complete(server.id, False)
+
+    def record(self, server_id, info):
+        """store a sample and notify listeners
+        """
+        if not self.store.writable:
+            # API workers neither store nor publish samples
+            return
+        timestamp = time.time()
+        self.store.record(server_id, info, timestamp)
+        for listener in self.listeners:
+            try:
+                listener(server_id, timestamp, info)
+            except Exception:
+                logger.exception('metrics listener failed')
+
+    def poll(self, server):
+        """fetch INFO of one server and record it
+        """
+        info = server.get_metrics()
+        self.record(server.id, info)
+        return info
+
+    def collect(self, servers=None):
+        """poll servers once, all registered servers by default
+
+        must run in an app context
+        """
+        started = time.time()
+        prune = servers is None
+        if prune:
+            servers = Server.query.all()
+            alive = {server.id for server in servers}
+            for narrow in self.filters:
+                servers = narrow(servers)
+
+        if probes.enabled:
+            # every probe shares the engine loop, no worker thread per server
+            for server, info in zip(servers, probes.info_many(servers)):
+                if isinstance(info, Exception):
+                    logger.warning('cannot connect to redis server %s: %s', server.host, info)
+                else:
+                    self.record(server.id, info)
+        else:
+            def poll(server):
+                try:
+                    self.poll(server)
+                except RestException as e:
+                    logger.warning(e.message)
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(poll, servers))
+
+        if not prune:
+            return
+
+        CYCLE_SECONDS.observe(time.time() - started)
+        for server_id in self.store.server_ids():
+            if server_id not in alive:
+                self.store.discard(server_id)
+
+    def effective_intervals(self):
+        """see Scheduler.effective_intervals, API workers of a shared store
+        read what the collector process published
+        """
+        if self.store.shared and not self.store.writable:
+            return self.store.intervals()
+        return self.scheduler.effective_intervals()
+
+    def interval_of(self, server_id):
+        """seconds until the next sample of server_id is expected, its
+        effective interval while it is scheduled, `interval` otherwise
+        """
+        interval = self.scheduler.effective_interval(server_id)
+        return self.interval if interval is None else interval
+
+    def latest(self, server):
+        """return INFO of server, probing it only if the cached sample is stale
+        """
+        sample = self.store.latest(server.id)
+        if sample is not None:
+            # a shared sample is as fresh as the schedule of its server
+            if time.time() - sample[0] < self.interval_of(server.id) or \
+                    self.store.shared and self.running:
+                return sample[1]
+        return self.poll(server)
+
+    def rates(self, server):
+        """return rates of server, probing it only if the cached sample is stale
+        """
+        info = self.latest(server)
+        rates = self.store.rates(server.id)
+        if rates is None:
+            # a worker probed a server the collector process has no sample of
+            rates = RateCalculator().update(server.id, time.time(), info)
+        return rates
+
+
+collector = Collector()
@@ -0,0 +1,163 @@
+""" rmon.common.aggregate
+fleet-wide statistics over the cached samples of many servers
+"""
+
+import math
+import re
+from array import array
+
+NAN = float('nan')
+STATS = ('count', 'sum', 'avg', 'min', 'max')
+PERCENTILE = re.compile(r'^p(\d{1,2}(\.\d+)?|100)$')
+# group keys read from the server record instead of the sample
+SERVER_KEYS = ('host', 'port')
+# `tag.<key>` groups servers by the value of one of their tags
+TAG_PREFIX = 'tag.'
+# `rate.<counter>` fields read the rates of the latest two samples
+RATE_PREFIX = 'rate.'
+
+
+def parse_stats(value):
+    """split `sum,avg,p99`
+
+    Raises:
+        ValueError: a statistic is unknown
+    """
+    stats = [stat for stat in value.split(',') if stat]
+    for stat in stats:
+        if stat not in STATS and not PERCENTILE.match(stat):
+            raise ValueError('invalid stat {}'.format(stat))
+    return stats
+
+
+def field_value(info, rates, field):
+    """numeric value of a field of a sample, NaN when it has none
+
+    `db0.keys` reads a keyspace field, `rate.total_commands_processed`
+    the per second rate of a counter.
+    """
+    if field.startswith(RATE_PREFIX):
+        value = (rates or {}).get('rates', {}).get(field[len(RATE_PREFIX):])
+    else:
+        value = info.get(field)
+        if value is None and '.' in field:
+            section, _, key = field.partition('.')
+            value = (info.get(section) or {}).get(key)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return NAN
+    return float(value)
+
+
+def percentile(ordered, q):
+    """q-th percentile of sorted values, interpolated between ranks
+    """
+    position = (len(ordered) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values, stats):
+    """return {stat: value} of the non NaN values of a column
+    """
+    present = [value for value in values if value == value]
+    summary = {}
+    if not present:
+        for stat in stats:
+            summary[stat] = 0 if stat == 'count' else None
+        return summary
+
+    ordered = None
+    total = sum(present)
+    for stat in stats:
+        if stat == 'count':
+            summary[stat] = len(present)
+        elif stat == 'sum':
+            summary[stat] = total
+        elif stat == 'avg':
+            summary[stat] = total / len(present)
+        elif stat == 'min':
+            summary[stat] = min(present)
+        elif stat == 'max':
+            summary[stat] = max(present)
+        else:
+            if ordered is None:
+                ordered = sorted(present)
+            summary[stat] = percentile(ordered, float(stat[1:]))
+    return summary
+
+
+class Columns:
+    """the fields of many servers' latest samples, one array per field
+
+    a sample missing a field holds NaN, servers without any sample are
+    listed in `missing`.
+    """
+
+    def __init__(self, servers, fields, store, group_by=None, labels=None):
+        """
+        Args:
+            servers (list): (id, name, host, port) of the servers
+            fields (list): fields to read, see field_value
+            store (MetricsStore): cached samples
+            group_by (str): INFO field, host / port or tag.<key> to group
+                servers by
+            labels (dict): server id -> value of the tag of group_by
+        """
+        self.fields = fields
+        self.ids = []
+        self.names = []
+        self.keys = []
+        self.missing = []
+        self.columns = {field: array('d') for field in fields}
+
+        rates_needed = any(field.startswith(RATE_PREFIX) for field in fields)
+        for server_id, name, host, port in servers:
+            sample = store.latest(server_id)
+            if sample is None:
+                self.missing.append(server_id)
+                continue
+            info = sample[1]
+            rates = store.rates(server_id) if rates_needed else None
+            self.ids.append(server_id)
+            self.names.append(name)
+            for field in fields:
+                self.columns[field].append(field_value(info, rates, field))
+            if group_by is None:
+                continue
+            if group_by == 'host':
+                self.keys.append(host)
+            elif group_by == 'port':
+                self.keys.append(port or 6379)
+            elif group_by.startswith(TAG_PREFIX):
+                self.keys.append((labels or {}).get(server_id))
+            else:
+                key = info.get(group_by)
+                self.keys.append(key if isinstance(key, (str, int, float)) else None)
+
+    def summary(self, stats, indexes=None):
+        """{field: {stat: value}} over every server or the given rows
+        """
+        summary = {}
+        for field, column in self.columns.items():
+            values = column if indexes is None else [column[index] for index in indexes]
+            summary[field] = summarize(values, stats)
+        return summary
+
+    def groups(self, stats):
+        """summaries per group key, the largest groups first
+        """
+        rows = {}
+        for index, key in enumerate(self.keys):
+            rows.setdefault(key, []).append(index)
+        groups = [{'key': key, 'servers': len(indexes), 'summary': self.summary(stats, indexes)}
+                  for key, indexes in rows.items()]
+        groups.sort(key=lambda group: (-group['servers'], str(group['key'])))
+        return groups
+
+    def matrix(self):
+        """every value of every server, None for missing values
+        """
+        return {'ids': self.ids, 'names': self.names,
+                'values': {field: [value if value == value else None for value in column]
+                           for field, column in self.columns.items()}}
@@ -0,0 +1,249 @@
+""" rmon.common.aioprobe
+asyncio engine multiplexing redis probes on one event loop
+"""
+
+import asyncio
+import threading
+import time
+
+from redis.client import parse_info
+from redis.exceptions import (AuthenticationError, ConnectionError, InvalidResponse,
+                              ResponseError, TimeoutError)
+
+from rmon.common.clients import observe_command
+
+
+def encode_command(*args):
+    """encode a command with the RESP protocol
+    """
+    parts = [b'*' + str(len(args)).encode() + b'\r\n']
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$' + str(len(arg)).encode() + b'\r\n' + arg + b'\r\n')
+    return b''.join(parts)
+
+
+async def read_reply(reader):
+    """read one RESP reply, error replies are returned, not raised
+    """
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('connection closed by server')
+
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b'+':
+        return rest
+    if prefix == b'-':
+        return ResponseError(rest.decode())
+    if prefix == b':':
+        return int(rest)
+    if prefix == b'$':
+        length = int(rest)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b'*':
+        length = int(rest)
+        if length == -1:
+            return None
+        reply = []
+        for _ in range(length):
+            reply.append(await read_reply(reader))
+        return reply
+    raise InvalidResponse('protocol error: {!r}'.format(line))
+
+
+class AsyncProbeEngine:
+    """probe redis servers from a private event loop thread
+
+    connections are kept per (host, port, password), hosts which failed
+    are not contacted again until their backoff expires and at most
+    `concurrency` commands are in flight at once. `ping`, `info` and
+    `info_many` are blocking facades usable from any thread.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.concurrency = 1000
+        self.connect_timeout = 3
+        self.read_timeout = 5
+        self.backoff_base = 1
+        self.backoff_max = 60
+        self.max_idle = 2
+        self.instrument = False
+
+        self._loop = None
+        self._semaphore = None
+        self._idle = {}
+        self._backoff = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('PROBE_ENGINE', 'sync') == 'async'
+        self.concurrency = config.get('ASYNC_PROBE_CONCURRENCY', self.concurrency)
+        self.connect_timeout = config.get('ASYNC_PROBE_CONNECT_TIMEOUT', self.connect_timeout)
+        self.read_timeout = config.get('ASYNC_PROBE_READ_TIMEOUT', self.read_timeout)
+        self.backoff_base = config.get('ASYNC_PROBE_BACKOFF_BASE', self.backoff_base)
+        self.backoff_max = config.get('ASYNC_PROBE_BACKOFF_MAX', self.backoff_max)
+        self.max_idle = config.get('ASYNC_PROBE_MAX_IDLE', self.max_idle)
+        self.instrument = config.get('INSTRUMENT_ENABLED', self.instrument)
+
+    @staticmethod
+    def key(server):
+        return (server.host, int(server.port or 6379), server.password)
+
+    # sync facade
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run, name='rmon-aioprobe')
+            thread.daemon = True
+            thread.start()
+            asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+            self._loop = loop
+
+    async def _setup(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    def run(self, coro):
+        """run coro on the engine loop and wait for its result
+        """
+        self._start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def ping(self, server, timeout=None):
+        return self.run(self.aping(server, timeout))
+
+    def info(self, server, timeout=None):
+        return self.run(self.ainfo(server, timeout))
+
+    def info_many(self, servers):
+        """INFO of every server, a failed probe yields its exception
+        """
+        return self.run(self.agather([self.ainfo(server) for server in servers]))
+
+    # coroutines
+
+    async def agather(self, coros):
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+    async def aping(self, server, timeout=None):
+        return await self.execute(self.key(server), 'PING', timeout=timeout) == b'PONG'
+
+    async def ainfo(self, server, timeout=None):
+        reply = await self.execute(self.key(server), 'INFO', timeout=timeout)
+        return parse_info(reply.decode())
+
+    async def execute(self, key, *args, timeout=None):
+        """send one command to the server identified by key
+
+        timeout bounds connecting and reading instead of connect_timeout
+        and read_timeout when given
+        """
+        if not self.instrument:
+            return await self._execute(key, *args, timeout=timeout)
+        started = time.perf_counter()
+        failed = True
+        try:
+            reply = await self._execute(key, *args, timeout=timeout)
+            failed = False
+            return reply
+        finally:
+            observe_command(args[0], '{}:{}'.format(*key[:2]), time.perf_counter() - started,
+                            failed)
+
+    async def _execute(self, key, *args, timeout=None):
+        self._check_backoff(key)
+        read_timeout = self.read_timeout if timeout is None else timeout
+
+        async with self._semaphore:
+            reply = None
+            for attempt in range(2):
+                reader, writer, reused = await self._acquire(key, timeout)
+                try:
+                    writer.write(encode_command(*args))
+                    reply = await asyncio.wait_for(read_reply(reader), read_timeout)
+                    break
+                except asyncio.TimeoutError:
+                    writer.close()
+                    self._failed(key)
+                    raise TimeoutError('timeout reading from {}:{}'.format(*key[:2]))
+                except (OSError, EOFError, ConnectionError) as e:
+                    writer.close()
+                    # an idle connection may have been closed by the server
+                    if reused and attempt == 0:
+                        continue
+                    self._failed(key)
+                    raise ConnectionError('error reading from {}:{}: {}'.format(key[0], key[1], e))
+
+            self._release(key, reader, writer)
+            self._backoff.pop(key, None)
+
+        if isinstance(reply, ResponseError):
+            raise reply
+        return reply
+
+    async def _acquire(self, key, timeout=None):
+        idle = self._idle.get(key)
+        if idle:
+            reader, writer = idle.pop()
+            return reader, writer, True
+
+        host, port, password = key
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port),
+                self.connect_timeout if timeout is None else timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._failed(key)
+            raise ConnectionError('error connecting to {}:{}: {}'.format(host, port, e))
+
+        if password:
+            writer.write(encode_command('AUTH', password))
+            try:
+                reply = await asyncio.wait_for(read_reply(reader),
+                                               self.read_timeout if timeout is None else timeout)
+            except (OSError, EOFError, ConnectionError, asyncio.TimeoutError) as e:
+                writer.close()
+                self._failed(key)
+                raise ConnectionError('error authenticating to {}:{}: {}'.format(host, port, e))
+            if isinstance(reply, ResponseError):
+                writer.close()
+                raise AuthenticationError(str(reply))
+
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def _check_backoff(self, key):
+        state = self._backoff.get(key)
+        if state is not None and time.time() < state[1]:
+            raise ConnectionError('{}:{} is unreachable, retry in {:.1f}s'.format(
+                key[0], key[1], state[1] - time.time()))
+
+    def _failed(self, key):
+        failures = self._backoff.get(key, (0, 0))[0] + 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (failures - 1))
+        self._backoff[key] = (failures, time.time() + delay)
+
+
+probes = AsyncProbeEngine()
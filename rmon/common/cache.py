@@ -0,0 +1,107 @@
+""" rmon.common.cache
+bounded in-process caches
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+
+class TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after being set
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ObjectCache:
+    """read-through cache of SQLAlchemy rows looked up by primary key
+
+    only column values are cached, every hit builds a fresh instance and
+    merges it into the current session without a SELECT, so cached state
+    is never shared between requests.
+
+    a process only invalidates its own cache. with `SHARED_STORE_PATH`
+    set, other API workers would serve a row changed or deleted by one of
+    them for up to `ttl` seconds, so the cache is disabled there.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self._cache = TTLCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('OBJECT_CACHE_ENABLED', True) and \
+            not app.config.get('SHARED_STORE_PATH')
+        self._cache = TTLCache(app.config.get('OBJECT_CACHE_SIZE', 1024),
+                               app.config.get('OBJECT_CACHE_TTL', 30))
+
+    def get(self, model, object_id):
+        """return the instance of model with object_id or None
+        """
+        if not self.enabled:
+            return model.query.get(object_id)
+
+        key = (model.__name__, object_id)
+        values = self._cache.get(key)
+        if values is None:
+            obj = model.query.get(object_id)
+            if obj is not None:
+                self._cache.set(key, {attr.key: getattr(obj, attr.key)
+                                      for attr in inspect(model).column_attrs})
+            return obj
+
+        obj = model(**values)
+        make_transient_to_detached(obj)
+        return model.query.session.merge(obj, load=False)
+
+    def invalidate(self, model, object_id):
+        self._cache.pop((model.__name__, object_id))
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+object_cache = ObjectCache()
@@ -0,0 +1,219 @@
+""" rmon.common.clients
+process-wide registry of pooled redis clients
+"""
+
+import threading
+import time
+
+from redis import StrictRedis, BlockingConnectionPool
+from redis.client import StrictPipeline
+
+from rmon.common.metrics import registry
+
+COMMAND_SECONDS = registry.histogram(
+    'rmon_redis_command_seconds', 'Latency of redis commands sent by rmon.', ('command',))
+SERVER_SECONDS = registry.counter(
+    'rmon_redis_server_seconds_total', 'Time spent in redis commands per server.', ('server',))
+SERVER_COMMANDS = registry.counter(
+    'rmon_redis_server_commands_total', 'Redis commands sent per server.', ('server',))
+SERVER_ERRORS = registry.counter(
+    'rmon_redis_server_errors_total', 'Failed redis commands per server.', ('server',))
+
+
+def observe_command(command, server, elapsed, failed=False):
+    """record one redis command (or pipeline) sent to server
+    """
+    COMMAND_SECONDS.observe(elapsed, command)
+    SERVER_SECONDS.inc(server, amount=elapsed)
+    SERVER_COMMANDS.inc(server)
+    if failed:
+        SERVER_ERRORS.inc(server)
+
+
+def _address(pool):
+    kwargs = pool.connection_kwargs
+    return '{}:{}'.format(kwargs.get('host'), kwargs.get('port'))
+
+
+class InstrumentedPipeline(StrictPipeline):
+    """StrictPipeline timing execute as one PIPELINE command
+    """
+
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(raise_on_error)
+            failed = False
+            return result
+        finally:
+            observe_command('PIPELINE', _address(self.connection_pool),
+                            time.perf_counter() - started, failed)
+
+
+class InstrumentedRedis(StrictRedis):
+    """StrictRedis timing every command
+    """
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute_command(*args, **options)
+            failed = False
+            return result
+        finally:
+            command = args[0] if isinstance(args[0], str) else args[0].decode()
+            observe_command(command.upper(), _address(self.connection_pool),
+                            time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
+
+
+class _Entry:
+    """a cached client and the last time it was handed out
+    """
+
+    __slots__ = ('client', 'last_used')
+
+    def __init__(self, client, last_used):
+        self.client = client
+        self.last_used = last_used
+
+
+class RedisClients:
+    """StrictRedis clients cached per server
+
+    every server gets its own bounded connection pool, keyed by
+    (id, host, port, password) so that a changed record never reuses
+    a pool pointing at the old address. probes bounded by a timeout get
+    a pool of their own whose sockets give up after that timeout.
+    """
+
+    def __init__(self, app=None):
+        self.max_connections = 8
+        self.pool_timeout = 5
+        self.idle_timeout = 300
+        self.socket_timeout = 5
+        self.socket_connect_timeout = 3
+        self.instrument = False
+
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read pool settings from app config
+        """
+        config = app.config
+        self.max_connections = config.get('REDIS_POOL_MAX_CONNECTIONS', self.max_connections)
+        self.pool_timeout = config.get('REDIS_POOL_TIMEOUT', self.pool_timeout)
+        self.idle_timeout = config.get('REDIS_POOL_IDLE_TIMEOUT', self.idle_timeout)
+        self.socket_timeout = config.get('REDIS_SOCKET_TIMEOUT', self.socket_timeout)
+        self.socket_connect_timeout = config.get('REDIS_SOCKET_CONNECT_TIMEOUT',
+                                                 self.socket_connect_timeout)
+        self.instrument = config.get('INSTRUMENT_ENABLED', self.instrument)
+
+    @staticmethod
+    def key(server):
+        """cache key of a server
+        """
+        return (server.id, server.host, int(server.port or 6379), server.password)
+
+    def get(self, server, timeout=None):
+        """return the cached client of server, create one if needed
+
+        Args:
+            timeout (float): seconds after which connecting, reading and
+                waiting for a pooled connection fail, the configured
+                timeouts when None
+        """
+        address = self.key(server)
+        key = address + (timeout,)
+        now = time.time()
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                # the record has changed, drop pools built for its old address
+                if server.id is not None:
+                    self._discard(server.id, address)
+                entry = self._clients[key] = _Entry(self._create(key), now)
+            entry.last_used = now
+
+            if now - self._last_sweep >= self.idle_timeout:
+                self._sweep(now)
+
+        return entry.client
+
+    def invalidate(self, server_id):
+        """drop every client built for server_id
+        """
+        with self._lock:
+            self._discard(server_id)
+
+    def evict_idle(self):
+        """drop clients which have not been used for idle_timeout seconds
+        """
+        with self._lock:
+            self._sweep(time.time())
+
+    def clear(self):
+        """drop all clients
+        """
+        with self._lock:
+            for entry in self._clients.values():
+                entry.client.connection_pool.disconnect()
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def stats(self):
+        """occupancy of the pools: pools, connections, in_use and idle
+        """
+        with self._lock:
+            pools = [entry.client.connection_pool for entry in self._clients.values()]
+        connections = in_use = 0
+        for pool in pools:
+            created = len(pool._connections)
+            idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+            connections += created
+            in_use += created - idle
+        return {'pools': len(pools), 'connections': connections, 'in_use': in_use,
+                'idle': connections - in_use}
+
+    def _create(self, key):
+        _, host, port, password, timeout = key
+        pool = BlockingConnectionPool(
+            max_connections=self.max_connections,
+            timeout=self.pool_timeout if timeout is None else timeout,
+            host=host,
+            port=port,
+            password=password,
+            socket_timeout=self.socket_timeout if timeout is None else timeout,
+            socket_connect_timeout=self.socket_connect_timeout if timeout is None else timeout)
+        if self.instrument:
+            return InstrumentedRedis(connection_pool=pool)
+        return StrictRedis(connection_pool=pool)
+
+    def _discard(self, server_id, address=None):
+        """drop the clients of server_id except those built for address
+        """
+        for key in [k for k in self._clients if k[0] == server_id and k[:4] != address]:
+            self._clients.pop(key).client.connection_pool.disconnect()
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for key, entry in list(self._clients.items()):
+            if now - entry.last_used >= self.idle_timeout:
+                del self._clients[key]
+                entry.client.connection_pool.disconnect()
+
+
+clients = RedisClients()
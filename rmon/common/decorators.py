@@ -2,11 +2,12 @@ from functools import wraps
 
 from flask import g
 
+from rmon.common.cache import object_cache
 from rmon.common.rest import RestException
 
 
 class ObjectMustExist:
-    """该装饰器确保对象存在
+    """该装饰器确保对象存在，对象通过 object_cache 读取
     """
 
     def __init__(self, object_class):
@@ -30,7 +31,7 @@ class ObjectMustExist:
             if object_id is None:
                 raise RestException(404, 'object doesn\'t exist')
 
-            obj = self.object_class.query.get(object_id)
+            obj = object_cache.get(self.object_class, object_id)
             if obj is None:
                 raise RestException(404, 'object doesn\'t exist')
             g.instance = obj
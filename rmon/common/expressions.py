@@ -0,0 +1,168 @@
+""" rmon.common.expressions
+alert conditions over INFO fields compiled once into python code
+"""
+
+import ast
+import re
+
+# `<condition> for 5m`
+DURATION = re.compile(r'^(?P<condition>.+?)\s+for\s+(?P<value>\d+)(?P<unit>[smhd]?)\s*$')
+UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# `connected_clients rate` is a shorthand of `rate(connected_clients)`
+POSTFIX = re.compile(r'\b(?!(?:and|or|not)\b)([A-Za-z_][\w.]*)\s+(rate|delta)\b(?!\s*\()')
+
+# functions over the change of a field since the previous sample
+CHANGES = ('rate', 'delta')
+BUILTINS = {'abs': abs, 'min': min, 'max': max}
+
+# no `**` and no strings: a condition runs on every sample while the
+# engine is locked, so it must not build huge numbers or strings
+NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.BinOp, ast.Add, ast.Sub, ast.Mult,
+         ast.Div, ast.FloorDiv, ast.Mod, ast.UnaryOp, ast.UAdd, ast.USub, ast.Not,
+         ast.Compare, ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq, ast.Call, ast.Name,
+         ast.Attribute, ast.Load, ast.Num, ast.NameConstant) + \
+    ((ast.Constant,) if hasattr(ast, 'Constant') else ())
+# python 3.8 parses every literal, strings too, as ast.Constant
+CONSTANT = getattr(ast, 'Constant', ast.NameConstant)
+NUMBERS = (int, float, bool, type(None))
+
+
+def split_duration(text):
+    """return (condition, seconds) of `<condition> for <duration>`
+
+    seconds is None without a `for` clause.
+    """
+    match = DURATION.match(text.strip())
+    if match is None:
+        return text.strip(), None
+    return match.group('condition'), int(match.group('value')) * UNITS[match.group('unit')]
+
+
+def _field_name(node):
+    """`db0.keys` parses as an attribute, return the dotted field name
+    """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = _field_name(node.value)
+        if parent is not None:
+            return '{}.{}'.format(parent, node.attr)
+    return None
+
+
+def _lookup(function, field):
+    return ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[ast.Str(s=field)],
+                    keywords=[])
+
+
+class _Rewriter(ast.NodeTransformer):
+    """replace fields by `_field('name')` and changes by `_rate('name')`
+    """
+
+    def __init__(self):
+        self.fields = set()
+
+    def visit_Name(self, node):
+        if node.id in BUILTINS or node.id in CHANGES:
+            raise ValueError('{} must be called'.format(node.id))
+        self.fields.add(node.id)
+        return _lookup('_field', node.id)
+
+    def visit_Attribute(self, node):
+        field = _field_name(node)
+        if field is None:
+            raise ValueError('invalid field')
+        self.fields.add(field)
+        return _lookup('_field', field)
+
+    def visit_Call(self, node):
+        name = node.func.id if isinstance(node.func, ast.Name) else None
+        if node.keywords or name not in BUILTINS and name not in CHANGES:
+            raise ValueError('unknown function {}'.format(name or '?'))
+        if name in CHANGES:
+            field = _field_name(node.args[0]) if len(node.args) == 1 else None
+            if field is None:
+                raise ValueError('{}() takes one field'.format(name))
+            self.fields.add(field)
+            return _lookup('_' + name, field)
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+
+def compile_condition(text):
+    """compile a condition such as `used_memory / maxmemory > 0.9`
+
+    names are INFO fields (`db0.keys` for keyspace fields), `rate(x)` and
+    `delta(x)` are the change of x per second and since the previous
+    sample. nothing but arithmetic, comparisons and abs/min/max is
+    accepted.
+
+    Returns:
+        (code, fields): code to eval with the namespace of a Sample
+
+    Raises:
+        ValueError: the condition is invalid
+    """
+    source = POSTFIX.sub(r'\2(\1)', text.strip())
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError as e:
+        raise ValueError('invalid condition: {}'.format(e.msg))
+    for node in ast.walk(tree):
+        if not isinstance(node, NODES) or \
+                isinstance(node, CONSTANT) and not isinstance(node.value, NUMBERS):
+            raise ValueError('{} is not allowed in a condition'.format(type(node).__name__))
+
+    rewriter = _Rewriter()
+    tree = ast.fix_missing_locations(rewriter.visit(tree))
+    return compile(tree, '<condition>', 'eval'), frozenset(rewriter.fields)
+
+
+class Missing(Exception):
+    """a field of the condition is not in the sample
+    """
+
+
+class Sample:
+    """namespace of one INFO sample and the previous one of its server
+    """
+
+    def __init__(self, timestamp, info, previous=None):
+        self.timestamp = timestamp
+        self.info = info
+        self.previous = previous
+        self.namespace = dict(BUILTINS, __builtins__={}, _field=self.field, _rate=self.rate,
+                              _delta=self.delta)
+
+    @staticmethod
+    def _get(info, name):
+        value = info.get(name)
+        if value is None and '.' in name:
+            section, _, key = name.partition('.')
+            value = (info.get(section) or {}).get(key)
+        if value is None or isinstance(value, dict):
+            raise Missing(name)
+        return value
+
+    def field(self, name):
+        return self._get(self.info, name)
+
+    def delta(self, name):
+        if self.previous is None:
+            raise Missing(name)
+        return self._get(self.info, name) - self._get(self.previous[1], name)
+
+    def rate(self, name):
+        delta = self.delta(name)
+        interval = self.timestamp - self.previous[0]
+        if interval <= 0:
+            raise Missing(name)
+        return delta / interval
+
+    def evaluate(self, code):
+        """return the value of code, None when it cannot be computed
+        """
+        try:
+            return eval(code, self.namespace)
+        except (Missing, ArithmeticError, TypeError):
+            return None
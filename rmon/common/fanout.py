@@ -0,0 +1,78 @@
+""" rmon.common.fanout
+run blocking calls concurrently with per-call and overall deadlines
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# longest time to block before re-checking per-call deadlines
+POLL_INTERVAL = 0.05
+
+
+def fan_out(items, func, timeout, deadline, workers):
+    """call func(item) for every item in a thread pool
+
+    results are yielded as soon as each call finishes, a call running
+    longer than `timeout` or still pending when `deadline` expires is
+    reported without waiting for it.
+
+    Args:
+        items (list): arguments of func
+        func (callable): blocking call
+        timeout (float): seconds allowed for one call once it has started
+        deadline (float): seconds allowed for all calls
+        workers (int): size of the thread pool
+
+    Yields:
+        (item, status, value, elapsed): status is 'ok' with the return
+        value, 'error' with the raised exception, or 'timeout' with None
+    """
+    started = {}
+
+    def run(index):
+        started[index] = time.time()
+        return func(items[index])
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(items))))
+    futures = {executor.submit(run, index): index for index in range(len(items))}
+    pending = set(futures)
+    end = time.time() + deadline
+
+    try:
+        while pending:
+            now = time.time()
+            if now >= end:
+                break
+
+            # report calls which have run out of time
+            for future in list(pending):
+                index = futures[future]
+                start = started.get(index)
+                if start is not None and now - start >= timeout and not future.done():
+                    pending.discard(future)
+                    yield items[index], 'timeout', None, now - start
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, timeout=min(end - now, POLL_INTERVAL),
+                           return_when=FIRST_COMPLETED)
+            finished = time.time()
+            for future in done:
+                pending.discard(future)
+                index = futures[future]
+                elapsed = finished - started.get(index, finished)
+                error = future.exception()
+                if error is None:
+                    yield items[index], 'ok', future.result(), elapsed
+                else:
+                    yield items[index], 'error', error, elapsed
+
+        now = time.time()
+        for future in pending:
+            index = futures[future]
+            yield items[index], 'timeout', None, now - started.get(index, now)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
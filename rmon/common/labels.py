@@ -0,0 +1,108 @@
+""" rmon.common.labels
+key=value tags of servers and the selectors choosing servers by them
+"""
+
+import re
+from collections import namedtuple
+
+KEY = re.compile(r'^[A-Za-z0-9_][\w.\-/]{0,63}$')
+VALUE = re.compile(r'^[\w.\-/:@]{0,128}$')
+# tags of one server, requirements of one selector
+MAX_TAGS = 32
+MAX_REQUIREMENTS = 16
+
+EXISTS = re.compile(r'^(?P<negated>!?)\s*(?P<key>[^\s!=()]+)$')
+EQUALS = re.compile(r'^(?P<key>[^\s!=()]+)\s*(?P<operator>==|=|!=)\s*(?P<value>[^\s=()]*)$')
+SET = re.compile(r'^(?P<key>[^\s!=()]+)\s+(?P<operator>in|notin)\s*\((?P<values>[^()]*)\)$')
+
+# servers having (or not having) the key with one of values, any value
+# when values is None
+Requirement = namedtuple('Requirement', ('key', 'negated', 'values'))
+
+
+def validate_labels(labels):
+    """check the tags given for a server
+
+    Raises:
+        ValueError: labels is not a dict of valid keys and values
+    """
+    if not isinstance(labels, dict):
+        raise ValueError('tags must be an object')
+    if len(labels) > MAX_TAGS:
+        raise ValueError('at most {} tags per server'.format(MAX_TAGS))
+    for key, value in labels.items():
+        if not KEY.match(key):
+            raise ValueError('invalid tag key {}'.format(key))
+        if not isinstance(value, str) or not VALUE.match(value):
+            raise ValueError('invalid value of tag {}'.format(key))
+
+
+def _split(text):
+    """split on the commas outside of parentheses
+    """
+    parts, depth, start = [], 0, 0
+    for index, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts]
+
+
+def _check(key, values=()):
+    if not KEY.match(key):
+        raise ValueError('invalid tag key {}'.format(key))
+    for value in values:
+        if not VALUE.match(value):
+            raise ValueError('invalid tag value {}'.format(value))
+
+
+def parse_selector(text):
+    """parse `env=prod,role!=cache,team in (a,b),tier notin (x),backup,!legacy`
+
+    every requirement must hold: `=`, `!=`, `in` and `notin` compare the
+    value of a key, a bare key requires it and `!key` excludes it. like
+    label selectors elsewhere, `!=` and `notin` also match servers
+    without the key.
+
+    Returns:
+        list: Requirement of each comma separated term
+
+    Raises:
+        ValueError: the selector is invalid
+    """
+    requirements = []
+    for part in _split(text):
+        if not part:
+            continue
+        match = EQUALS.match(part)
+        if match is not None:
+            key, value = match.group('key'), match.group('value')
+            _check(key, (value,))
+            requirements.append(Requirement(key, match.group('operator') == '!=', (value,)))
+            continue
+        match = SET.match(part)
+        if match is not None:
+            key = match.group('key')
+            values = tuple(sorted({value.strip() for value in match.group('values').split(',')
+                                   if value.strip()}))
+            if not values:
+                raise ValueError('{} needs at least one value'.format(part))
+            _check(key, values)
+            requirements.append(Requirement(key, match.group('operator') == 'notin', values))
+            continue
+        match = EXISTS.match(part)
+        if match is not None:
+            _check(match.group('key'))
+            requirements.append(Requirement(match.group('key'), bool(match.group('negated')),
+                                            None))
+            continue
+        raise ValueError('invalid selector {}'.format(part))
+
+    if len(requirements) > MAX_REQUIREMENTS:
+        raise ValueError('at most {} requirements per selector'.format(MAX_REQUIREMENTS))
+    return requirements
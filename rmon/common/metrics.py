@@ -0,0 +1,179 @@
+""" rmon.common.metrics
+counters, gauges and histograms rendered in the Prometheus text format
+"""
+
+import bisect
+import threading
+
+# seconds, from a fast local redis command to a slow remote INFO
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    """`{name="value",...}`, extra is one more (name, value) pair
+    """
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """a metric family, values are kept per tuple of label values
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def remove(self, *labels):
+        with self._lock:
+            self._values.pop(labels, None)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.documentation),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+    def collect(self):
+        """return the exposition lines of the family
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + ['{}{} {}'.format(self.name, format_labels(self.labels, labels),
+                                                  format_value(value)) for labels, value in values]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """a gauge set directly or read from `callback` at collection time
+
+    callback returns {label values tuple: value}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def collect(self):
+        if self.callback is not None:
+            values = self.callback()
+            with self._lock:
+                self._values = dict(values)
+        return super().collect()
+
+
+class Histogram(Metric):
+    """cumulative buckets, sum and count per label values
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return sum(state[0]) if state else 0
+
+    def collect(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self._values.items())
+        lines = self.header()
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labels, labels, ('le', format_value(float(bound)))),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, labels),
+                                              format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, labels),
+                                                cumulative))
+        return lines
+
+
+class Registry:
+    """metric families of the process, in registration order
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self._register(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self):
+        """return every family in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,100 @@
+""" rmon.common.rates
+per-second rates of the monotonic INFO counters
+"""
+
+# monotonic counters of INFO, reset to zero when redis restarts
+COUNTERS = (
+    'total_commands_processed',
+    'total_connections_received',
+    'rejected_connections',
+    'keyspace_hits',
+    'keyspace_misses',
+    'expired_keys',
+    'evicted_keys',
+    'total_net_input_bytes',
+    'total_net_output_bytes',
+    'used_cpu_sys',
+    'used_cpu_user',
+)
+
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return hits / total if total else None
+
+
+class RateCalculator:
+    """derive deltas and rates from consecutive INFO samples
+
+    only the previous sample of every server is kept, so each update
+    costs O(number of counters).
+    """
+
+    def __init__(self, counters=COUNTERS):
+        self.counters = counters
+        self._previous = {}
+
+    def update(self, server_id, timestamp, info):
+        """feed a sample and return what changed since the previous one
+
+        a restart (new run_id or smaller uptime) or a counter going
+        backwards is treated as a reset: the delta is the value counted
+        since the restart.
+
+        Returns:
+            dict: timestamp, interval, reset, deltas, rates and hit ratios
+        """
+        current = {name: info[name] for name in self.counters
+                   if isinstance(info.get(name), (int, float))}
+        run_id = info.get('run_id')
+        uptime = info.get('uptime_in_seconds')
+
+        previous = self._previous.get(server_id)
+        self._previous[server_id] = (timestamp, run_id, uptime, current)
+
+        result = {
+            'timestamp': timestamp,
+            'interval': None,
+            'reset': False,
+            'deltas': {},
+            'rates': {},
+            'hit_ratio': _ratio(current.get('keyspace_hits', 0), current.get('keyspace_misses', 0)),
+            'interval_hit_ratio': None,
+        }
+        if previous is None:
+            return result
+
+        prev_timestamp, prev_run_id, prev_uptime, prev_values = previous
+        elapsed = timestamp - prev_timestamp
+        if elapsed <= 0:
+            return result
+
+        restarted = (run_id is not None and run_id != prev_run_id) or \
+            (uptime is not None and prev_uptime is not None and uptime < prev_uptime)
+
+        deltas = {}
+        reset = restarted
+        for name, value in current.items():
+            prev_value = prev_values.get(name)
+            if prev_value is None:
+                continue
+            delta = value - prev_value
+            if restarted or delta < 0:
+                delta = value
+                reset = True
+            deltas[name] = delta
+
+        # counters restarted from zero only had `uptime` seconds to grow
+        if restarted and uptime:
+            elapsed = min(elapsed, uptime)
+
+        result['interval'] = elapsed
+        result['reset'] = reset
+        result['deltas'] = deltas
+        result['rates'] = {name: delta / elapsed for name, delta in deltas.items()}
+        if 'keyspace_hits' in deltas and 'keyspace_misses' in deltas:
+            result['interval_hit_ratio'] = _ratio(deltas['keyspace_hits'], deltas['keyspace_misses'])
+        return result
+
+    def discard(self, server_id):
+        self._previous.pop(server_id, None)
@@ -2,10 +2,11 @@
 """
 from collections import Mapping
 
-from flask import request, Response, make_response
-from flask.json import dumps
+from flask import request, Response
 from flask.views import MethodView
 
+from rmon.common.serializers import serializer
+
 
 class RestException(Exception):
     """exception base
@@ -40,8 +41,7 @@ class RestView(MethodView):
             'message': exception.message
         }
 
-        result = dumps(data) + '\n'
-        resp = make_response(result, exception.code)
+        resp = serializer.response(data, exception.code)
         resp.headers['Content-Type'] = self.content_type
         return resp
 
@@ -88,11 +88,8 @@ class RestView(MethodView):
 
             data = {'ok': False, 'message': message}
 
-        # 序列化数据
-        result = dumps(data) + '\n'
-
-        # 生成 HTTP 响应
-        response = make_response(result, code)
+        # 序列化数据并生成 HTTP 响应，见 rmon.common.serializers
+        response = serializer.response(data, code)
         response.headers.extend(headers)
 
         # 设置响应头为 application/json
@@ -0,0 +1,152 @@
+""" rmon.common.serializers
+response body encoding of RestView
+"""
+
+import gzip
+import zlib
+
+from flask import request, Response
+from flask.json import dumps, JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# zlib window bits of the supported content codings
+WBITS = {'gzip': 31, 'deflate': 15}
+
+if orjson is not None:
+    # sorted keys, non-string keys and datetimes written like the Flask
+    # encoder does; NaN and infinities become null rather than NaN
+    ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | \
+        orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def _stdlib_dumps(data):
+    return dumps(data).encode('utf-8')
+
+
+def _orjson_dumps(data):
+    # values orjson does not know fall back to the Flask encoder
+    return orjson.dumps(data, default=JSONEncoder().default, option=ORJSON_OPTIONS)
+
+
+def _ujson_dumps(data):
+    return ujson.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')
+
+
+def get_backend(name):
+    """return (name, dumps) of a JSON backend, dumps returning bytes
+
+    'auto' picks the fastest installed encoder: orjson, ujson, then the
+    Flask encoder ('json'). the others sort keys like the Flask encoder.
+    """
+    backends = {'json': _stdlib_dumps}
+    if orjson is not None:
+        backends['orjson'] = _orjson_dumps
+    if ujson is not None:
+        backends['ujson'] = _ujson_dumps
+
+    if name == 'auto':
+        for candidate in ('orjson', 'ujson', 'json'):
+            if candidate in backends:
+                return candidate, backends[candidate]
+    if name not in backends:
+        raise ValueError('JSON backend {} is not available'.format(name))
+    return name, backends[name]
+
+
+class ResponseSerializer:
+    """build JSON responses: encode to bytes, compress, stream long lists
+    """
+
+    def __init__(self, app=None):
+        self.backend, self.dumps = get_backend('json')
+        self.compress = False
+        self.compress_min_size = 1024
+        self.compress_level = 6
+        self.stream_threshold = 1000
+        self.chunk_size = 64 * 1024
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.backend, self.dumps = get_backend(config.get('JSON_BACKEND', 'auto'))
+        self.compress = config.get('RESPONSE_COMPRESSION', self.compress)
+        self.compress_min_size = config.get('RESPONSE_COMPRESS_MIN_SIZE', self.compress_min_size)
+        self.compress_level = config.get('RESPONSE_COMPRESS_LEVEL', self.compress_level)
+        self.stream_threshold = config.get('RESPONSE_STREAM_THRESHOLD', self.stream_threshold)
+        self.chunk_size = config.get('RESPONSE_STREAM_CHUNK_SIZE', self.chunk_size)
+
+    def encode(self, data):
+        """encode data as one JSON document followed by a newline
+        """
+        return self.dumps(data) + b'\n'
+
+    def _encoding(self, size=None):
+        """content coding accepted by the client, None for identity
+        """
+        if not self.compress or (size is not None and size < self.compress_min_size):
+            return None
+        return request.accept_encodings.best_match(('gzip', 'deflate'))
+
+    def _compress(self, body, encoding):
+        if encoding == 'gzip':
+            return gzip.compress(body, self.compress_level)
+        return zlib.compress(body, self.compress_level)
+
+    def _iter_list(self, items):
+        """encode a list slice by slice in chunks of about chunk_size bytes
+
+        each slice is encoded with one dumps call and its brackets are
+        stripped, so per-call overhead of the encoder is paid once per slice.
+        """
+        batch, start = 64, 0
+        yield b'['
+        while start < len(items):
+            encoded = self.dumps(items[start:start + batch])
+            yield (b',' if start else b'') + encoded[1:-1]
+            start += batch
+            # grow or shrink the slice so a chunk is about chunk_size bytes
+            batch = max(1, batch * self.chunk_size // len(encoded))
+        yield b']\n'
+
+    def _iter_compressed(self, chunks, encoding):
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, WBITS[encoding])
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def response(self, data, code=200):
+        """return the HTTP response of data
+        """
+        if isinstance(data, list) and len(data) >= self.stream_threshold:
+            chunks = self._iter_list(data)
+            encoding = self._encoding()
+            if encoding is not None:
+                chunks = self._iter_compressed(chunks, encoding)
+            response = Response(chunks, status=code)
+        else:
+            body = self.encode(data)
+            encoding = self._encoding(len(body))
+            if encoding is not None:
+                body = self._compress(body, encoding)
+            response = Response(body, status=code)
+
+        if self.compress:
+            response.headers['Vary'] = 'Accept-Encoding'
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+
+serializer = ResponseSerializer()
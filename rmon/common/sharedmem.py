@@ -0,0 +1,356 @@
+""" rmon.common.sharedmem
+per-server slots of a memory mapped file, one writer and many readers
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+MAGIC = b'RMONSLOT'
+VERSION = 1
+# magic, version, slots, payload size, ring capacity, columns length
+FILE_HEADER = struct.Struct('<8sIIIII')
+# heartbeat and lag of the writer
+WRITER_STATE = struct.Struct('<dd')
+WRITER_STATE_OFFSET = 32
+COLUMNS_OFFSET = 48
+HEADER_SIZE = 4096
+
+# sequence, server id, payload length, ring head, ring size
+SLOT_HEADER = struct.Struct('<QqIII')
+SLOT_HEADER_SIZE = 32
+SEQUENCE = struct.Struct('<Q')
+# effective probe interval of the server after the slot header, 0 when
+# unknown, written apart from the sequence
+SLOT_INTERVAL = struct.Struct('<f')
+SLOT_INTERVAL_OFFSET = SLOT_HEADER.size
+
+# reads retried while the writer keeps changing a slot
+READ_RETRIES = 100
+# seconds between checks of a reader for new slots or a new file
+RESCAN_INTERVAL = 1
+
+NAN = float('nan')
+
+
+class SlotFile:
+    """a payload and a ring of numeric rows for each server
+
+    the writer process owns the file, any number of reader processes map
+    it read-only. every slot is guarded by a sequence number which the
+    writer makes odd while it changes the slot, a reader retries until
+    it copied the slot between two reads of the same even number.
+    writes and releases of the writer threads take a lock, so two
+    threads never claim the same slot or interleave a sequence number.
+
+    a writer always starts with a new file renamed over the previous
+    one, readers notice the new inode and map it again.
+
+    the probe interval of each server is published next to its slot
+    header without changing the sequence, so readers do not decode a
+    sample again whenever the schedule of its server changes.
+    """
+
+    def __init__(self, path, writer=False, slots=1024, payload_size=16384, capacity=360,
+                 columns=()):
+        self.path = path
+        self.writer = writer
+        self.slots = slots
+        self.payload_size = payload_size
+        self.capacity = capacity
+        self.columns = tuple(columns)
+        # incremented whenever another file is mapped
+        self.generation = 0
+
+        self._mm = None
+        self._inode = None
+        self._index = {}
+        self._free = []
+        self._next = 0
+        self._checked = 0
+        self._lock = threading.Lock()
+
+        if writer:
+            self._create()
+        else:
+            self._open()
+
+    @property
+    def ready(self):
+        return self._mm is not None
+
+    def _layout(self):
+        self._row = struct.Struct('<{}d'.format(1 + len(self.columns)))
+        self._ring_offset = SLOT_HEADER_SIZE + self.payload_size
+        self.slot_size = self._ring_offset + self.capacity * self._row.size
+        self.size = HEADER_SIZE + self.slots * self.slot_size
+
+    def _create(self):
+        self._layout()
+        columns = json.dumps(self.columns).encode()
+        if COLUMNS_OFFSET + len(columns) > HEADER_SIZE:
+            raise ValueError('too many columns for the file header')
+
+        temporary = '{}.{}'.format(self.path, os.getpid())
+        with open(temporary, 'w+b') as f:
+            f.truncate(self.size)
+            mm = mmap.mmap(f.fileno(), self.size)
+        FILE_HEADER.pack_into(mm, 0, MAGIC, VERSION, self.slots, self.payload_size,
+                              self.capacity, len(columns))
+        mm[COLUMNS_OFFSET:COLUMNS_OFFSET + len(columns)] = columns
+        os.rename(temporary, self.path)
+
+        self._mm = mm
+        self._inode = os.stat(self.path).st_ino
+        self.generation += 1
+
+    def _open(self):
+        try:
+            with open(self.path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # no collector process has created the file yet
+            return
+        magic, version, slots, payload_size, capacity, length = FILE_HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            mm.close()
+            raise ValueError('{} is not a slot file'.format(self.path))
+
+        # a mapping still used by another thread is unmapped once released
+        self.slots, self.payload_size, self.capacity = slots, payload_size, capacity
+        self.columns = tuple(json.loads(mm[COLUMNS_OFFSET:COLUMNS_OFFSET + length].decode()))
+        self._layout()
+        self._mm = mm
+        self._inode = inode
+        self.generation += 1
+        self._scan()
+
+    def _check(self):
+        """map the file again if the writer replaced it, rescan the slots
+        """
+        now = time.time()
+        if self.writer or now - self._checked < RESCAN_INTERVAL:
+            return
+        self._checked = now
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return
+        if inode != self._inode:
+            self._open()
+        elif self._mm is not None:
+            self._scan()
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * self.slot_size
+
+    def _scan(self):
+        index = {}
+        for slot in range(self.slots):
+            server_id = SLOT_HEADER.unpack_from(self._mm, self._offset(slot))[1]
+            if server_id:
+                index[server_id] = slot
+        self._index = index
+
+    def _find(self, server_id):
+        """return (mapping, offset) of the slot of server_id or None
+        """
+        self._check()
+        mm = self._mm
+        slot = self._index.get(server_id)
+        if mm is None or slot is None:
+            return None
+        if SLOT_HEADER.unpack_from(mm, self._offset(slot))[1] != server_id:
+            # released and taken by another server since the last scan
+            self._scan()
+            slot = self._index.get(server_id)
+            if slot is None:
+                return None
+        return mm, self._offset(slot)
+
+    @staticmethod
+    def _consistent(mm, offset, copy):
+        """call copy() until no write to the slot overlapped it
+        """
+        for _ in range(READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(mm, offset)[0]
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            value = copy()
+            if SEQUENCE.unpack_from(mm, offset)[0] == sequence:
+                return sequence, value
+        return None
+
+    def write(self, server_id, payload, row=None):
+        """replace the payload of server_id and append a row to its ring
+
+        Args:
+            payload (bytes): at most payload_size bytes
+            row (tuple): timestamp followed by one value per column
+
+        Raises:
+            ValueError: the payload is too large or every slot is taken
+        """
+        if len(payload) > self.payload_size:
+            raise ValueError('payload of server {} is {} bytes, slots hold {}'.format(
+                server_id, len(payload), self.payload_size))
+        with self._lock:
+            slot = self._index.get(server_id)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                elif self._next < self.slots:
+                    slot = self._next
+                    self._next += 1
+                else:
+                    raise ValueError('no free slot for server {}'.format(server_id))
+                self._index[server_id] = slot
+
+            mm = self._mm
+            offset = self._offset(slot)
+            sequence, _, _, head, size = SLOT_HEADER.unpack_from(mm, offset)
+            SEQUENCE.pack_into(mm, offset, sequence + 1)
+
+            start = offset + SLOT_HEADER_SIZE
+            mm[start:start + len(payload)] = payload
+            if row is not None:
+                self._row.pack_into(mm, offset + self._ring_offset + head * self._row.size, *row)
+                head = (head + 1) % self.capacity
+                size = min(size + 1, self.capacity)
+
+            SLOT_HEADER.pack_into(mm, offset, sequence + 1, server_id, len(payload), head, size)
+            SEQUENCE.pack_into(mm, offset, sequence + 2)
+
+    def read(self, server_id):
+        """return (sequence, payload) of server_id or None
+        """
+        found = self._find(server_id)
+        if found is None:
+            return None
+        mm, offset = found
+
+        def copy():
+            length = SLOT_HEADER.unpack_from(mm, offset)[2]
+            start = offset + SLOT_HEADER_SIZE
+            return mm[start:start + length]
+
+        result = self._consistent(mm, offset, copy)
+        if result is None or not result[1]:
+            return None
+        return result
+
+    def range(self, server_id, start=None, end=None, names=None):
+        """rows of server_id with start <= timestamp <= end
+
+        Returns:
+            dict: same as TimeSeries.range
+        """
+        empty = {'timestamps': [], 'series': {}}
+        found = self._find(server_id)
+        if found is None:
+            return empty
+        mm, offset = found
+        ring = offset + self._ring_offset
+
+        def copy():
+            _, _, _, head, size = SLOT_HEADER.unpack_from(mm, offset)
+            rows = array('d')
+            rows.frombytes(mm[ring:ring + self.capacity * self._row.size])
+            return head, size, rows
+
+        result = self._consistent(mm, offset, copy)
+        if result is None:
+            return empty
+        head, size, rows = result[1]
+
+        width = 1 + len(self.columns)
+        if size < self.capacity:
+            order = range(size)
+        else:
+            order = [(head + index) % self.capacity for index in range(size)]
+        timestamps = [rows[index * width] for index in order]
+        lo = 0 if start is None else bisect_left(timestamps, start)
+        hi = len(timestamps) if end is None else bisect_right(timestamps, end)
+
+        selected = order[lo:hi]
+        series = {}
+        for column, name in enumerate(self.columns, 1):
+            if names is not None and name not in names:
+                continue
+            values = [rows[index * width + column] for index in selected]
+            series[name] = [value if value == value else None for value in values]
+        return {'timestamps': timestamps[lo:hi], 'series': series}
+
+    def release(self, server_id):
+        """free the slot of server_id
+        """
+        with self._lock:
+            slot = self._index.pop(server_id, None)
+            if slot is None:
+                return
+            mm = self._mm
+            offset = self._offset(slot)
+            sequence = SEQUENCE.unpack_from(mm, offset)[0]
+            SEQUENCE.pack_into(mm, offset, sequence + 1)
+            SLOT_HEADER.pack_into(mm, offset, sequence + 1, 0, 0, 0, 0)
+            SLOT_INTERVAL.pack_into(mm, offset + SLOT_INTERVAL_OFFSET, 0)
+            SEQUENCE.pack_into(mm, offset, sequence + 2)
+            self._free.append(slot)
+
+    def set_intervals(self, intervals):
+        """publish the probe interval of every server having a slot
+
+        Args:
+            intervals (dict): seconds by server id
+        """
+        with self._lock:
+            for server_id, slot in self._index.items():
+                SLOT_INTERVAL.pack_into(self._mm, self._offset(slot) + SLOT_INTERVAL_OFFSET,
+                                        intervals.get(server_id, 0))
+
+    def intervals(self):
+        """return the published probe intervals by server id
+        """
+        self._check()
+        mm = self._mm
+        if mm is None:
+            return {}
+        intervals = {}
+        for server_id, slot in self._index.items():
+            offset = self._offset(slot)
+            if SLOT_HEADER.unpack_from(mm, offset)[1] != server_id:
+                continue
+            interval = SLOT_INTERVAL.unpack_from(mm, offset + SLOT_INTERVAL_OFFSET)[0]
+            if interval > 0:
+                intervals[server_id] = interval
+        return intervals
+
+    def server_ids(self):
+        self._check()
+        return list(self._index)
+
+    def heartbeat(self, lag):
+        """record that the writer is alive and how far behind it is
+        """
+        WRITER_STATE.pack_into(self._mm, WRITER_STATE_OFFSET, time.time(), lag)
+
+    def writer_state(self):
+        """return (heartbeat, lag) of the writer, (0, 0) before it started
+        """
+        self._check()
+        if self._mm is None:
+            return 0, 0
+        return WRITER_STATE.unpack_from(self._mm, WRITER_STATE_OFFSET)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._index = {}
@@ -0,0 +1,88 @@
+""" rmon.common.sketches
+bounded memory heavy hitters and frequency estimates
+"""
+
+import hashlib
+from array import array
+
+
+class SpaceSaving:
+    """the heaviest keys of a weighted stream in `capacity` counters
+
+    when a new key arrives and every counter is taken, the lightest key
+    is evicted and the new one inherits its weight as `error`, so the
+    weight of a kept key is over-estimated by at most `error`.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, key, weight=1, **stats):
+        """add weight to key, return its item
+
+        stats are merged into the item: `count` and `total` are summed,
+        `max` keeps the largest value, anything else is replaced.
+        """
+        item = self.items.get(key)
+        if item is None:
+            error = 0
+            if len(self.items) >= self.capacity:
+                lightest = min(self.items, key=lambda k: self.items[k]['weight'])
+                error = self.items.pop(lightest)['weight']
+            item = self.items[key] = {'weight': error, 'error': error, 'count': 0,
+                                      'total': 0, 'max': 0}
+        item['weight'] += weight
+        for name, value in stats.items():
+            if name in ('count', 'total'):
+                item[name] += value
+            elif name == 'max':
+                item[name] = max(item[name], value)
+            else:
+                item[name] = value
+        return item
+
+    def top(self, limit):
+        """return [(key, item)] of the `limit` heaviest keys
+        """
+        items = sorted(self.items.items(), key=lambda pair: pair[1]['weight'], reverse=True)
+        return items[:limit]
+
+    def clear(self):
+        self.items.clear()
+
+
+class CountMinSketch:
+    """estimate the total weight of any key in width * depth counters
+
+    an estimate is never below the true total and exceeds it by more
+    than total weight * e / width with probability at most e ** -depth.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._rows = [array('d', [0]) * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8 * self.depth).digest()
+        for row in range(self.depth):
+            yield int.from_bytes(digest[row * 8:row * 8 + 8], 'little') % self.width
+
+    def add(self, key, weight=1):
+        self.total += weight
+        for row, index in zip(self._rows, self._indexes(key)):
+            row[index] += weight
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def clear(self):
+        self.total = 0
+        for row in self._rows:
+            for index in range(self.width):
+                row[index] = 0
@@ -0,0 +1,100 @@
+""" rmon.common.snapshot
+collect several commands of one server in a single pipeline
+"""
+
+import re
+from collections import Counter
+
+from redis import RedisError
+
+SECTION_PATTERN = re.compile(r'^[a-z_]+$')
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _slowlog(entries):
+    return [dict(entry, command=_decode(entry['command'])) for entry in entries]
+
+
+def _client_list(clients):
+    flags = Counter()
+    for client in clients:
+        for flag in client.get('flags', ''):
+            flags[flag] += 1
+    return {'total': len(clients), 'flags': dict(flags)}
+
+
+def _latency(events):
+    return [{'event': _decode(event), 'timestamp': timestamp, 'latest': latest, 'max': maximum}
+            for event, timestamp, latest, maximum in events]
+
+
+# snapshot item -> (queue the command on a pipeline, convert the reply)
+COMMANDS = {
+    'config': (lambda pipe: pipe.config_get('maxmemory*'), dict),
+    'dbsize': (lambda pipe: pipe.dbsize(), int),
+    'slowlog': (lambda pipe: pipe.slowlog_get(10), _slowlog),
+    'client_list': (lambda pipe: pipe.client_list(), _client_list),
+    'latency': (lambda pipe: pipe.execute_command('LATENCY', 'LATEST'), _latency),
+}
+
+
+def parse_sections(value):
+    """split a comma separated list of snapshot items
+
+    Raises:
+        ValueError: an item is neither a command nor an INFO section name
+    """
+    sections = [section.strip().lower() for section in value.split(',') if section.strip()]
+    for section in sections:
+        if not SECTION_PATTERN.match(section):
+            raise ValueError('invalid section {}'.format(section))
+    return sections
+
+
+def take_snapshot(client, sections):
+    """run the commands of sections in one pipeline
+
+    names found in COMMANDS run that command, any other name is an INFO
+    section. a failed command is reported as {'error': message} so one
+    unsupported command does not fail the whole snapshot.
+
+    Args:
+        client (StrictRedis): client of the server
+        sections (list): snapshot items
+
+    Returns:
+        dict: {'info': {section: {...}}, command: result, ...}
+    """
+    pipe = client.pipeline(transaction=False)
+    converters = []
+    for section in sections:
+        if section in COMMANDS:
+            queue, convert = COMMANDS[section]
+            queue(pipe)
+        else:
+            pipe.info(section)
+            convert = None
+        converters.append(convert)
+
+    replies = pipe.execute(raise_on_error=False)
+
+    snapshot = {'info': {}}
+    for section, convert, reply in zip(sections, converters, replies):
+        if isinstance(reply, RedisError):
+            result = {'error': str(reply)}
+        elif convert is None:
+            snapshot['info'][section] = reply
+            continue
+        else:
+            result = convert(reply)
+
+        if section in COMMANDS:
+            snapshot[section] = result
+        else:
+            snapshot['info'][section] = result
+    return snapshot
@@ -0,0 +1,92 @@
+""" rmon.common.timeseries
+fixed size in-memory time series
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+NAN = float('nan')
+
+
+class TimeSeries:
+    """ring buffer of samples sharing one timestamp column
+
+    every column is an array of doubles allocated once with `capacity`
+    slots, so memory per series never grows. a column missing from a
+    sample is stored as NaN and reported as None.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = self._column()
+        self.columns = {}
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _column(self):
+        return array('d', [NAN]) * self.capacity
+
+    def append(self, timestamp, values):
+        """append one sample
+
+        Args:
+            timestamp (float): unix time of the sample
+            values (dict): column name -> float
+        """
+        index = self.head
+        self.timestamps[index] = timestamp
+
+        for name, column in self.columns.items():
+            column[index] = values.get(name, NAN)
+
+        for name in values:
+            if name not in self.columns:
+                column = self.columns[name] = self._column()
+                column[index] = values[name]
+
+        self.head = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def _ordered(self, column):
+        """return column from the oldest to the newest sample
+        """
+        if self.size < self.capacity:
+            return column[:self.size]
+        return column[self.head:] + column[:self.head]
+
+    def last(self):
+        """return (timestamp, {name: value}) of the newest sample
+        """
+        if self.size == 0:
+            return None
+        index = (self.head - 1) % self.capacity
+        values = {name: column[index] for name, column in self.columns.items()
+                  if column[index] == column[index]}
+        return self.timestamps[index], values
+
+    def range(self, start=None, end=None, names=None):
+        """return samples with start <= timestamp <= end
+
+        Args:
+            start (float): lower bound, None means the oldest sample
+            end (float): upper bound, None means the newest sample
+            names (list): columns to return, None means all
+        """
+        timestamps = self._ordered(self.timestamps)
+        lo = 0 if start is None else bisect_left(timestamps, start)
+        hi = len(timestamps) if end is None else bisect_right(timestamps, end)
+
+        if names is None:
+            names = list(self.columns)
+
+        series = {}
+        for name in names:
+            column = self.columns.get(name)
+            if column is None:
+                continue
+            series[name] = [v if v == v else None for v in self._ordered(column)[lo:hi]]
+
+        return {'timestamps': timestamps[lo:hi].tolist(), 'series': series}
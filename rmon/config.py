@@ -7,9 +7,206 @@ class DevConfig:
     """
     DEBUG = True 
     SQLALCHEMY_TRACK_MODIFICATIONS = False 
-    SQLALCHEMY_DATABASE_URI = 'sqlite://'
     TEMPLATES_AUTO_RELOAD = True
 
+    # inventory database, any SQLAlchemy URL. the RMON_DATABASE_URL
+    # environment variable overrides it
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # connections pooled per process, an in-memory sqlite database always
+    # shares a single connection
+    SQLALCHEMY_POOL_SIZE = 5
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_TIMEOUT = 30
+    SQLALCHEMY_POOL_RECYCLE = 3600
+    # run on every new sqlite connection: WAL lets readers go on while a
+    # writer commits, busy_timeout (ms) makes writers wait for the lock
+    # instead of failing with "database is locked"
+    SQLITE_PRAGMAS = (('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+                      ('busy_timeout', 5000), ('foreign_keys', 'ON'))
+    # apply pending schema migrations when the app is created, otherwise
+    # run `flask upgrade_db` once before starting the API workers. debug
+    # apps always migrate
+    DATABASE_AUTO_MIGRATE = False
+
+    # JSON encoding of RestView responses, 'auto' uses orjson or ujson
+    # when installed and the Flask encoder otherwise
+    JSON_BACKEND = 'auto'
+    # gzip/deflate when the client accepts it and the body is large enough
+    RESPONSE_COMPRESSION = True
+    RESPONSE_COMPRESS_MIN_SIZE = 1024
+    RESPONSE_COMPRESS_LEVEL = 6
+    # lists at least this long are encoded and sent item by item
+    RESPONSE_STREAM_THRESHOLD = 1000
+    RESPONSE_STREAM_CHUNK_SIZE = 64 * 1024
+
+    # request, SQL and redis command metrics served by /metrics
+    INSTRUMENT_ENABLED = True
+    # sample thread stacks for /metrics/profile, costs a little CPU
+    PROFILER_ENABLED = False
+    PROFILER_INTERVAL = 0.01
+    PROFILER_MAX_STACKS = 10000
+
+    # pooled redis clients, one bounded pool per server
+    REDIS_POOL_MAX_CONNECTIONS = 8
+    REDIS_POOL_TIMEOUT = 5
+    REDIS_POOL_IDLE_TIMEOUT = 300
+    REDIS_SOCKET_TIMEOUT = 5
+    REDIS_SOCKET_CONNECT_TIMEOUT = 3
+
+    # read-through cache of rows looked up by ObjectMustExist, always off
+    # with SHARED_STORE_PATH as workers cannot invalidate each other's
+    OBJECT_CACHE_ENABLED = True
+    OBJECT_CACHE_SIZE = 1024
+    OBJECT_CACHE_TTL = 30
+
+    # pagination of GET /servers
+    SERVER_LIST_PAGE_SIZE = 100
+    SERVER_LIST_MAX_PAGE_SIZE = 1000
+
+    # bulk import of /servers/bulk and `flask import_servers`
+    BULK_MAX_ITEMS = 10000
+    BULK_PING_DEADLINE = 60
+
+    # engine used by Server.ping and Server.get_metrics, 'sync' uses the
+    # pooled redis-py clients, 'async' multiplexes probes on one event loop
+    PROBE_ENGINE = 'sync'
+    ASYNC_PROBE_CONCURRENCY = 1000
+    ASYNC_PROBE_CONNECT_TIMEOUT = 3
+    ASYNC_PROBE_READ_TIMEOUT = 5
+    ASYNC_PROBE_BACKOFF_BASE = 1
+    ASYNC_PROBE_BACKOFF_MAX = 60
+    ASYNC_PROBE_MAX_IDLE = 2
+
+    # fan-out health check of /servers/health
+    HEALTH_CHECK_TIMEOUT = 2
+    HEALTH_CHECK_DEADLINE = 10
+    HEALTH_CHECK_WORKERS = 32
+
+    # default items of /servers/<id>/metrics?sections=, INFO section names
+    # or commands from rmon.common.snapshot.COMMANDS
+    SNAPSHOT_SECTIONS = ('server', 'clients', 'memory', 'stats', 'replication', 'keyspace',
+                         'config', 'dbsize', 'slowlog', 'client_list', 'latency')
+
+    # background metrics collector
+    COLLECTOR_ENABLED = False
+    COLLECTOR_INTERVAL = 5
+    COLLECTOR_WORKERS = 8
+    # samples kept per server, 360 * 5s = 30 minutes
+    COLLECTOR_HISTORY_SIZE = 360
+    # numeric INFO fields kept in history, None keeps all of them
+    COLLECTOR_SERIES = (
+        'used_memory', 'used_memory_rss', 'mem_fragmentation_ratio',
+        'connected_clients', 'blocked_clients', 'instantaneous_ops_per_sec',
+        'instantaneous_input_kbps', 'instantaneous_output_kbps',
+        'total_commands_processed', 'total_connections_received',
+        'keyspace_hits', 'keyspace_misses', 'expired_keys', 'evicted_keys',
+        'total_net_input_bytes', 'total_net_output_bytes',
+        'used_cpu_sys', 'used_cpu_user', 'uptime_in_seconds',
+    )
+
+    # per-server probe schedule, a server's probe_interval overrides
+    # COLLECTOR_INTERVAL. delays are jittered by +-JITTER, failing servers
+    # back off exponentially up to BACKOFF_MAX seconds and a server whose
+    # INFO reaches one of THRESHOLDS is probed every boost_interval seconds
+    # (interval * BOOST_FACTOR, at least MIN_INTERVAL, when unset)
+    SCHEDULER_JITTER = 0.1
+    SCHEDULER_BACKOFF_MAX = 300
+    SCHEDULER_BOOST_FACTOR = 0.2
+    SCHEDULER_MIN_INTERVAL = 1
+    SCHEDULER_THRESHOLDS = {'blocked_clients': 1, 'mem_fragmentation_ratio': 3}
+    # seconds between reloads of the server list and between due checks
+    SCHEDULER_SYNC_INTERVAL = 30
+    SCHEDULER_TICK = 0.05
+
+    # commands of /servers/<id>/command, all of them must finish within
+    # TIMEOUT seconds. collections are read PAGE_SIZE items at a time and
+    # at most MAX_ITEMS items or MAX_BYTES bytes are returned per request
+    COMMAND_ADMIN_ENABLED = False
+    COMMAND_MAX_BATCH = 20
+    COMMAND_TIMEOUT = 10
+    COMMAND_MAX_BYTES = 4 << 20
+    COMMAND_MAX_ITEMS = 100000
+    COMMAND_PAGE_SIZE = 500
+
+    # multi-process mode: a collector process started by `flask
+    # run_collector` probes every server and shares the samples through
+    # this memory mapped file, API workers only read it. None keeps
+    # collecting in the API process. a slot holds the JSON of one sample
+    # in SLOT_SIZE bytes plus COLLECTOR_HISTORY_SIZE rows of COLLECTOR_SERIES.
+    # the alerts of the collector process are shared in PATH.alerts
+    SHARED_STORE_PATH = None
+    SHARED_STORE_SLOTS = 1024
+    SHARED_STORE_SLOT_SIZE = 16384
+
+    # alert rules evaluated on every collected sample, rules changed by
+    # another process are loaded after RELOAD_INTERVAL seconds. firing and
+    # resolved events go to SINKS: 'log', 'file' (one JSON line per event
+    # appended to ALERT_FILE) and 'webhook' (POST to ALERT_WEBHOOK_URL)
+    ALERT_SINKS = ('log',)
+    ALERT_FILE = None
+    ALERT_WEBHOOK_URL = None
+    ALERT_WEBHOOK_TIMEOUT = 5
+    ALERT_RELOAD_INTERVAL = 30
+
+    # persistent history of collected samples with 1m and 1h rollups
+    HISTORY_ENABLED = True
+    HISTORY_DATABASE = ':memory:'
+    # numeric INFO fields kept, None keeps all of them
+    HISTORY_METRICS = COLLECTOR_SERIES
+    HISTORY_FLUSH_INTERVAL = 10
+    # retention in seconds of raw samples, 1m and 1h rollups
+    HISTORY_RAW_RETENTION = 86400
+    HISTORY_MINUTE_RETENTION = 30 * 86400
+    HISTORY_HOUR_RETENTION = 365 * 86400
+    # bound of (to - from) / step of /servers/<id>/metrics/history
+    HISTORY_MAX_POINTS = 10000
+
+    # fields of one /servers/aggregate request
+    AGGREGATE_MAX_FIELDS = 50
+
+    # Prometheus export of the latest samples by /servers/metrics, None
+    # exports every numeric INFO field; samples older than STALE_AFTER
+    # seconds (3 effective probe intervals of the server when None) report
+    # redis_up 0
+    FLEET_EXPORT_METRICS = None
+    FLEET_EXPORT_STALE_AFTER = None
+
+    # cluster / replication topology of /servers/<id>/topology, nodes are
+    # discovered again after REFRESH_INTERVAL seconds or when INFO shows
+    # a changed role or replica set. a registered replica is only probed
+    # every REPLICA_PROBE_EVERY times it is due while its master has a
+    # sample younger than the master's interval
+    TOPOLOGY_REFRESH_INTERVAL = 300
+    TOPOLOGY_REPLICA_PROBE_EVERY = 6
+
+    # slow command templates of /servers/<id>/slowlog and /servers/slowlog,
+    # a server's slowlog is fetched again after FETCH_INTERVAL seconds and
+    # at most MAX_FETCH new entries are transferred at once. CAPACITY and
+    # FLEET_CAPACITY bound the templates kept per server and in total
+    SLOWLOG_FETCH_INTERVAL = 60
+    SLOWLOG_MAX_FETCH = 128
+    SLOWLOG_CAPACITY = 64
+    SLOWLOG_FLEET_CAPACITY = 256
+
+    # server-sent events of /servers/<id>/metrics/stream
+    STREAM_QUEUE_SIZE = 16
+    STREAM_HEARTBEAT = 15
+    # seconds before a stream is closed, 0 keeps it open
+    STREAM_MAX_DURATION = 3600
+
+    # SCAN based keyspace analysis of /servers/<id>/keyspace, a job asks
+    # for at most MAX_SCAN_COUNT keys per SCAN
+    KEYSPACE_SCAN_COUNT = 500
+    KEYSPACE_MAX_SCAN_COUNT = 5000
+    # fraction of scanned keys inspected with TYPE, TTL and MEMORY USAGE
+    KEYSPACE_SAMPLE_RATE = 0.1
+    # commands per second as a fraction of the server's own ops per second
+    KEYSPACE_OPS_FRACTION = 0.05
+    KEYSPACE_MIN_RATE = 200
+    # bound of the pattern prefix tree
+    KEYSPACE_MAX_NODES = 10000
+    KEYSPACE_MAX_DEPTH = 4
+
 
 class ProductConfig(DevConfig):
     """
@@ -17,6 +214,13 @@ class ProductConfig(DevConfig):
     """
     DEBUG = False
 
+    COLLECTOR_ENABLED = True
+
+    # sqlite files are kept in RMON_DATA_DIR, the working directory when unset
+    data_dir = os.environ.get('RMON_DATA_DIR') or os.getcwd()
+
     # path for sqlite db 
-    path = os.path.join(os.getcwd(), 'rmon.db').replace('\\', '/')
+    path = os.path.join(data_dir, 'rmon.db').replace('\\', '/')
     SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(path)
+
+    HISTORY_DATABASE = os.path.join(data_dir, 'rmon-history.db')
@@ -0,0 +1,351 @@
+""" rmon.console
+whitelisted redis commands run for operators with bounded replies
+"""
+
+import socket
+import time
+
+from redis import RedisError, TimeoutError as RedisTimeoutError
+
+from rmon.common.clients import clients, observe_command
+from rmon.common.rest import RestException
+from rmon.slowlog import SUBCOMMANDS
+
+# commands with small replies, run as they are
+READ_COMMANDS = {
+    'DBSIZE', 'EXISTS', 'HEXISTS', 'HLEN', 'HSTRLEN', 'INFO', 'LASTSAVE', 'LINDEX', 'LLEN',
+    'PING', 'PTTL', 'ROLE', 'SCARD', 'SISMEMBER', 'TIME', 'TTL', 'TYPE', 'XLEN', 'ZCARD',
+    'ZCOUNT', 'ZRANK', 'ZREVRANK', 'ZSCORE', 'STRLEN',
+    'CLIENT GETNAME', 'CLIENT LIST', 'CLUSTER INFO', 'CLUSTER NODES', 'CONFIG GET',
+    'LATENCY HISTORY', 'LATENCY LATEST', 'MEMORY STATS', 'MEMORY USAGE', 'OBJECT ENCODING',
+    'OBJECT FREQ', 'OBJECT IDLETIME', 'OBJECT REFCOUNT', 'SLOWLOG GET', 'SLOWLOG LEN',
+}
+# commands whose reply is the size of a value, checked against the cap first
+SIZED_COMMANDS = {'GET': 'STRLEN', 'HGET': 'HSTRLEN'}
+# commands changing the server, only run with COMMAND_ADMIN_ENABLED
+ADMIN_COMMANDS = {
+    'BGREWRITEAOF', 'BGSAVE', 'CLIENT KILL', 'CONFIG RESETSTAT', 'CONFIG SET',
+    'LATENCY RESET', 'MEMORY PURGE', 'SLOWLOG RESET',
+}
+# commands replying a whole collection, run page by page
+PAGED_COMMANDS = {'SCAN', 'HSCAN', 'SSCAN', 'ZSCAN', 'HGETALL', 'HKEYS', 'HVALS', 'SMEMBERS',
+                  'LRANGE', 'ZRANGE'}
+
+
+def command_name(args):
+    """`CONFIG SET` for ['config', 'set', ...], `GET` for ['get', ...]
+    """
+    name = str(args[0]).upper()
+    if name in SUBCOMMANDS and len(args) > 1:
+        return '{} {}'.format(name, str(args[1]).upper())
+    return name
+
+
+def parse_commands(data, admin=False, max_batch=20):
+    """validate `{"command": [...]}` or `{"commands": [[...], ...]}`
+
+    Returns:
+        list: (name, args) of every command
+
+    Raises:
+        RestException: a command is malformed or not allowed
+    """
+    if not isinstance(data, dict):
+        raise RestException(400, 'invalid command')
+    commands = data.get('commands')
+    if commands is None:
+        commands = [data.get('command')]
+    if not isinstance(commands, list) or not commands:
+        raise RestException(400, 'invalid command')
+    if len(commands) > max_batch:
+        raise RestException(400, 'at most {} commands per request'.format(max_batch))
+
+    parsed = []
+    for args in commands:
+        if not isinstance(args, list) or not args or \
+                not all(isinstance(arg, (str, int, float)) and not isinstance(arg, bool)
+                        for arg in args):
+            raise RestException(400, 'a command is a list of strings and numbers')
+        name = command_name(args)
+        if name in ADMIN_COMMANDS and not admin:
+            raise RestException(403, 'admin command {} is disabled'.format(name))
+        if name not in READ_COMMANDS and name not in SIZED_COMMANDS and \
+                name not in ADMIN_COMMANDS and name not in PAGED_COMMANDS:
+            raise RestException(403, 'command {} is not allowed'.format(name))
+        parsed.append((name, [str(arg) for arg in args]))
+    return parsed
+
+
+def _decode(reply):
+    if isinstance(reply, bytes):
+        return reply.decode('utf-8', 'backslashreplace')
+    if isinstance(reply, list):
+        return [_decode(item) for item in reply]
+    if isinstance(reply, RedisError):
+        return str(reply)
+    return reply
+
+
+def _pairs(items):
+    return [items[index:index + 2] for index in range(0, len(items), 2)]
+
+
+def _size(reply):
+    """approximate JSON size of a decoded reply
+    """
+    if isinstance(reply, list):
+        return 2 + sum(_size(item) + 1 for item in reply)
+    if isinstance(reply, str):
+        return len(reply) + 2
+    return 8
+
+
+class Timeout(Exception):
+    """the deadline of the request has passed
+    """
+
+
+class CommandSession:
+    """run commands on one connection of the server's pool
+
+    every read waits at most until the deadline of the request. collection
+    replies are fetched `page_size` items at a time with SCAN cursors or
+    index ranges, so no reply larger than a page is ever held, and stop
+    once `max_items` items or `max_bytes` bytes were streamed, a COUNT
+    given to SCAN is lowered to `page_size` too. HGETALL,
+    HKEYS and HVALS use HSCAN and SMEMBERS uses SSCAN, which may repeat
+    an item while the collection is rehashed.
+    """
+
+    def __init__(self, server, timeout=5, max_bytes=4 << 20, max_items=100000, page_size=500):
+        self.server = server
+        self.deadline = time.time() + timeout
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.page_size = page_size
+        self.sent = 0
+        self.address = '{}:{}'.format(server.host, server.port or 6379)
+
+        self._pool = None
+        self._connection = None
+
+    def open(self):
+        """take a connection from the pool of the server
+        """
+        try:
+            self._pool = clients.get(self.server).connection_pool
+            self._connection = self._pool.get_connection('COMMAND')
+            self._connection.connect()
+        except RedisError:
+            if self._connection is not None:
+                self._pool.release(self._connection)
+                self._connection = None
+            raise RestException(400, 'cannot connect to redis server {}'.format(self.server.host))
+
+    def close(self, failed=False):
+        """give the connection back to the pool
+        """
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if failed or connection._sock is None:
+            # a reply may still be pending on the socket
+            connection.disconnect()
+        else:
+            connection._sock.settimeout(connection.socket_timeout)
+        self._pool.release(connection)
+
+    def __enter__(self):
+        if self._connection is None:
+            self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close(exc_info[0] is not None)
+
+    def call(self, *args):
+        """send one command and read its raw reply before the deadline
+        """
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise Timeout()
+        connection = self._connection
+        started = time.perf_counter()
+        failed = True
+        try:
+            if connection._sock is None:
+                connection.connect()
+            connection._sock.settimeout(remaining)
+            connection.send_command(*args)
+            reply = connection.read_response()
+            failed = False
+            return reply
+        except (socket.timeout, RedisTimeoutError):
+            raise Timeout()
+        finally:
+            if clients.instrument:
+                observe_command(args[0].upper(), self.address, time.perf_counter() - started,
+                                failed)
+
+    def run(self, commands):
+        """run commands in order
+
+        Yields:
+            dict: result lines, `items` chunks of paged commands followed
+            by their `done` line, then a `summary`
+        """
+        started = time.time()
+        errors = 0
+        truncated = False
+        for index, (name, args) in enumerate(commands):
+            try:
+                if name in PAGED_COMMANDS:
+                    for line in self._paged(name, args):
+                        line['index'] = index
+                        truncated = truncated or line.get('truncated', False)
+                        yield line
+                else:
+                    yield {'index': index, 'command': name, 'result': self._single(name, args)}
+            except Timeout:
+                errors += 1
+                yield {'index': index, 'command': name, 'error': 'timeout'}
+                # the connection cannot be reused with a reply in flight
+                self._connection.disconnect()
+                break
+            except RestException as e:
+                errors += 1
+                yield {'index': index, 'command': name, 'error': e.message}
+            except RedisError as e:
+                errors += 1
+                yield {'index': index, 'command': name, 'error': str(e)}
+            if self.sent >= self.max_bytes:
+                truncated = True
+                break
+
+        yield {'summary': {'commands': len(commands), 'errors': errors, 'truncated': truncated,
+                           'bytes': self.sent,
+                           'elapsed': round((time.time() - started) * 1000, 3)}}
+
+    def _single(self, name, args):
+        size_command = SIZED_COMMANDS.get(name)
+        if size_command is not None:
+            size = self.call(size_command, *args[1:3])
+            if size > self.max_bytes - self.sent:
+                raise RestException(413, 'value of {} bytes exceeds the reply cap'.format(size))
+        reply = _decode(self.call(*args))
+        self.sent += _size(reply)
+        return reply
+
+    def _paged(self, name, args):
+        """yield the item chunks of a collection command and a done line
+        """
+        count = 0
+        line = {'command': name, 'done': True, 'truncated': False}
+        for items, position in self._pages(name, args):
+            items = _decode(items)
+            size = _size(items)
+            if count + len(items) > self.max_items or self.sent + size > self.max_bytes:
+                if not count and (len(items) > self.max_items or size > self.max_bytes):
+                    # the page would not fit a request of its own either,
+                    # resuming from its start would never progress
+                    items, size = self._split(name, items, position)
+                    if items:
+                        count = len(items)
+                        self.sent += size
+                        position += count
+                        yield {'command': name, 'items': items}
+                # the SCAN cursor or range start to resume from
+                line.update(truncated=True, cursor=position)
+                break
+            count += len(items)
+            self.sent += size
+            yield {'command': name, 'items': items}
+        line['count'] = count
+        yield line
+
+    def _split(self, name, items, position):
+        """return the leading items of a page within the caps and their size
+
+        Raises:
+            RestException: the page is one of SCAN, which cannot resume in
+                the middle of a page, or its first item alone is too large
+        """
+        if not isinstance(position, int):
+            raise RestException(413, 'a page of {} items at cursor {} exceeds the reply cap, '
+                                     'lower COUNT'.format(len(items), position))
+        kept, size = [], 2
+        for item in items[:self.max_items]:
+            item_size = _size(item) + 1
+            if self.sent + size + item_size > self.max_bytes:
+                break
+            kept.append(item)
+            size += item_size
+        if not kept and not self.sent:
+            raise RestException(413, 'item {} exceeds the reply cap'.format(position))
+        return kept, size
+
+    def _pages(self, name, args):
+        """yield (items, cursor or index the page was read from) per page
+        """
+        page = str(self.page_size)
+        if name in ('SCAN', 'HSCAN', 'SSCAN', 'ZSCAN'):
+            position = 1 if name == 'SCAN' else 2
+            if len(args) <= position:
+                raise RestException(400, '{} needs a cursor'.format(name))
+            head, cursor, options = args[:position], args[position], args[position + 1:]
+            for index in range(0, len(options) - 1, 2):
+                if options[index].upper() == 'COUNT':
+                    # a page is never larger than asked for by page_size
+                    try:
+                        count = int(options[index + 1])
+                    except ValueError:
+                        raise RestException(400, 'invalid {} COUNT'.format(name))
+                    options[index + 1] = str(min(max(count, 1), self.page_size))
+                    break
+            else:
+                options = options + ['COUNT', page]
+            while True:
+                position = cursor
+                cursor, items = self.call(*(head + [cursor] + options))
+                cursor = cursor.decode()
+                yield (_pairs(items) if name in ('HSCAN', 'ZSCAN') else items), position
+                if cursor == '0':
+                    return
+
+        elif name in ('HGETALL', 'HKEYS', 'HVALS', 'SMEMBERS'):
+            if len(args) != 2:
+                raise RestException(400, '{} takes one key'.format(name))
+            scan = 'SSCAN' if name == 'SMEMBERS' else 'HSCAN'
+            cursor = '0'
+            while True:
+                position = cursor
+                cursor, items = self.call(scan, args[1], cursor, 'COUNT', page)
+                cursor = cursor.decode()
+                if name == 'HGETALL':
+                    items = _pairs(items)
+                elif name == 'HKEYS':
+                    items = items[::2]
+                elif name == 'HVALS':
+                    items = items[1::2]
+                yield items, position
+                if cursor == '0':
+                    return
+
+        else:
+            # LRANGE / ZRANGE key start stop [WITHSCORES]
+            if len(args) not in (4, 5) or len(args) == 5 and name != 'ZRANGE':
+                raise RestException(400, 'invalid {} arguments'.format(name))
+            try:
+                start, stop = int(args[2]), int(args[3])
+            except ValueError:
+                raise RestException(400, 'invalid {} range'.format(name))
+            length = self.call('LLEN' if name == 'LRANGE' else 'ZCARD', args[1])
+            start = max(0, start + length if start < 0 else start)
+            stop = min(length - 1, stop + length if stop < 0 else stop)
+            while start <= stop:
+                end = min(stop, start + self.page_size - 1)
+                items = self.call(name, args[1], start, end, *args[4:])
+                if len(args) == 5:
+                    items = _pairs(items)
+                yield items, start
+                start = end + 1
@@ -0,0 +1,165 @@
+""" rmon.exporter
+Prometheus exposition of the collected INFO samples of every server
+"""
+
+import re
+import threading
+import time
+
+from rmon.collector import collector
+from rmon.common.metrics import format_labels, format_value
+from rmon.common.rates import COUNTERS
+
+INVALID_CHARACTERS = re.compile(r'[^a-zA-Z0-9_]')
+DB_FIELD = re.compile(r'^(db\d+)\.(\w+)$')
+
+LABELS = ('name', 'host', 'port')
+# string INFO fields exported as labels of redis_instance_info
+INFO_LABELS = (('redis_version', 'version'), ('redis_mode', 'mode'), ('role', 'role'))
+
+
+def family_of(field):
+    """return (family, extra label, type) of a flattened INFO field
+
+    `db0.keys` -> ('redis_db_keys', ('db', 'db0'), 'gauge'), monotonic
+    counters get the `_total` suffix.
+    """
+    match = DB_FIELD.match(field)
+    if match is not None:
+        return 'redis_db_' + match.group(2), ('db', match.group(1)), 'gauge'
+    family = 'redis_' + INVALID_CHARACTERS.sub('_', field)
+    if field in COUNTERS:
+        return family + '_total', None, 'counter'
+    return family, None, 'gauge'
+
+
+class FleetExporter:
+    """render the latest sample of every server without contacting redis
+
+    the lines of a server are only formatted again when its sample or
+    its labels changed since the previous scrape, a scrape otherwise
+    only joins cached strings.
+    """
+
+    def __init__(self, collector, app=None):
+        self.collector = collector
+        self.metrics = None
+        self.stale_after = None
+
+        self._fields = {}
+        self._kinds = {'redis_instance_info': 'gauge'}
+        self._servers = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.metrics = config.get('FLEET_EXPORT_METRICS', self.metrics)
+        self.stale_after = config.get('FLEET_EXPORT_STALE_AFTER', self.stale_after)
+        with self._lock:
+            self._servers.clear()
+
+    def _family(self, field):
+        family = self._fields.get(field)
+        if family is None:
+            family = self._fields[field] = family_of(field)
+            self._kinds[family[0]] = family[2]
+        return family
+
+    def _render_server(self, values, labels, info):
+        """return [(family, line)] of one INFO reply
+        """
+        lines = []
+        base = labels[:-1]
+        for key, value in info.items():
+            if isinstance(value, dict):
+                fields = [('{}.{}'.format(key, sub_key), sub_value)
+                          for sub_key, sub_value in value.items()]
+            else:
+                fields = [(key, value)]
+            for field, value in fields:
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if self.metrics is not None and field not in self.metrics:
+                    continue
+                family, extra, _ = self._family(field)
+                label = labels if extra is None else '{},{}="{}"}}'.format(base, *extra)
+                lines.append((family, '{}{} {}'.format(family, label, format_value(float(value)))))
+
+        fields = [(name, info[field]) for field, name in INFO_LABELS if field in info]
+        lines.append(('redis_instance_info', 'redis_instance_info{} 1'.format(format_labels(
+            LABELS + tuple(name for name, _ in fields), values + tuple(v for _, v in fields)))))
+        return lines
+
+    def render(self, servers, openmetrics=False):
+        """return the exposition text of servers
+
+        Args:
+            servers (list): (id, name, host, port) of the servers to export
+            openmetrics (bool): OpenMetrics instead of the Prometheus format
+        """
+        now = time.time()
+        # 3 effective intervals of each server, see Collector.effective_intervals
+        intervals = {} if self.stale_after else self.collector.effective_intervals()
+        families = {}
+        up, age = [], []
+
+        with self._lock:
+            cache, self._servers = self._servers, {}
+            for server_id, name, host, port in servers:
+                values = (name, host, port or 6379)
+                entry = cache.get(server_id)
+                if entry is None or entry[1] != values:
+                    entry = (None, values, format_labels(LABELS, values), None)
+                labels = entry[2]
+
+                sample = self.collector.store.latest(server_id)
+                if sample is None:
+                    up.append('redis_up{} 0'.format(labels))
+                    continue
+
+                timestamp, info = sample
+                if entry[0] != timestamp:
+                    entry = (timestamp, values, labels, self._render_server(values, labels, info))
+                self._servers[server_id] = entry
+
+                stale_after = self.stale_after or \
+                    3 * intervals.get(server_id, self.collector.interval)
+                up.append('redis_up{} {}'.format(labels, int(now - timestamp < stale_after)))
+                age.append('redis_sample_age_seconds{} {:.3f}'.format(labels, now - timestamp))
+                for family, line in entry[3]:
+                    lines = families.get(family)
+                    if lines is None:
+                        lines = families[family] = []
+                    lines.append(line)
+
+        chunks = [self._header('redis_up', 'gauge', 'Whether a recent sample of the server exists.',
+                               openmetrics), up,
+                  self._header('redis_sample_age_seconds', 'gauge', 'Age of the latest sample.',
+                               openmetrics), age]
+        for family in sorted(families):
+            kind = self._kinds[family]
+            if family == 'redis_instance_info':
+                documentation = 'Version and role of the server.'
+            elif kind == 'counter':
+                documentation = 'INFO counter {}.'.format(family[6:-6])
+            else:
+                documentation = 'INFO field {}.'.format(family[6:])
+            chunks.append(self._header(family, kind, documentation, openmetrics))
+            chunks.append(families[family])
+        if openmetrics:
+            chunks.append(['# EOF'])
+        return '\n'.join('\n'.join(chunk) for chunk in chunks if chunk) + '\n'
+
+    @staticmethod
+    def _header(family, kind, documentation, openmetrics):
+        # OpenMetrics names a counter family without its _total suffix
+        if openmetrics and kind == 'counter':
+            family = family[:-6]
+        return ['# HELP {} {}'.format(family, documentation),
+                '# TYPE {} {}'.format(family, kind)]
+
+
+exporter = FleetExporter(collector)
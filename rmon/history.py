@@ -0,0 +1,270 @@
+""" rmon.history
+persistent metrics history in sqlite with raw, 1m and 1h rollups
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from rmon.collector import collector, flatten_info
+from rmon.models import discards
+
+logger = logging.getLogger(__name__)
+
+# resolution in seconds -> retention setting of the config
+RESOLUTIONS = (0, 60, 3600)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS metric ('
+    ' id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+    # value is the average of the bucket, raw rows have count 1
+    'CREATE TABLE IF NOT EXISTS sample ('
+    ' server_id INTEGER NOT NULL, metric_id INTEGER NOT NULL,'
+    ' resolution INTEGER NOT NULL, ts INTEGER NOT NULL,'
+    ' value REAL NOT NULL, vmin REAL NOT NULL, vmax REAL NOT NULL, count INTEGER NOT NULL,'
+    ' PRIMARY KEY (server_id, metric_id, resolution, ts)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS rollup ('
+    ' resolution INTEGER PRIMARY KEY, done INTEGER NOT NULL)',
+)
+
+
+class HistoryStore:
+    """append-only samples, rolled up into coarser resolutions
+
+    samples are buffered in memory and written with one executemany per
+    flush in WAL mode. each flush aggregates the finished 1m buckets of
+    raw samples and the finished 1h buckets of 1m samples, then deletes
+    rows older than their retention. a sample buffered late into a bucket
+    which was rolled up already makes the flush aggregate it again.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.path = ':memory:'
+        self.metrics = None
+        self.flush_interval = 10
+        self.retention = {0: 86400, 60: 30 * 86400, 3600: 365 * 86400}
+
+        self._db = None
+        self._metric_ids = {}
+        self._buffer = []
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.close()
+        self.enabled = config.get('HISTORY_ENABLED', self.enabled)
+        self.path = config.get('HISTORY_DATABASE', self.path)
+        self.metrics = config.get('HISTORY_METRICS', self.metrics)
+        self.flush_interval = config.get('HISTORY_FLUSH_INTERVAL', self.flush_interval)
+        self.retention = {
+            0: config.get('HISTORY_RAW_RETENTION', self.retention[0]),
+            60: config.get('HISTORY_MINUTE_RETENTION', self.retention[60]),
+            3600: config.get('HISTORY_HOUR_RETENTION', self.retention[3600]),
+        }
+
+    @property
+    def db(self):
+        if self._db is None:
+            if self.path != ':memory:':
+                directory = os.path.dirname(os.path.abspath(self.path))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('PRAGMA busy_timeout=5000')
+            for statement in SCHEMA:
+                db.execute(statement)
+            self._db = db
+            self._metric_ids = dict((name, id_) for id_, name in db.execute(
+                'SELECT id, name FROM metric'))
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self.flush()
+                self._db.close()
+                self._db = None
+
+    def _metric_id(self, name):
+        metric_id = self._metric_ids.get(name)
+        if metric_id is None:
+            self.db.execute('INSERT OR IGNORE INTO metric (name) VALUES (?)', (name,))
+            metric_id = self.db.execute('SELECT id FROM metric WHERE name = ?',
+                                        (name,)).fetchone()[0]
+            self._metric_ids[name] = metric_id
+        return metric_id
+
+    def on_sample(self, server_id, timestamp, info):
+        """collector listener, keep the numeric fields of every sample
+        """
+        if self.enabled:
+            self.append(server_id, timestamp, flatten_info(info))
+
+    def names(self):
+        """names of every metric stored so far
+        """
+        with self._lock:
+            self.flush()
+            self.db
+            return sorted(self._metric_ids)
+
+    def append(self, server_id, timestamp, values):
+        """buffer a sample, flushing when flush_interval has passed
+
+        Args:
+            values (dict): metric name -> float
+        """
+        if self.metrics is not None:
+            values = {name: values[name] for name in self.metrics if name in values}
+        with self._lock:
+            self._buffer.append((server_id, int(timestamp), values))
+            if time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """write buffered samples in one transaction, then roll up
+        """
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+            self._last_flush = time.time()
+            if not buffer:
+                return
+
+            db = self.db
+            rows = []
+            for server_id, ts, values in buffer:
+                for name, value in values.items():
+                    rows.append((server_id, self._metric_id(name), ts, value, value, value))
+            db.execute('BEGIN')
+            try:
+                db.executemany('INSERT OR REPLACE INTO sample VALUES (?, ?, 0, ?, ?, ?, ?, 1)', rows)
+                since = self._rollup(60, 0, self._last_flush, min(ts for _, ts, _ in buffer))
+                self._rollup(3600, 60, self._last_flush, since)
+                self._expire(self._last_flush)
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    def _rollup(self, resolution, source, now, since=None):
+        """aggregate finished buckets of source resolution
+
+        a bucket is aggregated from every source row it holds, so one
+        rolled up before is aggregated again from `since`, the oldest
+        source row written since, unless its rows have expired.
+
+        Returns:
+            int: start of the aggregated buckets, None if none was
+        """
+        row = self.db.execute('SELECT done FROM rollup WHERE resolution = ?',
+                              (resolution,)).fetchone()
+        done = row[0] if row else 0
+        start = done
+        if since is not None and since < done:
+            # the first bucket whose source rows are all retained
+            retained = -(-int(now - self.retention[source]) // resolution) * resolution
+            start = min(done, max(since // resolution * resolution, retained))
+        until = int(now) // resolution * resolution
+        if until <= start:
+            return None
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO sample '
+            'SELECT server_id, metric_id, ?, ts / ? * ?,'
+            ' SUM(value * count) / SUM(count), MIN(vmin), MAX(vmax), SUM(count) '
+            'FROM sample WHERE resolution = ? AND ts >= ? AND ts < ? '
+            'GROUP BY server_id, metric_id, ts / ?',
+            (resolution, resolution, resolution, source, start, until, resolution))
+        self.db.execute('INSERT OR REPLACE INTO rollup VALUES (?, ?)',
+                        (resolution, max(done, until)))
+        return start
+
+    def _expire(self, now):
+        for resolution, retention in self.retention.items():
+            self.db.execute('DELETE FROM sample WHERE resolution = ? AND ts < ?',
+                            (resolution, int(now - retention)))
+
+    def _done(self, resolution):
+        if resolution == 0:
+            return None
+        row = self.db.execute('SELECT done FROM rollup WHERE resolution = ?',
+                              (resolution,)).fetchone()
+        return row[0] if row else 0
+
+    def query(self, server_id, names, start, end, step=None):
+        """return series of server_id between start and end
+
+        the coarsest resolution not larger than step is read and samples
+        are averaged into step sized buckets. the recent part which is not
+        rolled up yet is read from the finer resolutions.
+
+        Returns:
+            dict: {'step', 'resolution', 'timestamps', 'series': {name: [...]}}
+        """
+        start, end = int(start), int(end)
+        if step is None or step <= 0:
+            step = max(1, (end - start) // 500)
+        step = int(step)
+        resolution = max(r for r in RESOLUTIONS if r <= step)
+
+        timestamps = list(range(start // step * step, end + 1, step))
+        with self._lock:
+            self.flush()
+            metric_ids = {self._metric_ids[name]: name for name in names
+                          if name in self._metric_ids}
+            series = {name: [None] * len(timestamps) for name in metric_ids.values()}
+            result = {'step': step, 'resolution': resolution, 'timestamps': timestamps,
+                      'series': series}
+            if not metric_ids or not timestamps:
+                return result
+
+            # (resolution, from, to) segments, coarsest first
+            segments = []
+            lo = start
+            for r in sorted((r for r in RESOLUTIONS if r <= resolution), reverse=True):
+                done = self._done(r)
+                hi = end + 1 if done is None else min(end + 1, done)
+                if hi > lo:
+                    segments.append((r, lo, hi))
+                    lo = hi
+
+            placeholders = ','.join('?' * len(metric_ids))
+            sql = ('SELECT metric_id, ts / ? * ?, SUM(value * count), SUM(count) FROM sample '
+                   'WHERE server_id = ? AND resolution = ? AND ts >= ? AND ts < ? '
+                   'AND metric_id IN ({}) GROUP BY metric_id, ts / ?'.format(placeholders))
+            totals = {}
+            for r, lo, hi in segments:
+                for metric_id, ts, total, count in self.db.execute(
+                        sql, [step, step, server_id, r, lo, hi] + list(metric_ids) + [step]):
+                    key = (metric_id, ts)
+                    previous = totals.get(key, (0, 0))
+                    totals[key] = (previous[0] + total, previous[1] + count)
+
+            first = timestamps[0]
+            for (metric_id, ts), (total, count) in totals.items():
+                index = (ts - first) // step
+                if 0 <= index < len(timestamps):
+                    series[metric_ids[metric_id]][index] = total / count
+            return result
+
+    def discard(self, server_id):
+        """delete the samples of a deleted server, its id may be handed out again
+        """
+        with self._lock:
+            self._buffer = [sample for sample in self._buffer if sample[0] != server_id]
+            if self.enabled:
+                self.db.execute('DELETE FROM sample WHERE server_id = ?', (server_id,))
+
+
+history = HistoryStore()
+collector.listeners.append(history.on_sample)
+discards.append(history.discard)
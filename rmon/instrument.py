@@ -0,0 +1,185 @@
+""" rmon.instrument
+request, SQL, pool and collector instrumentation of rmon itself
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from rmon.collector import collector
+from rmon.common.clients import clients
+from rmon.common.metrics import registry
+
+REQUEST_SECONDS = registry.histogram(
+    'rmon_http_request_seconds', 'Latency of API requests.', ('view', 'method'))
+REQUESTS = registry.counter(
+    'rmon_http_requests_total', 'API requests by response status.', ('view', 'method', 'status'))
+REQUEST_QUERIES = registry.histogram(
+    'rmon_http_request_sql_queries', 'SQL queries issued by one API request.', ('view', 'method'),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+SQL_SECONDS = registry.histogram('rmon_sql_query_seconds', 'Latency of SQL queries.')
+
+
+def _pool_occupancy():
+    stats = clients.stats()
+    return {(state,): stats[state] for state in ('in_use', 'idle')}
+
+
+registry.gauge('rmon_redis_pools', 'Connection pools of monitored servers.',
+               callback=lambda: {(): len(clients)})
+registry.gauge('rmon_redis_pool_connections', 'Pooled redis connections by state.', ('state',),
+               callback=_pool_occupancy)
+registry.gauge('rmon_collector_lag_seconds', 'Seconds the collector is behind its schedule.',
+               callback=lambda: {(): collector.lag})
+registry.gauge('rmon_collector_running', 'Whether the background collector is running.',
+               callback=lambda: {(): int(collector.running)})
+
+
+class SamplingProfiler:
+    """sample the stacks of every thread every `interval` seconds
+
+    stacks are kept in the collapsed format of flame graph tools,
+    `file:function;file:function count`, at most max_stacks of them.
+    """
+
+    def __init__(self, interval=0.01, max_stacks=10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self.stacks = Counter()
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='rmon-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{}:{}'.format(code.co_filename, code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample(self):
+        own = threading.get_ident()
+        with self._lock:
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self._collapse(frame)
+                if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[stack] += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def collapsed(self):
+        with self._lock:
+            return ''.join('{} {}\n'.format(stack, count)
+                           for stack, count in self.stacks.most_common())
+
+    def reset(self):
+        with self._lock:
+            self.samples = 0
+            self.stacks.clear()
+
+
+class Instrumentation:
+    """time API requests and count their SQL queries
+
+    redis commands are timed by the clients of rmon.common.clients and
+    the collector times its own cycles, every metric is registered in
+    rmon.common.metrics.registry and served by /metrics.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.profiler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config.get('INSTRUMENT_ENABLED', self.enabled)
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if config.get('PROFILER_ENABLED'):
+            self.profiler = SamplingProfiler(config.get('PROFILER_INTERVAL', 0.01),
+                                             config.get('PROFILER_MAX_STACKS', 10000))
+            self.profiler.start()
+
+    @staticmethod
+    def _before_request():
+        g.instrument_started = time.perf_counter()
+        g.instrument_queries = 0
+
+    @staticmethod
+    def _after_request(response):
+        started = g.get('instrument_started')
+        if started is not None:
+            view = request.endpoint or 'none'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, view, request.method)
+            REQUEST_QUERIES.observe(g.instrument_queries, view, request.method)
+            REQUESTS.inc(view, request.method, str(response.status_code))
+        return response
+
+    def render(self):
+        return registry.render()
+
+
+instrument = Instrumentation()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if instrument.enabled:
+        conn.info.setdefault('instrument_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('instrument_started')
+    if not started:
+        return
+    SQL_SECONDS.observe(time.perf_counter() - started.pop())
+    if has_request_context() and 'instrument_queries' in g:
+        g.instrument_queries += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    started = context.connection.info.get('instrument_started') \
+        if context.connection is not None else None
+    if started:
+        started.pop()
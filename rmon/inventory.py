@@ -0,0 +1,178 @@
+""" rmon.inventory
+bulk import, delete and export of registered servers
+"""
+
+from flask.json import dumps
+
+from rmon.common.cache import object_cache
+from rmon.common.fanout import fan_out
+from rmon.models import (db, AlertRule, Server, ServerNode, ServerSchema, discard_server,
+                         server_schema, server_tag)
+
+# stay below the 999 bound parameters of sqlite
+CHUNK_SIZE = 500
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _lookup(column, values):
+    """load the servers whose column is in values with one query per chunk
+    """
+    servers = {}
+    for chunk in _chunks(set(values)):
+        for server in Server.query.filter(column.in_(chunk)):
+            servers[getattr(server, column.key)] = server
+    return servers
+
+
+def _error(message):
+    if isinstance(message, dict):
+        # {'name': ['Redis server already exists']} -> 'name: Redis server already exists'
+        message = '; '.join('{}: {}'.format(key, value[0] if isinstance(value, list) else value)
+                            for key, value in sorted(message.items()))
+    return {'ok': False, 'message': message}
+
+
+def import_servers(items, ping=True, timeout=2, deadline=30, workers=32):
+    """create or update servers in a single transaction
+
+    an item with an `id` updates that server, any other item creates a
+    new one. names are checked against the database with one set-based
+    query, candidates are pinged concurrently and every valid item is
+    committed at once; invalid items are reported and skipped.
+
+    Args:
+        items (list): server dicts as accepted by ServerSchema
+        ping (bool): ping candidates before saving them
+        timeout (float): seconds allowed for one ping
+        deadline (float): seconds allowed for all pings
+        workers (int): concurrent pings
+
+    Returns:
+        list: one {'ok', 'action', 'id'} or {'ok', 'message'} per item
+    """
+    results = [None] * len(items)
+
+    # values of the wrong type are reported per item below
+    ids = [item['id'] for item in items if isinstance(item, dict) and _is_id(item.get('id'))]
+    names = [item['name'] for item in items
+             if isinstance(item, dict) and isinstance(item.get('name'), str)]
+    by_id = _lookup(Server.id, ids)
+    by_name = _lookup(Server.name, names)
+    # tags looked up or created by earlier items
+    tags = {}
+
+    candidates = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = _error('server must be an object')
+            continue
+        if 'id' in item and not _is_id(item['id']):
+            results[index] = _error({'id': ['Not a valid integer.']})
+            continue
+        if 'name' in item and not isinstance(item['name'], str):
+            results[index] = _error({'name': ['Not a valid string.']})
+            continue
+
+        data = dict(item)
+        instance = None
+        if 'id' in data:
+            instance = by_id.get(data.pop('id'))
+            if instance is None:
+                results[index] = _error('object doesn\'t exist')
+                continue
+
+        schema = ServerSchema(context={'instance': instance, 'servers': by_name, 'tags': tags})
+        old_name = instance.name if instance is not None else None
+        server, errors = schema.load(data, partial=instance is not None)
+        if errors:
+            if instance is not None:
+                db.session.expire(instance)
+            results[index] = _error(errors)
+            continue
+
+        # later items of the batch must not take the same name
+        if old_name is not None and old_name != server.name:
+            by_name.pop(old_name, None)
+        by_name[server.name] = server
+        candidates.append((index, server, instance is None))
+
+    if ping and candidates:
+        for candidate, status, value, _ in fan_out(candidates, lambda c: c[1].ping(timeout),
+                                                   timeout, deadline, workers):
+            if status == 'ok':
+                continue
+            index, server, created = candidate
+            message = getattr(value, 'message', None) or \
+                'cannot connect to redis server {}'.format(server.host)
+            results[index] = _error(message)
+            if not created:
+                db.session.expire(server)
+
+    valid = [(index, server, created) for index, server, created in candidates
+             if results[index] is None]
+    db.session.add_all([server for _, server, _ in valid])
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for index, _, _ in valid:
+            results[index] = _error('transaction failed: {}'.format(e))
+        return results
+
+    for index, server, created in valid:
+        object_cache.invalidate(Server, server.id)
+        results[index] = {'ok': True, 'action': 'created' if created else 'updated',
+                          'id': server.id}
+    return results
+
+
+def delete_servers(ids):
+    """delete servers by id in a single transaction
+
+    Returns:
+        list: one {'ok', 'id'} or {'ok', 'id', 'message'} per id
+    """
+    existing = _lookup(Server.id, [server_id for server_id in ids if _is_id(server_id)])
+    for chunk in _chunks(existing):
+        ServerNode.query.filter(ServerNode.server_id.in_(chunk)).delete(synchronize_session=False)
+        AlertRule.query.filter(AlertRule.server_id.in_(chunk)).delete(synchronize_session=False)
+        db.session.execute(server_tag.delete().where(server_tag.c.server_id.in_(chunk)))
+        Server.query.filter(Server.id.in_(chunk)).delete(synchronize_session=False)
+    db.session.commit()
+
+    results = []
+    for server_id in ids:
+        if not _is_id(server_id):
+            results.append({'ok': False, 'id': server_id, 'message': 'Not a valid integer.'})
+        elif server_id in existing:
+            discard_server(server_id)
+            results.append({'ok': True, 'id': server_id})
+        else:
+            results.append({'ok': False, 'id': server_id, 'message': 'object doesn\'t exist'})
+    return results
+
+
+def export_servers(query=None, batch=CHUNK_SIZE):
+    """yield the servers of query as NDJSON lines, batch by batch by id
+    """
+    query = Server.query if query is None else query
+    schema = server_schema()
+    cursor = None
+    while True:
+        page = query if cursor is None else query.filter(Server.id > cursor)
+        servers = page.order_by(Server.id).limit(batch).all()
+        if not servers:
+            return
+        Server.preload_labels(servers)
+        for server in servers:
+            yield dumps(schema.dump(server).data) + '\n'
+        cursor = servers[-1].id
@@ -0,0 +1,274 @@
+""" rmon.keyspace
+throttled SCAN based keyspace profiling
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from redis import RedisError
+
+from rmon.common.clients import clients
+
+logger = logging.getLogger(__name__)
+
+# segments which identify a single object rather than a kind of key
+VARIABLE_SEGMENT = re.compile(r'^(\d+|[0-9a-f]{8,}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                              r'[0-9a-f]{4}-[0-9a-f]{12})$', re.IGNORECASE)
+
+# upper bounds in seconds of the TTL distribution buckets
+TTL_BUCKETS = ((3600, '<1h'), (86400, '<1d'), (7 * 86400, '<7d'))
+
+Target = namedtuple('Target', 'id host port password')
+
+
+def key_pattern(key, delimiter=':', max_depth=4):
+    """return the pattern segments of a key
+
+    `user:1024:profile` -> ('user', '*', 'profile')
+    """
+    segments = key.split(delimiter, max_depth)[:max_depth]
+    return tuple('*' if VARIABLE_SEGMENT.match(segment) else segment for segment in segments)
+
+
+def ttl_bucket(ttl):
+    if ttl is None or ttl < 0:
+        return 'none'
+    for bound, name in TTL_BUCKETS:
+        if ttl < bound:
+            return name
+    return '>=7d'
+
+
+class PrefixTree:
+    """key statistics aggregated per pattern prefix
+
+    at most max_nodes prefixes are tracked, a key whose prefix cannot get
+    a node of its own only counts towards its deepest tracked ancestor.
+    """
+
+    def __init__(self, max_nodes=10000, delimiter=':'):
+        self.max_nodes = max_nodes
+        self.delimiter = delimiter
+        self.nodes = {}
+
+    def add(self, pattern, key_type, size, ttl):
+        for depth in range(1, len(pattern) + 1):
+            prefix = pattern[:depth]
+            node = self.nodes.get(prefix)
+            if node is None:
+                if len(self.nodes) >= self.max_nodes:
+                    return
+                node = self.nodes[prefix] = {'keys': 0, 'bytes': 0, 'types': Counter(),
+                                             'ttl': Counter()}
+            node['keys'] += 1
+            node['bytes'] += size
+            node['types'][key_type] += 1
+            node['ttl'][ttl_bucket(ttl)] += 1
+
+    def top(self, limit, scale=1.0):
+        """return the `limit` biggest prefixes, counts multiplied by scale
+        """
+        nodes = sorted(self.nodes.items(), key=lambda item: item[1]['bytes'], reverse=True)
+        return [{
+            'pattern': self.delimiter.join(prefix),
+            'depth': len(prefix),
+            'keys': int(node['keys'] * scale),
+            'bytes': int(node['bytes'] * scale),
+            'types': dict(node['types']),
+            'ttl': dict(node['ttl']),
+        } for prefix, node in nodes[:limit]]
+
+
+class KeyspaceAnalyzer:
+    """walk the keyspace of one server with SCAN in a background thread
+
+    sampled keys get TYPE, TTL and MEMORY USAGE in one pipeline per SCAN
+    batch. commands are paced to `ops_fraction` of the server's own
+    instantaneous ops per second (at least `min_rate` per second), and
+    the SCAN cursor is kept so a stopped analysis can be resumed.
+    """
+
+    def __init__(self, server, scan_count=500, sample_rate=0.1, ops_fraction=0.05,
+                 min_rate=200, max_nodes=10000, max_depth=4):
+        self.target = Target(server.id, server.host, server.port, server.password)
+        self.scan_count = scan_count
+        self.sample_rate = sample_rate
+        self.ops_fraction = ops_fraction
+        self.min_rate = min_rate
+        self.max_depth = max_depth
+        self.tree = PrefixTree(max_nodes)
+
+        self.status = 'pending'
+        self.message = None
+        self.cursor = 0
+        self.scanned = 0
+        self.sampled = 0
+        self.started_at = None
+        self.updated_at = None
+        self.memory_supported = True
+
+        self._random = random.Random(server.id)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """start or resume from the last cursor
+        """
+        if self.running:
+            return
+        self._stopped.clear()
+        self.status = 'running'
+        self.message = None
+        self.started_at = self.started_at or time.time()
+        self._thread = threading.Thread(target=self._run, name='rmon-keyspace')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _rate(self, client):
+        """commands per second allowed by ops_fraction
+        """
+        ops = client.info('stats').get('instantaneous_ops_per_sec', 0)
+        return max(self.min_rate, ops * self.ops_fraction)
+
+    def _run(self):
+        client = clients.get(self.target)
+        try:
+            rate = self._rate(client)
+            batches = 0
+            while not self._stopped.is_set():
+                started = time.time()
+                self.cursor, keys = client.scan(self.cursor, count=self.scan_count)
+                commands = 1 + self._analyze(client, keys)
+                self.scanned += len(keys)
+                self.updated_at = time.time()
+
+                if self.cursor == 0:
+                    self.status = 'done'
+                    return
+
+                batches += 1
+                if batches % 20 == 0:
+                    rate = self._rate(client)
+                self._stopped.wait(max(0, commands / rate - (time.time() - started)))
+            self.status = 'paused'
+        except RedisError as e:
+            logger.warning('keyspace analysis of %s failed: %s', self.target.host, e)
+            self.status = 'failed'
+            self.message = str(e)
+
+    def _analyze(self, client, keys):
+        """aggregate a sample of keys, return the number of commands sent
+        """
+        sample = [key for key in keys if self._random.random() < self.sample_rate]
+        if not sample:
+            return 0
+
+        pipe = client.pipeline(transaction=False)
+        for key in sample:
+            pipe.type(key)
+            pipe.ttl(key)
+            if self.memory_supported:
+                pipe.execute_command('MEMORY', 'USAGE', key)
+        replies = pipe.execute(raise_on_error=False)
+
+        step = 3 if self.memory_supported else 2
+        for index, key in enumerate(sample):
+            key_type, ttl = replies[index * step], replies[index * step + 1]
+            size = replies[index * step + 2] if self.memory_supported else 0
+            if isinstance(size, RedisError):
+                # MEMORY USAGE needs redis 4.0
+                self.memory_supported = False
+                size = 0
+            if isinstance(key_type, RedisError) or key_type in (b'none', 'none'):
+                continue
+            if isinstance(key_type, bytes):
+                key_type = key_type.decode()
+            if isinstance(key, bytes):
+                key = key.decode('utf-8', 'replace')
+            ttl = ttl if isinstance(ttl, int) else None
+            self.tree.add(key_pattern(key, max_depth=self.max_depth), key_type, size or 0, ttl)
+            self.sampled += 1
+        return len(sample) * step
+
+    def report(self, limit=50):
+        """progress and the biggest key patterns, scaled by the sample rate
+        """
+        return {
+            'status': self.status,
+            'message': self.message,
+            'cursor': self.cursor,
+            'scanned': self.scanned,
+            'sampled': self.sampled,
+            'sample_rate': self.sample_rate,
+            'memory_supported': self.memory_supported,
+            'started_at': self.started_at,
+            'updated_at': self.updated_at,
+            'patterns': self.tree.top(limit, 1 / self.sample_rate if self.sample_rate else 0),
+        }
+
+
+class Analyzers:
+    """keyspace analysis jobs, at most one per server
+    """
+
+    def __init__(self, app=None):
+        self.options = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.options = {
+            'scan_count': config.get('KEYSPACE_SCAN_COUNT', 500),
+            'sample_rate': config.get('KEYSPACE_SAMPLE_RATE', 0.1),
+            'ops_fraction': config.get('KEYSPACE_OPS_FRACTION', 0.05),
+            'min_rate': config.get('KEYSPACE_MIN_RATE', 200),
+            'max_nodes': config.get('KEYSPACE_MAX_NODES', 10000),
+            'max_depth': config.get('KEYSPACE_MAX_DEPTH', 4),
+        }
+
+    def get(self, server_id):
+        return self._jobs.get(server_id)
+
+    def start(self, server, restart=False, **options):
+        """start, resume or restart the analysis of server
+        """
+        with self._lock:
+            job = self._jobs.get(server.id)
+            if job is not None and restart:
+                job.stop()
+                job = None
+            if job is None or job.status == 'done':
+                job = self._jobs[server.id] = KeyspaceAnalyzer(
+                    server, **dict(self.options, **options))
+            job.start()
+            return job
+
+    def stop(self, server_id):
+        job = self._jobs.get(server_id)
+        if job is not None:
+            job.stop()
+        return job
+
+    def discard(self, server_id):
+        job = self._jobs.pop(server_id, None)
+        if job is not None:
+            job.stop()
+
+
+analyzers = Analyzers()
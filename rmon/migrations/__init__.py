@@ -0,0 +1,87 @@
+""" rmon.migrations
+versioned changes of the inventory schema
+
+every migration module has a VERSION, a NAME and an upgrade(schema)
+function. applied versions are recorded in the schema_version table.
+a migration only creates what the schema does not have yet, so it
+adopts a database made by `db.create_all()` and completes one which was
+interrupted half way on engines without transactional DDL.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select
+from sqlalchemy.schema import CreateColumn
+
+from rmon.migrations import v001_initial, v002_nodes_and_alerts, v003_server_tags
+
+MIGRATIONS = (v001_initial, v002_nodes_and_alerts, v003_server_tags)
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(64), nullable=False),
+    Column('applied_at', DateTime, nullable=False))
+
+
+class Schema:
+    """the tables of a connection as the migrations see them
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.inspector = inspect(connection)
+
+    def has_table(self, table):
+        return table in self.inspector.get_table_names()
+
+    def has_column(self, table, column):
+        return any(item['name'] == column for item in self.inspector.get_columns(table))
+
+    def has_index(self, table, index):
+        return any(item['name'] == index for item in self.inspector.get_indexes(table))
+
+    def create_table(self, table):
+        if not self.has_table(table.name):
+            table.create(self.connection)
+
+    def add_column(self, table, column):
+        if not self.has_column(table, column.name):
+            self.connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                table, CreateColumn(column).compile(dialect=self.connection.dialect)))
+
+    def create_index(self, index):
+        if not self.has_index(index.table.name, index.name):
+            index.create(self.connection)
+
+
+def current_version(connection):
+    """the latest applied version, 0 for a database never migrated
+    """
+    if not connection.dialect.has_table(connection, schema_version.name):
+        return 0
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade(engine, target=None):
+    """apply the migrations after the current version up to target
+
+    each migration runs in its own transaction, run it once before the
+    API workers start rather than from every worker.
+
+    Returns:
+        list: (version, name) of the applied migrations
+    """
+    applied = []
+    for migration in MIGRATIONS:
+        if target is not None and migration.VERSION > target:
+            break
+        with engine.begin() as connection:
+            schema_version.create(connection, checkfirst=True)
+            if migration.VERSION <= current_version(connection):
+                continue
+            migration.upgrade(Schema(connection))
+            connection.execute(schema_version.insert().values(
+                version=migration.VERSION, name=migration.NAME, applied_at=datetime.utcnow()))
+        applied.append((migration.VERSION, migration.NAME))
+    return applied
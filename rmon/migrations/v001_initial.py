@@ -0,0 +1,25 @@
+""" rmon.migrations.v001_initial
+the redis_server table of the first release
+"""
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+
+VERSION = 1
+NAME = 'initial'
+
+metadata = MetaData()
+
+redis_server = Table(
+    'redis_server', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(64), unique=True),
+    Column('description', String(512)),
+    Column('host', String(15)),
+    Column('port', Integer),
+    Column('password', String()),
+    Column('updated_at', DateTime),
+    Column('created_at', DateTime))
+
+
+def upgrade(schema):
+    schema.create_table(redis_server)
@@ -0,0 +1,53 @@
+""" rmon.migrations.v002_nodes_and_alerts
+probe intervals of servers, discovered nodes and alert rules
+"""
+
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Index, Integer, MetaData, String,
+                        Table, Text, UniqueConstraint)
+
+VERSION = 2
+NAME = 'nodes_and_alerts'
+
+metadata = MetaData()
+
+# the columns referenced by the new tables
+redis_server = Table('redis_server', metadata, Column('id', Integer, primary_key=True))
+
+redis_node = Table(
+    'redis_node', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('server_id', Integer, ForeignKey('redis_server.id', ondelete='CASCADE'),
+           nullable=False),
+    Column('node_id', String(40)),
+    Column('host', String(255)),
+    Column('port', Integer),
+    Column('role', String(16)),
+    Column('master', String(262)),
+    Column('slots', Text),
+    Column('flags', String(128)),
+    Column('link_state', String(32)),
+    Column('updated_at', DateTime),
+    Column('created_at', DateTime),
+    UniqueConstraint('server_id', 'host', 'port'),
+    Index('ix_redis_node_server_id', 'server_id'))
+
+alert_rule = Table(
+    'alert_rule', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(64), unique=True),
+    Column('description', String(512)),
+    Column('server_id', Integer, ForeignKey('redis_server.id', ondelete='CASCADE')),
+    Column('condition', String(512), nullable=False),
+    Column('duration', Integer, nullable=False),
+    Column('severity', String(16), nullable=False),
+    Column('enabled', Boolean, nullable=False),
+    Column('updated_at', DateTime),
+    Column('created_at', DateTime),
+    Index('ix_alert_rule_server_id', 'server_id'))
+
+
+def upgrade(schema):
+    schema.add_column('redis_server', Column('probe_interval', Integer))
+    schema.add_column('redis_server', Column('boost_interval', Integer))
+    schema.create_table(redis_node)
+    schema.create_table(alert_rule)
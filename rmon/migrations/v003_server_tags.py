@@ -0,0 +1,38 @@
+""" rmon.migrations.v003_server_tags
+tags of servers and the index of the host / port filters
+"""
+
+from sqlalchemy import (Column, ForeignKey, Index, Integer, MetaData, String, Table,
+                        UniqueConstraint)
+
+VERSION = 3
+NAME = 'server_tags'
+
+metadata = MetaData()
+
+redis_server = Table(
+    'redis_server', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('host', String(15)),
+    Column('port', Integer))
+
+tag = Table(
+    'tag', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('key', String(64), nullable=False),
+    Column('value', String(128), nullable=False),
+    UniqueConstraint('key', 'value'))
+
+server_tag = Table(
+    'server_tag', metadata,
+    Column('server_id', Integer, ForeignKey('redis_server.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('tag_id', Integer, ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_server_tag_tag_id', 'tag_id', 'server_id'))
+
+
+def upgrade(schema):
+    schema.create_table(tag)
+    schema.create_table(server_tag)
+    schema.create_index(Index('ix_redis_server_host_port', redis_server.c.host,
+                              redis_server.c.port))
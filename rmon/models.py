@@ -2,15 +2,87 @@
 rmon.model
 """
 
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
-from flask_sqlalchemy import SQLAlchemy
 from marshmallow import (Schema, fields, validate, post_load, validates_schema, ValidationError)
-from redis import StrictRedis, RedisError
+from redis import RedisError
+from sqlalchemy import and_, bindparam, exists, false, select
 
+from rmon.common.aioprobe import probes
+from rmon.common.cache import object_cache
+from rmon.common.clients import clients
+from rmon.common.expressions import compile_condition, split_duration
+from rmon.common.labels import validate_labels
 from rmon.common.rest import RestException
+from rmon.common.snapshot import take_snapshot
+from rmon.keyspace import analyzers
+from rmon.slowlog import slowlogs
+from rmon.storage import db
 
-db = SQLAlchemy()
+# many-to-many between servers and tags, the primary key looks up the
+# tags of a server and the index the servers of a tag
+server_tag = db.Table(
+    'server_tag',
+    db.Column('server_id', db.Integer, db.ForeignKey('redis_server.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Index('ix_server_tag_tag_id', 'tag_id', 'server_id'))
+
+
+class Tag(db.Model):
+    """
+    a key=value label shared by every server tagged with it
+    """
+
+    __tablename__ = 'tag'
+    __table_args__ = (db.UniqueConstraint('key', 'value'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), nullable=False)
+    value = db.Column(db.String(128), nullable=False, default='')
+
+    def __repr__(self):
+        return '<Tag({}={})>'.format(self.key, self.value)
+
+    @classmethod
+    def resolve(cls, labels, known=None):
+        """return the Tag of every key=value of labels, new ones unsaved
+
+        Args:
+            labels (dict): tag key -> value
+            known (dict): (key, value) -> Tag already looked up, shared by
+                the servers of a bulk load so that a new tag is created once
+        """
+        known = {} if known is None else known
+        pairs = [pair for pair in labels.items() if pair not in known]
+        keys = {key for key, _ in pairs}
+        if keys:
+            # changes of other servers of the batch are not flushed yet
+            with db.session.no_autoflush:
+                for tag in cls.query.filter(cls.key.in_(keys)):
+                    known.setdefault((tag.key, tag.value), tag)
+        for pair in pairs:
+            if pair not in known:
+                known[pair] = cls(key=pair[0], value=pair[1])
+        return [known[pair] for pair in sorted(labels.items())]
+
+
+# key and value of the tags of the given servers, compiled once per
+# process instead of on every page
+SERVER_LABELS = select([server_tag.c.server_id, Tag.key, Tag.value]) \
+    .select_from(server_tag.join(Tag.__table__, Tag.id == server_tag.c.tag_id)) \
+    .where(server_tag.c.server_id.in_(bindparam('ids', expanding=True)))
+_compiled_labels = {}
+# ids bound per query, below the 999 variables of sqlite before 3.32
+LABEL_IDS = 500
+# labels of every untagged server read by preload_labels, never modified
+NO_LABELS = {}
+# discard(server_id) of the modules keeping state of servers, which import
+# this module and register themselves, called by discard_server
+discards = []
 
 
 class Server(db.Model):
@@ -19,6 +91,7 @@ class Server(db.Model):
     """
 
     __tablename__ = 'redis_server'
+    __table_args__ = (db.Index('ix_redis_server_host_port', 'host', 'port'),)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
@@ -26,38 +99,260 @@ class Server(db.Model):
     host = db.Column(db.String(15))
     port = db.Column(db.Integer, default=6379)
     password = db.Column(db.String())
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow())
+    # seconds between probes of the collector, COLLECTOR_INTERVAL when null
+    probe_interval = db.Column(db.Integer)
+    # seconds between probes while a SCHEDULER_THRESHOLDS metric is crossed
+    boost_interval = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    tags = db.relationship(Tag, secondary=server_tag, order_by=(Tag.key, Tag.value))
+
+    # labels read by preload_labels
+    _labels = None
+
     def __repr__(self):
         return '<Server(name={})>'.format(self.name)
 
+    @property
+    def labels(self):
+        """tags of the server as a dict
+        """
+        if self._labels is not None:
+            return self._labels
+        return {tag.key: tag.value for tag in self.tags}
+
+    @classmethod
+    def preload_labels(cls, servers):
+        """read the labels of many servers with one query
+
+        cheaper than loading the tags relationship of servers which are
+        only dumped. only the tags of servers are read, a filtered page
+        may span most of the id range.
+        """
+        if not servers:
+            return
+        connection = db.session.connection().execution_options(compiled_cache=_compiled_labels)
+        ids = [server.id for server in servers]
+        labels = {}
+        for start in range(0, len(ids), LABEL_IDS):
+            rows = connection.execute(SERVER_LABELS, ids=ids[start:start + LABEL_IDS])
+            for server_id, key, value in rows:
+                labels.setdefault(server_id, {})[key] = value
+        for server in servers:
+            server._labels = labels.get(server.id, NO_LABELS)
+
+    def set_labels(self, labels, known=None):
+        """replace the tags of the server, see Tag.resolve
+        """
+        with db.session.no_autoflush:
+            if labels == self.labels:
+                return
+            self.tags = Tag.resolve(labels, known)
+            self._labels = None
+        # the row itself is unchanged, list ETags still have to change
+        self.updated_at = datetime.utcnow()
+
+    @classmethod
+    def filtered(cls, ids=None, name=None, host=None, port=None, tags=None):
+        """query servers matching the given filters
+
+        Args:
+            ids (list): server ids
+            name (str): server name, `*` matches any characters
+            host (str): exact host
+            port (int): exact port
+            tags (list): Requirement of a selector, see
+                rmon.common.labels.parse_selector
+        """
+        query = cls.query
+        if ids is not None:
+            query = query.filter(cls.id.in_(ids))
+        if name is not None:
+            if '*' in name:
+                pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                query = query.filter(cls.name.like(pattern.replace('*', '%'), escape='\\'))
+            else:
+                query = query.filter(cls.name == name)
+        if host is not None:
+            query = query.filter(cls.host == host)
+        if port is not None:
+            query = query.filter(cls.port == port)
+        if tags:
+            query = cls._select_tags(query, tags)
+        return query
+
+    @classmethod
+    def _select_tags(cls, query, requirements):
+        """filter query by the requirements of a tag selector
+
+        the ids of the few matching tags are read first, every candidate
+        server then costs one lookup in the primary key of server_tag, so
+        a page stops as soon as it is full instead of materializing every
+        tagged server.
+        """
+        keys = {requirement.key for requirement in requirements}
+        tags = db.session.query(Tag.id, Tag.key, Tag.value).filter(Tag.key.in_(keys)).all()
+        for requirement in requirements:
+            tag_ids = [tag_id for tag_id, key, value in tags if key == requirement.key and
+                       (requirement.values is None or value in requirement.values)]
+            if not tag_ids:
+                if not requirement.negated:
+                    return query.filter(false())
+                continue
+            # an alias, query may join server_tag itself
+            tagging = server_tag.alias()
+            tagged = exists().where(and_(tagging.c.server_id == cls.id,
+                                         tagging.c.tag_id.in_(tag_ids)))
+            query = query.filter(~tagged if requirement.negated else tagged)
+        return query
+
     def save(self):
         db.session.add(self)
         db.session.commit()
+        object_cache.invalidate(Server, self.id)
 
     def delete(self):
+        server_id = self.id
         db.session.delete(self)
         db.session.commit()
+        discard_server(server_id)
 
     @property 
     def redis(self):
-        return StrictRedis(host=self.host, port=self.port, password=self.password)
+        """pooled client shared by every access to this server
+        """
+        return clients.get(self)
 
-    def ping(self):
+    def ping(self, timeout=None):
+        """
+        Args:
+            timeout (float): seconds before giving up, the configured
+                socket timeouts when None
+        """
         try:
-            return self.redis.ping()
+            if probes.enabled:
+                return probes.ping(self, timeout)
+            return clients.get(self, timeout).ping()
         except RedisError:
             raise RestException(400, 'cannot connect to redis server {}'.format(self.host))
 
-    def get_metrics(self):
-        """get redis server metrics 
+    def get_metrics(self, timeout=None):
+        """get redis server metrics, see ping for timeout
         """
         try:
-            return self.redis.info()
+            if probes.enabled:
+                return probes.info(self, timeout)
+            return clients.get(self, timeout).info()
         except RedisError:
             raise(RestException(400, 'cannot connect to redis server {}'.format(self.host)))
 
+    def snapshot(self, sections):
+        """fetch INFO sections and extra commands in one pipeline
+
+        Args:
+            sections (list): INFO section names or commands of
+                rmon.common.snapshot.COMMANDS
+        """
+        try:
+            return take_snapshot(self.redis, sections)
+        except RedisError:
+            raise RestException(400, 'cannot connect to redis server {}'.format(self.host))
+
+    def analyze_keyspace(self, restart=False, **options):
+        """start or resume a background keyspace analysis
+
+        see rmon.keyspace.KeyspaceAnalyzer for the options
+        """
+        return analyzers.start(self, restart=restart, **options)
+
+
+def discard_server(server_id):
+    """drop what is kept outside of the database about a deleted server
+    """
+    object_cache.invalidate(Server, server_id)
+    clients.invalidate(server_id)
+    analyzers.discard(server_id)
+    slowlogs.discard(server_id)
+    for discard in discards:
+        discard(server_id)
+
+
+class ServerNode(db.Model):
+    """
+    a cluster or replication node discovered from a seed server
+    """
+
+    __tablename__ = 'redis_node'
+    __table_args__ = (db.UniqueConstraint('server_id', 'host', 'port'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    server_id = db.Column(db.Integer, db.ForeignKey('redis_server.id', ondelete='CASCADE'),
+                          index=True, nullable=False)
+    # cluster node id, None outside of a cluster
+    node_id = db.Column(db.String(40))
+    host = db.Column(db.String(255))
+    port = db.Column(db.Integer)
+    # master or replica
+    role = db.Column(db.String(16))
+    # host:port of the master of a replica
+    master = db.Column(db.String(262))
+    slots = db.Column(db.Text)
+    flags = db.Column(db.String(128))
+    link_state = db.Column(db.String(32))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    server = db.relationship(Server, backref=db.backref(
+        'nodes', cascade='all, delete-orphan', order_by='ServerNode.id'))
+
+    def __repr__(self):
+        return '<ServerNode({}:{} {})>'.format(self.host, self.port, self.role)
+
+    @property
+    def address(self):
+        return '{}:{}'.format(self.host, self.port)
+
+
+class AlertRule(db.Model):
+    """
+    an alert condition over the samples of one or every server
+    """
+
+    __tablename__ = 'alert_rule'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True)
+    description = db.Column(db.String(512))
+    # None applies the rule to every server
+    server_id = db.Column(db.Integer, db.ForeignKey('redis_server.id', ondelete='CASCADE'),
+                          index=True)
+    # see rmon.common.expressions.compile_condition
+    condition = db.Column(db.String(512), nullable=False)
+    # seconds the condition must hold before the alert fires
+    duration = db.Column(db.Integer, default=0, nullable=False)
+    severity = db.Column(db.String(16), default='warning', nullable=False)
+    enabled = db.Column(db.Boolean, default=True, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    server = db.relationship(Server, backref=db.backref(
+        'alert_rules', cascade='all, delete-orphan', order_by='AlertRule.id'))
+
+    def __repr__(self):
+        return '<AlertRule(name={})>'.format(self.name)
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+        object_cache.invalidate(AlertRule, self.id)
+
+    def delete(self):
+        rule_id = self.id
+        db.session.delete(self)
+        db.session.commit()
+        object_cache.invalidate(AlertRule, rule_id)
+
 
 class ServerSchema(Schema):
     """ serialization for Redis server instances 
@@ -70,18 +365,42 @@ class ServerSchema(Schema):
     host = fields.String(required=True, validate=validate.Regexp(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$'))
     port = fields.Integer(validate=validate.Range(1024, 65536))
     password = fields.String()
+    probe_interval = fields.Integer(allow_none=True, validate=validate.Range(1, 86400))
+    boost_interval = fields.Integer(allow_none=True, validate=validate.Range(1, 86400))
+    # {"env": "prod", "role": "cache"}
+    tags = fields.Dict(attribute='labels')
     updated_at = fields.DateTime(dump_only=True)
     created_at = fields.DateTime(dump_only=True)
 
     @validates_schema 
     def validate_schema(self, data):
         """check out if there is a homonymous Redis 
+
+        bulk loads pass the servers looked up by name in context['servers']
+        so that no query is issued per item
         """
         if 'port' not in data:
             data['port'] = 6379 
 
+        if 'labels' in data:
+            try:
+                validate_labels(data['labels'])
+            except ValueError as e:
+                raise ValidationError(str(e), 'tags')
+
+        # partial update without renaming
+        if 'name' not in data:
+            return
+
         instance = self.context.get('instance', None)
-        server = Server.query.filter_by(name=data['name']).first()
+        if instance is not None and data['name'] == instance.name:
+            return
+
+        servers = self.context.get('servers', None)
+        if servers is not None:
+            server = servers.get(data['name'])
+        else:
+            server = Server.query.filter_by(name=data['name']).first()
 
         if server is None:
             return 
@@ -98,12 +417,112 @@ class ServerSchema(Schema):
         """
 
         instance = self.context.get('instance', None)
+        labels = data.pop('labels', None)
 
         # create a Redis server object
         if instance is None:
-            return Server(**data)
+            instance = Server(**data)
+            if labels:
+                instance.set_labels(labels, self.context.get('tags'))
+            return instance
 
         # update
         for key in data:
             setattr(instance, key, data[key])
-        return instance 
\ No newline at end of file
+        if labels is not None:
+            instance.set_labels(labels, self.context.get('tags'))
+        clients.invalidate(instance.id)
+        return instance 
+
+
+class ServerNodeSchema(Schema):
+    """ serialization of discovered nodes, read only
+    """
+
+    id = fields.Integer()
+    node_id = fields.String()
+    host = fields.String()
+    port = fields.Integer()
+    role = fields.String()
+    master = fields.String()
+    slots = fields.String()
+    flags = fields.String()
+    link_state = fields.String()
+    updated_at = fields.DateTime()
+    created_at = fields.DateTime()
+
+
+class AlertRuleSchema(Schema):
+    """ serialization of alert rules
+
+    a condition ending with `for 5m` sets the duration
+    """
+
+    id = fields.Integer(dump_only=True)
+    name = fields.String(required=True, validate=validate.Length(2, 64))
+    description = fields.String(validate=validate.Length(0, 512))
+    server_id = fields.Integer(allow_none=True)
+    condition = fields.String(required=True, validate=validate.Length(1, 512))
+    duration = fields.Integer(validate=validate.Range(0, 7 * 86400))
+    severity = fields.String(validate=validate.OneOf(('info', 'warning', 'critical')))
+    enabled = fields.Boolean()
+    updated_at = fields.DateTime(dump_only=True)
+    created_at = fields.DateTime(dump_only=True)
+
+    @validates_schema
+    def validate_schema(self, data):
+        """check the condition, the server and that the name is free
+        """
+        if 'condition' in data:
+            condition, duration = split_duration(data['condition'])
+            try:
+                compile_condition(condition)
+            except ValueError as e:
+                raise ValidationError(str(e), 'condition')
+            data['condition'] = condition
+            if duration is not None:
+                data['duration'] = duration
+
+        if data.get('server_id') is not None and Server.query.get(data['server_id']) is None:
+            raise ValidationError('Redis server doesn\'t exist', 'server_id')
+
+        instance = self.context.get('instance', None)
+        if 'name' not in data or instance is not None and data['name'] == instance.name:
+            return
+        if AlertRule.query.filter_by(name=data['name']).first() is not None:
+            raise ValidationError('alert rule already exists', 'name')
+
+    @post_load
+    def create_or_update(self, data):
+        instance = self.context.get('instance', None)
+        if instance is None:
+            return AlertRule(**data)
+        for key in data:
+            setattr(instance, key, data[key])
+        return instance
+
+
+_schemas = threading.local()
+# schemas of distinct field sets kept per thread
+MAX_SCHEMAS = 32
+
+
+def server_schema(only=None):
+    """ServerSchema instance reused for dumping by the current thread
+
+    Args:
+        only (iterable): fields to dump, None for all
+    """
+    schemas = getattr(_schemas, 'schemas', None)
+    if schemas is None:
+        schemas = _schemas.schemas = OrderedDict()
+    # the same fields in another order or repeated share one schema
+    key = None if only is None else tuple(sorted(set(only)))
+    schema = schemas.get(key)
+    if schema is None:
+        if len(schemas) >= MAX_SCHEMAS:
+            schemas.popitem(last=False)
+        schema = schemas[key] = ServerSchema(only=key)
+    else:
+        schemas.move_to_end(key)
+    return schema
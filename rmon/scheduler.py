@@ -0,0 +1,241 @@
+""" rmon.scheduler
+per-server probe schedule with jitter, backoff and threshold boosts
+"""
+
+import heapq
+import random
+import threading
+import time
+
+from rmon.models import Server
+
+# Server columns the schedule of a server depends on
+COLUMNS = (Server.id, Server.host, Server.port, Server.password, Server.probe_interval,
+           Server.boost_interval)
+
+
+class Entry:
+    """schedule state of one server
+    """
+
+    __slots__ = ('server', 'row', 'due', 'failures', 'boosted', 'skipped', 'version',
+                 'in_flight')
+
+    def __init__(self, server, row):
+        self.server = server
+        self.row = row
+        self.due = 0
+        self.failures = 0
+        self.boosted = False
+        self.skipped = 0
+        self.version = 0
+        self.in_flight = False
+
+
+class Scheduler:
+    """a heap of next-due probes over every registered server
+
+    a server is probed every `probe_interval` seconds (the default
+    interval when unset). each delay is jittered so probes spread over
+    the interval instead of firing together, a failing server backs off
+    exponentially up to `backoff_max` and a server whose INFO crosses one
+    of `thresholds` is probed every `boost_interval` seconds until it
+    recovers. a server is never due again while its probe is in flight.
+    a due probe which a collector filter skipped is rescheduled by
+    skip(), its server's sample gets older by an interval each time.
+    """
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.jitter = 0.1
+        self.backoff_max = 300
+        self.boost_factor = 0.2
+        self.min_interval = 1
+        self.thresholds = {}
+
+        self._entries = {}
+        self._heap = []
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def init_app(self, app):
+        config = app.config
+        self.interval = config.get('COLLECTOR_INTERVAL', self.interval)
+        self.jitter = config.get('SCHEDULER_JITTER', self.jitter)
+        self.backoff_max = config.get('SCHEDULER_BACKOFF_MAX', self.backoff_max)
+        self.boost_factor = config.get('SCHEDULER_BOOST_FACTOR', self.boost_factor)
+        self.min_interval = config.get('SCHEDULER_MIN_INTERVAL', self.min_interval)
+        self.thresholds = dict(config.get('SCHEDULER_THRESHOLDS', self.thresholds))
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._heap = []
+
+    def _push(self, entry, due):
+        entry.due = due
+        entry.version += 1
+        heapq.heappush(self._heap, (due, entry.row[0], entry.version))
+
+    def intervals(self, entry):
+        """(normal, boosted) interval of an entry
+        """
+        interval = entry.row[4] or self.interval
+        boost = entry.row[5] or max(self.min_interval, interval * self.boost_factor)
+        return interval, min(interval, boost)
+
+    def _delay(self, entry):
+        """delay before the next probe of an entry, without jitter
+        """
+        interval, boost = self.intervals(entry)
+        if entry.failures:
+            return min(self.backoff_max, interval * 2 ** entry.failures)
+        return boost if entry.boosted else interval
+
+    def sync(self, rows=None, now=None):
+        """add new servers, apply changed columns and drop deleted ones
+
+        a new server is first due at a random point of its interval.
+
+        Args:
+            rows (list): tuples of COLUMNS, queried when None
+
+        Returns:
+            list: ids of the servers which were dropped
+        """
+        if rows is None:
+            rows = Server.query.with_entities(*COLUMNS).all()
+        now = time.time() if now is None else now
+
+        with self._lock:
+            seen = set()
+            for row in rows:
+                row = tuple(row)
+                seen.add(row[0])
+                entry = self._entries.get(row[0])
+                if entry is not None and entry.row == row:
+                    continue
+                server = Server(id=row[0], host=row[1], port=row[2], password=row[3])
+                if entry is None:
+                    entry = self._entries[row[0]] = Entry(server, row)
+                    self._push(entry, now + self._random.uniform(0, self.intervals(entry)[0]))
+                    continue
+                entry.server, entry.row = server, row
+                if not entry.in_flight:
+                    # a shorter interval applies at once
+                    self._push(entry, min(entry.due, now + self.intervals(entry)[0]))
+
+            removed = [server_id for server_id in self._entries if server_id not in seen]
+            for server_id in removed:
+                del self._entries[server_id]
+            return removed
+
+    def due(self, now=None, limit=None):
+        """pop the servers whose probe is due, marking them in flight
+        """
+        now = time.time() if now is None else now
+        servers = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, server_id, version = heapq.heappop(self._heap)
+                entry = self._entries.get(server_id)
+                # deleted servers and rescheduled entries leave stale items
+                if entry is None or entry.version != version or entry.in_flight:
+                    continue
+                entry.in_flight = True
+                servers.append(entry.server)
+                if limit is not None and len(servers) >= limit:
+                    break
+        return servers
+
+    def next_due(self):
+        """time of the earliest due probe, None when nothing is scheduled
+        """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def lag(self, now=None):
+        """seconds the most overdue probe waits past its due time
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            overdue = [now - entry.due for entry in self._entries.values()
+                       if entry.in_flight or entry.due <= now]
+        return max(overdue) if overdue else 0
+
+    def boosted(self, info):
+        return any(info.get(name, 0) >= threshold for name, threshold in self.thresholds.items()
+                   if isinstance(info.get(name, 0), (int, float)))
+
+    def complete(self, server_id, ok, info=None, now=None):
+        """reschedule a server after its probe
+
+        Args:
+            ok (bool): False when the probe failed
+            info (dict): INFO of a successful probe, checked against
+                thresholds, None keeps the current boost
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(server_id)
+            if entry is None:
+                return None
+            entry.in_flight = False
+            entry.skipped = 0
+            if not ok:
+                entry.failures += 1
+            else:
+                entry.failures = 0
+                if info is not None:
+                    entry.boosted = self.boosted(info)
+            delay = self._delay(entry) * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._push(entry, now + delay)
+            return delay
+
+    def skip(self, server_id, now=None):
+        """reschedule a server whose due probe was not sent
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(server_id)
+            if entry is None:
+                return None
+            entry.in_flight = False
+            entry.skipped += 1
+            delay = self._delay(entry) * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._push(entry, now + delay)
+            return delay
+
+    def _effective(self, entry):
+        return self._delay(entry) * (1 + entry.skipped) * (1 + self.jitter)
+
+    def effective_intervals(self):
+        """longest time between two samples of every server as scheduled
+        now, with its backoff, boost, skipped probes and jitter
+
+        Returns:
+            dict: seconds by server id
+        """
+        with self._lock:
+            return {server_id: self._effective(entry)
+                    for server_id, entry in self._entries.items()}
+
+    def effective_interval(self, server_id):
+        """see effective_intervals, None for a server which is not scheduled
+        """
+        with self._lock:
+            entry = self._entries.get(server_id)
+            return None if entry is None else self._effective(entry)
+
+    def state(self, server_id):
+        """schedule of a server: due, failures and boosted
+        """
+        entry = self._entries.get(server_id)
+        if entry is None:
+            return None
+        return {'due': entry.due, 'failures': entry.failures, 'boosted': entry.boosted,
+                'interval': self.intervals(entry)[0]}
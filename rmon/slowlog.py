@@ -0,0 +1,253 @@
+""" rmon.slowlog
+incremental SLOWLOG and LATENCY aggregation per server and across servers
+"""
+
+import threading
+import time
+from functools import partial
+
+from redis import RedisError
+
+from rmon.common.clients import clients
+from rmon.common.fanout import fan_out
+from rmon.common.rest import RestException
+from rmon.common.sketches import CountMinSketch, SpaceSaving
+from rmon.common.snapshot import _decode, _latency
+from rmon.keyspace import key_pattern
+
+# commands whose first argument is a subcommand rather than a key
+SUBCOMMANDS = {'CLIENT', 'CLUSTER', 'COMMAND', 'CONFIG', 'DEBUG', 'LATENCY', 'MEMORY',
+               'MODULE', 'OBJECT', 'PUBSUB', 'SCRIPT', 'SLOWLOG', 'XGROUP', 'XINFO'}
+# commands without key arguments
+KEYLESS = {'AUTH', 'BGREWRITEAOF', 'BGSAVE', 'DBSIZE', 'ECHO', 'EVAL', 'EVALSHA', 'EXEC',
+           'FLUSHALL', 'FLUSHDB', 'INFO', 'KEYS', 'LASTSAVE', 'MULTI', 'PING', 'PUBLISH',
+           'RANDOMKEY', 'SAVE', 'SCAN', 'SELECT', 'SHUTDOWN', 'TIME', 'WAIT'}
+
+
+def command_template(command):
+    """normalize a slowlog command into a template shared by its calls
+
+    only the command, its subcommand and the pattern of its first key
+    are kept, argument values never are:
+    `HSET user:1024:profile name x` -> `HSET user:*:profile ...`.
+    """
+    args = _decode(command).split()
+    if not args:
+        return ''
+    template = [args[0].upper()]
+    rest = args[1:]
+    if rest and template[0] in SUBCOMMANDS:
+        template.append(rest.pop(0).upper())
+    elif rest and template[0] not in KEYLESS:
+        template.append(':'.join(key_pattern(rest.pop(0))))
+    if rest:
+        template.append('...')
+    return ' '.join(template)
+
+
+class ServerSlowlog:
+    """slow command templates of one server since the cursor was set
+    """
+
+    def __init__(self, capacity):
+        self.cursor = None
+        self.fetched_at = None
+        self.entries = 0
+        self.missed = 0
+        self.latency = []
+        self.patterns = SpaceSaving(capacity)
+
+
+class SlowlogAggregator:
+    """fetch only the slowlog entries newer than the last seen id
+
+    `SLOWLOG GET 1` tells the id of the newest entry, so only the
+    entries added since the previous fetch are transferred, at most
+    `max_fetch` of them. templates are aggregated by total duration per
+    server and across servers in SpaceSaving counters, and a count-min
+    sketch estimates the total duration of any template of the fleet.
+    """
+
+    def __init__(self, app=None):
+        self.fetch_interval = 60
+        self.max_fetch = 128
+        self.capacity = 64
+        self.fleet_capacity = 256
+        self.timeout = 2
+        self.deadline = 10
+        self.workers = 32
+
+        self._servers = {}
+        self._fleet = SpaceSaving(self.fleet_capacity)
+        self._sketch = CountMinSketch()
+        self._lock = threading.RLock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.fetch_interval = config.get('SLOWLOG_FETCH_INTERVAL', self.fetch_interval)
+        self.max_fetch = config.get('SLOWLOG_MAX_FETCH', self.max_fetch)
+        self.capacity = config.get('SLOWLOG_CAPACITY', self.capacity)
+        self.fleet_capacity = config.get('SLOWLOG_FLEET_CAPACITY', self.fleet_capacity)
+        self.timeout = config.get('HEALTH_CHECK_TIMEOUT', self.timeout)
+        self.deadline = config.get('HEALTH_CHECK_DEADLINE', self.deadline)
+        self.workers = config.get('HEALTH_CHECK_WORKERS', self.workers)
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._servers.clear()
+            self._fleet = SpaceSaving(self.fleet_capacity)
+            self._sketch = CountMinSketch()
+
+    def get(self, server_id):
+        return self._servers.get(server_id)
+
+    def stale(self, server_id, now=None):
+        state = self._servers.get(server_id)
+        now = time.time() if now is None else now
+        return state is None or state.fetched_at is None or \
+            now - state.fetched_at >= self.fetch_interval
+
+    def fetch(self, server, timeout=None):
+        """transfer and aggregate the new slowlog entries of server
+
+        Args:
+            timeout (float): socket timeout, see RedisClients.get
+
+        Returns:
+            int: number of new entries
+        """
+        client = clients.get(server, timeout)
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.slowlog_get(1)
+            pipe.execute_command('LATENCY', 'LATEST')
+            newest, latency = pipe.execute(raise_on_error=False)
+            if isinstance(newest, RedisError):
+                raise newest
+
+            with self._lock:
+                state = self._servers.get(server.id)
+                if state is None:
+                    state = self._servers[server.id] = ServerSlowlog(self.capacity)
+            newest_id = newest[0]['id'] if newest else None
+
+            new = 0
+            if newest_id is not None:
+                # ids only grow, even across SLOWLOG RESET, a smaller one means a restart
+                reset = state.cursor is None or newest_id < state.cursor
+                pending = newest_id + 1 if reset else newest_id - state.cursor
+                if pending > 0:
+                    entries = newest if pending == 1 else client.slowlog_get(
+                        min(pending, self.max_fetch))
+                    entries = [entry for entry in entries
+                               if reset or entry['id'] > state.cursor]
+                    self._aggregate(server.id, state, entries)
+                    new = len(entries)
+                    if state.cursor is not None:
+                        state.missed += max(0, pending - new)
+        except RedisError:
+            raise RestException(400, 'cannot connect to redis server {}'.format(server.host))
+
+        with self._lock:
+            if newest_id is not None:
+                state.cursor = newest_id
+            state.fetched_at = time.time()
+            if not isinstance(latency, RedisError):
+                state.latency = _latency(latency)
+        return new
+
+    def _aggregate(self, server_id, state, entries):
+        with self._lock:
+            for entry in entries:
+                template = command_template(entry['command'])
+                duration = entry['duration']
+                state.entries += 1
+                state.patterns.add(template, duration, count=1, total=duration, max=duration,
+                                   last_seen=entry['start_time'])
+                item = self._fleet.add(template, duration, count=1, total=duration)
+                if duration >= item.get('max', 0):
+                    item['max'] = duration
+                    item['max_server_id'] = server_id
+                self._sketch.add(template, duration)
+
+    def refresh(self, servers, force=False):
+        """fetch the stale servers concurrently within the deadline
+
+        Returns:
+            dict: server id -> error message of the fetches which failed
+        """
+        servers = [server for server in servers if force or self.stale(server.id)]
+        errors = {}
+        if not servers:
+            return errors
+        fetch = partial(self.fetch, timeout=self.timeout)
+        for server, status, value, _ in fan_out(servers, fetch, self.timeout, self.deadline,
+                                                self.workers):
+            if status == 'error':
+                errors[server.id] = getattr(value, 'message', None) or str(value)
+            elif status == 'timeout':
+                errors[server.id] = 'timeout'
+        return errors
+
+    @staticmethod
+    def _pattern(template, item):
+        return {'template': template, 'count': item['count'], 'total_us': item['total'],
+                'max_us': item['max'], 'error_us': item['error']}
+
+    def report(self, server_id, limit=20):
+        """slowest templates of one server, None before its first fetch
+        """
+        with self._lock:
+            state = self._servers.get(server_id)
+            if state is None:
+                return None
+            patterns = []
+            for template, item in state.patterns.top(limit):
+                pattern = self._pattern(template, item)
+                pattern['last_seen'] = item.get('last_seen')
+                patterns.append(pattern)
+            return {'cursor': state.cursor, 'fetched_at': state.fetched_at,
+                    'entries': state.entries, 'missed': state.missed,
+                    'latency': state.latency, 'patterns': patterns}
+
+    def fleet_report(self, limit=20, template=None):
+        """slowest templates across every fetched server
+        """
+        with self._lock:
+            patterns = []
+            for key, item in self._fleet.top(limit):
+                pattern = self._pattern(key, item)
+                pattern['max_server_id'] = item.get('max_server_id')
+                patterns.append(pattern)
+            report = {'servers': len(self._servers), 'patterns': patterns}
+            if template is not None:
+                report['estimate'] = {'template': template,
+                                      'total_us': self._sketch.estimate(template)}
+            return report
+
+    def reset(self, server_id):
+        """clear the templates of one server
+
+        the fleet counters keep what was aggregated from it, so the last
+        seen id is kept too and the next fetch only aggregates newer
+        entries instead of counting the old ones twice.
+        """
+        with self._lock:
+            state = self._servers.get(server_id)
+            if state is not None:
+                cursor = state.cursor
+                state = self._servers[server_id] = ServerSlowlog(self.capacity)
+                state.cursor = cursor
+
+    def discard(self, server_id):
+        """forget a deleted server
+        """
+        with self._lock:
+            self._servers.pop(server_id, None)
+
+
+slowlogs = SlowlogAggregator()
@@ -0,0 +1,73 @@
+""" rmon.storage
+engine options of the inventory database
+"""
+
+import sqlite3
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from rmon import migrations
+
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy with pooled sqlite connections and schema migrations
+
+    a sqlite file is opened again on every checkout unless a pool size
+    is configured; with one, connections are kept in a pool shared by
+    the threads of the process and SQLITE_PRAGMAS run once per
+    connection instead of once per request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pragmas = ()
+
+    def init_app(self, app):
+        self.pragmas = tuple(app.config.get('SQLITE_PRAGMAS', ()))
+        super().init_app(app)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername != 'sqlite':
+            return
+        if options.get('poolclass') is StaticPool:
+            # one connection shared by the whole process, nothing to size
+            for name in POOL_OPTIONS:
+                options.pop(name, None)
+        elif options.get('poolclass') is None:
+            # sqlalchemy does not pool sqlite files by default, a pooled
+            # connection is used by whichever thread checks it out
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def upgrade(self, target=None, app=None):
+        """apply the pending migrations, see rmon.migrations.upgrade
+        """
+        return migrations.upgrade(self.get_engine(self.get_app(app)), target)
+
+    def schema_version(self, app=None):
+        """return (current version, pending migrations)
+        """
+        engine = self.get_engine(self.get_app(app))
+        with engine.connect() as connection:
+            version = migrations.current_version(connection)
+        return version, [migration for migration in migrations.MIGRATIONS
+                         if migration.VERSION > version]
+
+
+db = Database()
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in db.pragmas:
+        cursor.execute('PRAGMA {}={}'.format(name, value))
+    cursor.close()
@@ -0,0 +1,158 @@
+""" rmon.stream
+fan-out of collected samples to streaming subscribers
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from rmon.collector import collector
+from rmon.models import Server
+
+logger = logging.getLogger(__name__)
+
+# seconds between reads of the shared store by a following hub
+FOLLOW_INTERVAL = 0.5
+
+
+class Subscription:
+    """bounded queue of samples for one viewer
+
+    when the viewer reads slower than samples arrive the oldest samples
+    are dropped, so a slow client never blocks the publisher nor grows
+    memory.
+    """
+
+    def __init__(self, server_ids, size):
+        self.server_ids = set(server_ids)
+        self.dropped = 0
+        self._queue = deque(maxlen=size)
+        self._ready = threading.Condition()
+
+    def put(self, message):
+        with self._ready:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append(message)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """return pending messages, waiting up to timeout seconds for one
+        """
+        with self._ready:
+            if not self._queue:
+                self._ready.wait(timeout)
+            messages = list(self._queue)
+            self._queue.clear()
+            return messages
+
+
+class StreamHub:
+    """one probe per server and interval shared by every subscriber
+
+    samples recorded by the collector are pushed to subscribers. when the
+    background collector is not running the hub polls the subscribed
+    servers itself, once per interval however many viewers there are.
+    an API worker of the multi-process mode follows the shared store
+    instead, samples are recorded by the collector process.
+    """
+
+    def __init__(self, collector, app=None):
+        self.collector = collector
+        self.app = None
+        self.queue_size = 16
+        self.heartbeat = 15
+
+        self._subscriptions = {}
+        # server id -> timestamp of the last sample followed in the shared store
+        self._followed = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        collector.listeners.append(self.publish)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.queue_size = app.config.get('STREAM_QUEUE_SIZE', self.queue_size)
+        self.heartbeat = app.config.get('STREAM_HEARTBEAT', self.heartbeat)
+
+    def subscribe(self, server_ids):
+        subscription = Subscription(server_ids, self.queue_size)
+        with self._lock:
+            for server_id in subscription.server_ids:
+                self._subscriptions.setdefault(server_id, set()).add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rmon-stream')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for server_id in subscription.server_ids:
+                subscribers = self._subscriptions.get(server_id)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[server_id]
+                    self._followed.pop(server_id, None)
+
+    def subscribed(self):
+        with self._lock:
+            return list(self._subscriptions)
+
+    def _subscribers(self, server_id):
+        with self._lock:
+            return list(self._subscriptions.get(server_id, ()))
+
+    def publish(self, server_id, timestamp, info):
+        """collector listener, queue the sample for every subscriber
+        """
+        subscribers = self._subscribers(server_id)
+        if not subscribers:
+            return
+        message = (server_id, timestamp, info, self.collector.store.rates(server_id))
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def _follow(self, server_ids):
+        """publish the samples the collector process shared since the last call
+        """
+        store = self.collector.store
+        for server_id in server_ids:
+            sample = store.latest(server_id)
+            if sample is None or sample[0] <= self._followed.get(server_id, 0):
+                continue
+            self._followed[server_id] = sample[0]
+            message = (server_id, sample[0], sample[1], store.rates(server_id))
+            for subscription in self._subscribers(server_id):
+                subscription.put(message)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                server_ids = list(self._subscriptions)
+                if not server_ids:
+                    self._thread = None
+                    return
+
+            started = time.time()
+            if self.collector.store.shared:
+                self._follow(server_ids)
+                time.sleep(FOLLOW_INTERVAL)
+                continue
+            if self.app is not None and not self.collector.running:
+                try:
+                    with self.app.app_context():
+                        self.collector.collect(Server.filtered(ids=server_ids).all())
+                except Exception:
+                    logger.exception('stream polling failed')
+            time.sleep(max(0.1, self.collector.interval - (time.time() - started)))
+
+
+hub = StreamHub(collector)
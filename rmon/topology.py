@@ -0,0 +1,309 @@
+""" rmon.topology
+cluster and replication topology discovered from a seed server
+"""
+
+import logging
+import threading
+import time
+
+from redis import RedisError
+
+from rmon.collector import collector
+from rmon.common.clients import clients
+from rmon.common.rest import RestException
+from rmon.keyspace import Target
+from rmon.models import db, discards, ServerNode
+
+logger = logging.getLogger(__name__)
+
+# columns of ServerNode refreshed from a discovery
+NODE_FIELDS = ('node_id', 'role', 'master', 'slots', 'flags', 'link_state')
+
+
+def parse_cluster_nodes(text, seed_host=None):
+    """parse the reply of CLUSTER NODES
+
+    Returns:
+        list: node dicts, `master` is the host:port of a replica's master
+    """
+    nodes = []
+    addresses = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 8:
+            continue
+        node_id, address, flags, master_id, _, _, _, link_state = parts[:8]
+        # ip:port@cport[,hostname]
+        host, _, port = address.split('@')[0].split(',')[0].rpartition(':')
+        flags = flags.split(',')
+        if not host and 'myself' in flags:
+            # a node which has not learned its own address yet
+            host = seed_host
+        if 'master' in flags:
+            role = 'master'
+        elif 'slave' in flags:
+            role = 'replica'
+        else:
+            role = 'unknown'
+        addresses[node_id] = '{}:{}'.format(host, port)
+        nodes.append({
+            'node_id': node_id,
+            'host': host,
+            'port': int(port),
+            'role': role,
+            'master': None if master_id == '-' else master_id,
+            'slots': ' '.join(parts[8:]) or None,
+            'flags': ','.join(flag for flag in flags if flag != 'myself'),
+            'link_state': link_state,
+        })
+
+    for node in nodes:
+        if node['master'] is not None:
+            node['master'] = addresses.get(node['master'])
+    return nodes
+
+
+def replicas_of(info):
+    """replicas listed by the INFO replication of a master
+
+    Returns:
+        dict: host:port -> {'state', 'offset', 'lag', 'offset_lag'}
+    """
+    offset = info.get('master_repl_offset', 0)
+    replicas = {}
+    for index in range(info.get('connected_slaves', 0)):
+        replica = info.get('slave{}'.format(index))
+        if not isinstance(replica, dict):
+            continue
+        replicas['{}:{}'.format(replica.get('ip'), replica.get('port'))] = {
+            'state': replica.get('state'),
+            'offset': replica.get('offset'),
+            'lag': replica.get('lag'),
+            'offset_lag': offset - replica.get('offset', 0),
+        }
+    return replicas
+
+
+def signature(info):
+    """what the topology depends on in an INFO reply
+    """
+    return (info.get('role'), info.get('master_host'), info.get('master_port'),
+            tuple(sorted(replicas_of(info))))
+
+
+def _replication_nodes(host, port, info):
+    """nodes seen by the INFO replication of one master
+    """
+    address = '{}:{}'.format(host, port)
+    nodes = [{'host': host, 'port': port, 'role': 'master', 'master': None,
+              'link_state': 'connected'}]
+    for replica, state in sorted(replicas_of(info).items()):
+        replica_host, _, replica_port = replica.rpartition(':')
+        nodes.append({'host': replica_host, 'port': int(replica_port), 'role': 'replica',
+                      'master': address, 'link_state': state['state']})
+    return nodes
+
+
+def discover(server):
+    """return (mode, nodes, info) of the topology server belongs to
+
+    mode is 'cluster', 'replication' or 'standalone'. a replica seed is
+    followed to its master, whose single INFO lists every replica.
+    """
+    client = server.redis
+    port = int(server.port or 6379)
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.info('replication')
+        pipe.info('cluster')
+        info, cluster = pipe.execute()
+
+        if cluster.get('cluster_enabled'):
+            text = client.execute_command('CLUSTER', 'NODES')
+            if isinstance(text, bytes):
+                text = text.decode()
+            return 'cluster', parse_cluster_nodes(text, server.host), info
+    except RedisError:
+        raise RestException(400, 'cannot connect to redis server {}'.format(server.host))
+
+    if info.get('role') == 'master':
+        nodes = _replication_nodes(server.host, port, info)
+        return ('replication' if len(nodes) > 1 else 'standalone'), nodes, info
+
+    master_host, master_port = info.get('master_host'), info.get('master_port')
+    try:
+        master = clients.get(Target(None, master_host, master_port, server.password))
+        nodes = _replication_nodes(master_host, master_port, master.info('replication'))
+    except RedisError as e:
+        logger.warning('cannot reach master %s:%s of %s: %s', master_host, master_port,
+                       server.host, e)
+        nodes = [{'host': master_host, 'port': master_port, 'role': 'master', 'master': None,
+                  'link_state': 'disconnected'}]
+    if not any(node['host'] == server.host and node['port'] == port for node in nodes):
+        nodes.append({'host': server.host, 'port': port, 'role': 'replica',
+                      'master': '{}:{}'.format(master_host, master_port),
+                      'link_state': info.get('master_link_status')})
+    return 'replication', nodes, info
+
+
+class Topology:
+    """discovered nodes of every seed server and the replica state
+    reported by masters
+
+    while the sample of its master is fresh, the collector only probes
+    a registered replica every `replica_probe_every` times it is due,
+    the lag of replicas is read from the master's INFO in between.
+    """
+
+    def __init__(self, collector, app=None):
+        self.collector = collector
+        self.refresh_interval = 300
+        self.replica_probe_every = 6
+
+        # master server id -> replicas_of() of its latest sample
+        self._replicas = {}
+        # replica server id -> probes skipped in a row
+        self._skipped = {}
+        # server id -> (signature at refresh, refresh time)
+        self._refreshed = {}
+        self._signatures = {}
+        self._lock = threading.Lock()
+
+        collector.listeners.append(self.on_sample)
+        collector.filters.append(self.narrow)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.refresh_interval = config.get('TOPOLOGY_REFRESH_INTERVAL', self.refresh_interval)
+        self.replica_probe_every = config.get('TOPOLOGY_REPLICA_PROBE_EVERY',
+                                              self.replica_probe_every)
+
+    def on_sample(self, server_id, timestamp, info):
+        """collector listener, keep the replica state and topology signature
+        """
+        with self._lock:
+            self._signatures[server_id] = signature(info)
+            if info.get('role') == 'master' and info.get('connected_slaves'):
+                self._replicas[server_id] = replicas_of(info)
+            else:
+                self._replicas.pop(server_id, None)
+
+    def replicas(self, server_id):
+        """replica state from the latest sample of a master, {} if none
+        """
+        return self._replicas.get(server_id, {})
+
+    def replica_state(self, address):
+        """state of the replica at host:port reported by any collected master
+        """
+        with self._lock:
+            for replicas in self._replicas.values():
+                state = replicas.get(address)
+                if state is not None:
+                    return state
+        return None
+
+    def stale(self, server_id):
+        """whether the nodes of server_id should be discovered again
+        """
+        refreshed = self._refreshed.get(server_id)
+        if refreshed is None:
+            return True
+        current = self._signatures.get(server_id)
+        return time.time() - refreshed[1] >= self.refresh_interval or \
+            (current is not None and current != refreshed[0])
+
+    def refresh(self, server):
+        """discover the nodes of server and store what changed
+
+        Returns:
+            dict: the number of nodes added, updated and removed
+        """
+        _, nodes, info = discover(server)
+
+        existing = {(node.host, node.port): node for node in server.nodes}
+        changes = {'added': 0, 'updated': 0, 'removed': 0}
+        for data in nodes:
+            node = existing.pop((data['host'], data['port']), None)
+            if node is None:
+                server.nodes.append(ServerNode(**data))
+                changes['added'] += 1
+                continue
+            changed = False
+            for field in NODE_FIELDS:
+                value = data.get(field)
+                if getattr(node, field) != value:
+                    setattr(node, field, value)
+                    changed = True
+            changes['updated'] += changed
+        for node in existing.values():
+            server.nodes.remove(node)
+            changes['removed'] += 1
+
+        if changes['added'] or changes['updated'] or changes['removed']:
+            db.session.commit()
+
+        with self._lock:
+            self._signatures[server.id] = signature(info)
+            self._refreshed[server.id] = (signature(info), time.time())
+        return changes
+
+    @staticmethod
+    def mode(server):
+        """mode of the stored nodes of server
+        """
+        if any(node.node_id is not None for node in server.nodes):
+            return 'cluster'
+        return 'replication' if len(server.nodes) > 1 else 'standalone'
+
+    def _fresh(self, master_id, now):
+        """whether the latest sample of a master is younger than its interval
+        """
+        sample = self.collector.store.latest(master_id)
+        if sample is None:
+            return False
+        state = self.collector.scheduler.state(master_id)
+        # the normal interval, a master in backoff has no fresh sample
+        interval = self.collector.interval if state is None else state['interval']
+        return now - sample[0] < interval * (1 + self.collector.scheduler.jitter)
+
+    def narrow(self, servers):
+        """collector filter, skip a replica while its master has a fresh
+        sample or is probed in the same batch, at most
+        `replica_probe_every` - 1 times in a row
+        """
+        if self.replica_probe_every <= 1:
+            return servers
+
+        now = time.time()
+        fresh = {server.id: True for server in servers}
+        probed = []
+        with self._lock:
+            masters = {address: master_id for master_id, state in self._replicas.items()
+                       for address in state}
+            for server in servers:
+                master_id = masters.get('{}:{}'.format(server.host, server.port or 6379))
+                if master_id is not None and master_id != server.id:
+                    if master_id not in fresh:
+                        fresh[master_id] = self._fresh(master_id, now)
+                    skipped = self._skipped.get(server.id, 0)
+                    if fresh[master_id] and skipped + 1 < self.replica_probe_every:
+                        self._skipped[server.id] = skipped + 1
+                        continue
+                self._skipped.pop(server.id, None)
+                probed.append(server)
+        return probed
+
+    def discard(self, server_id):
+        with self._lock:
+            self._replicas.pop(server_id, None)
+            self._skipped.pop(server_id, None)
+            self._refreshed.pop(server_id, None)
+            self._signatures.pop(server_id, None)
+
+
+topology = Topology(collector)
+discards.append(topology.discard)
@@ -0,0 +1,83 @@
+""" rmon.views.alert
+alert rules and active alerts
+"""
+
+from flask import request, g
+
+from rmon.alerts import alerts
+from rmon.common.decorators import ObjectMustExist
+from rmon.common.rest import RestView, RestException
+from rmon.models import AlertRule, AlertRuleSchema
+
+
+class AlertRuleList(RestView):
+    """ 告警规则列表
+    """
+
+    def get(self):
+        """获取告警规则
+
+        :query server_id: 只返回该服务器的规则和对所有服务器生效的规则
+        """
+        query = AlertRule.query
+        server_id = request.args.get('server_id', type=int)
+        if server_id is not None:
+            query = query.filter((AlertRule.server_id == server_id) |
+                                 (AlertRule.server_id.is_(None)))
+        return AlertRuleSchema().dump(query.order_by(AlertRule.id).all(), many=True).data
+
+    def post(self):
+        """创建告警规则，条件可以以 `for 5m` 结尾表示持续时间
+        """
+        rule, errors = AlertRuleSchema().load(request.get_json())
+        if errors:
+            return errors, 400
+        rule.save()
+        alerts.reload()
+        return {'ok': True, 'id': rule.id}, 201
+
+
+class AlertRuleDetail(RestView):
+    """ 告警规则
+    """
+
+    method_decorators = (ObjectMustExist(AlertRule),)
+
+    def get(self, object_id):
+        """获取告警规则详情
+        """
+        return AlertRuleSchema().dump(g.instance).data
+
+    def put(self, object_id):
+        """更新告警规则，规则的条件改变时已触发的告警恢复
+        """
+        schema = AlertRuleSchema(context={'instance': g.instance})
+        rule, errors = schema.load(request.get_json(), partial=True)
+        if errors:
+            return errors, 400
+        rule.save()
+        alerts.reload()
+        return {'ok': True}
+
+    def delete(self, object_id):
+        """删除告警规则
+        """
+        g.instance.delete()
+        alerts.reload()
+        return {'ok': True}
+
+
+class AlertList(RestView):
+    """ 当前的告警
+    """
+
+    def get(self):
+        """获取等待中和已触发的告警，多进程模式下读取采集进程共享的告警
+
+        :query server_id: 服务器 id
+        :query state: pending 或 firing
+        """
+        state = request.args.get('state')
+        if state not in (None, 'pending', 'firing'):
+            raise RestException(400, 'invalid state {}'.format(state))
+        return alerts.active(request.args.get('server_id', type=int), state)
@@ -0,0 +1,123 @@
+"""rmon.views.metrics
+Prometheus exposition of rmon's own metrics and of the monitored servers
+"""
+
+from flask import current_app, request, Response
+
+from rmon.collector import collector
+from rmon.common.aggregate import TAG_PREFIX, Columns, parse_stats
+from rmon.common.rest import RestException, RestView
+from rmon.exporter import exporter
+from rmon.instrument import instrument
+from rmon.models import Server, Tag, server_tag
+from rmon.views.server import parse_ids, parse_tags
+
+OPENMETRICS = 'application/openmetrics-text'
+
+
+class MetricsView(RestView):
+    """metrics of rmon in the Prometheus text format
+    """
+
+    def get(self):
+        """请求延迟、Redis 命令延迟、SQL 查询、连接池和采集延迟指标
+        """
+        return Response(instrument.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ProfileView(RestView):
+    """stacks sampled by the profiler, in the collapsed flame graph format
+    """
+
+    def get(self):
+        """需要开启 PROFILER_ENABLED
+        """
+        if instrument.profiler is None:
+            raise RestException(404, 'profiler is not enabled')
+        return Response(instrument.profiler.collapsed(), mimetype='text/plain; charset=utf-8')
+
+    def delete(self):
+        """清空已采样的调用栈
+        """
+        if instrument.profiler is None:
+            raise RestException(404, 'profiler is not enabled')
+        instrument.profiler.reset()
+        return {'ok': True}
+
+
+class FleetMetrics(RestView):
+    """latest collected INFO of every server in the Prometheus text format
+    """
+
+    def get(self):
+        """由采集器缓存的样本生成，不访问 Redis
+
+        支持 name, host, port, tags 过滤，Accept 为 application/openmetrics-text
+        时返回 OpenMetrics 格式
+        """
+        query = Server.filtered(name=request.args.get('name'),
+                                host=request.args.get('host'),
+                                port=request.args.get('port', type=int),
+                                tags=parse_tags(request.args.get('tags')))
+        servers = query.with_entities(Server.id, Server.name, Server.host, Server.port) \
+            .order_by(Server.id)
+
+        if request.accept_mimetypes.best_match((OPENMETRICS, 'text/plain')) == OPENMETRICS:
+            return Response(exporter.render(servers, openmetrics=True),
+                            mimetype=OPENMETRICS + '; version=1.0.0; charset=utf-8')
+        return Response(exporter.render(servers),
+                        mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+class FleetAggregate(RestView):
+    """statistics of INFO fields across many servers
+    """
+
+    def get(self):
+        """由采集器缓存的样本计算，不访问 Redis，没有样本的服务器在 missing 中列出
+
+        :query ids: 逗号分隔的服务器 id
+        :query name: 服务器名称，支持 * 通配
+        :query tags: 标签选择器，如 env=prod,role=cache
+        :query fields: 逗号分隔的字段，如 used_memory, db0.keys, rate.total_commands_processed
+        :query stats: 逗号分隔的统计量 count, sum, avg, min, max, p50, p99 ...
+        :query group_by: 按 INFO 字段（如 role, redis_version）、host, port 或标签（如 tag.env）分组
+        :query matrix: 为 1 时同时返回每个服务器的取值
+        """
+        fields = [field for field in request.args.get('fields', '').split(',') if field]
+        if not fields:
+            raise RestException(400, 'fields is required')
+        if len(fields) > current_app.config['AGGREGATE_MAX_FIELDS']:
+            raise RestException(400, 'at most {} fields'.format(
+                current_app.config['AGGREGATE_MAX_FIELDS']))
+        try:
+            stats = parse_stats(request.args.get('stats', 'count,sum,avg,max'))
+        except ValueError as e:
+            raise RestException(400, str(e))
+        group_by = request.args.get('group_by') or None
+
+        query = Server.filtered(ids=parse_ids(request.args.get('ids')),
+                                name=request.args.get('name'),
+                                tags=parse_tags(request.args.get('tags')))
+        servers = query.with_entities(Server.id, Server.name, Server.host, Server.port) \
+            .order_by(Server.id)
+
+        labels = None
+        if group_by is not None and group_by.startswith(TAG_PREFIX):
+            # value of the tag of every selected server in one query
+            labels = dict(query.join(server_tag, server_tag.c.server_id == Server.id)
+                          .join(Tag, Tag.id == server_tag.c.tag_id)
+                          .filter(Tag.key == group_by[len(TAG_PREFIX):])
+                          .with_entities(Server.id, Tag.value))
+        columns = Columns(servers, fields, collector.store, group_by, labels)
+
+        result = {'servers': len(columns.ids) + len(columns.missing),
+                  'missing': columns.missing}
+        if group_by is None:
+            result['summary'] = columns.summary(stats)
+        else:
+            result['group_by'] = group_by
+            result['groups'] = columns.groups(stats)
+        if request.args.get('matrix', 0, type=int):
+            result['matrix'] = columns.matrix()
+        return result
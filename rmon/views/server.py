@@ -1,8 +1,60 @@
-from flask import request, g
+import hashlib
+import json
+import time
+from functools import partial
 
+from flask import request, g, current_app, Response, url_for
+from flask.json import dumps
+from sqlalchemy import func
+from sqlalchemy.orm import load_only
+
+from rmon.collector import collector
 from rmon.common.decorators import ObjectMustExist
-from rmon.common.rest import RestView
-from rmon.models import Server, ServerSchema
+from rmon.common.fanout import fan_out
+from rmon.common.labels import parse_selector
+from rmon.common.rest import RestView, RestException
+from rmon.common.snapshot import parse_sections
+from rmon.console import CommandSession, parse_commands
+from rmon.history import history
+from rmon.inventory import import_servers, delete_servers, export_servers
+from rmon.keyspace import analyzers
+from rmon.models import Server, ServerNodeSchema, ServerSchema, server_schema
+from rmon.slowlog import slowlogs
+from rmon.topology import topology
+
+
+def parse_ids(value):
+    """parse a comma separated list of ids from a query argument
+    """
+    if value is None:
+        return None
+    try:
+        return [int(item) for item in value.split(',') if item]
+    except ValueError:
+        raise RestException(400, 'invalid ids {}'.format(value))
+
+
+def parse_tags(value):
+    """parse the `tags=` selector of a query argument, see parse_selector
+    """
+    if value is None:
+        return None
+    try:
+        return parse_selector(value)
+    except ValueError as e:
+        raise RestException(400, str(e))
+
+
+def parse_fields(value):
+    """parse the `fields=` projection of server lists
+    """
+    if value is None:
+        return None
+    fields = [field for field in value.split(',') if field]
+    for field in fields:
+        if field not in ServerSchema._declared_fields:
+            raise RestException(400, 'invalid field {}'.format(field))
+    return fields
 
 
 class ServerList(RestView):
@@ -10,11 +62,58 @@ class ServerList(RestView):
     """
 
     def get(self):
-        """获取 Redis 列表
+        """获取 Redis 列表，按 id 分页
+
+        :query cursor: 上一页最后一个服务器的 id
+        :query limit: 每页数量
+        :query name: 服务器名称，支持 * 通配
+        :query host: 服务器地址
+        :query port: 服务器端口
+        :query tags: 标签选择器，如 env=prod,role!=cache,team in (a,b),!legacy
+        :query fields: 逗号分隔的返回字段
+        :return:
+            查询成功 200：服务器列表，还有下一页时在 X-Next-Cursor 和 Link 头部给出游标
+            未修改 304：If-None-Match 与当前 ETag 相同
         """
-        servers = Server.query.all()
-        print(servers)
-        return ServerSchema().dump(servers, many=True).data
+        config = current_app.config
+        limit = request.args.get('limit', config['SERVER_LIST_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, config['SERVER_LIST_MAX_PAGE_SIZE']))
+        cursor = request.args.get('cursor', type=int)
+        fields = parse_fields(request.args.get('fields'))
+
+        query = Server.filtered(name=request.args.get('name'),
+                                host=request.args.get('host'),
+                                port=request.args.get('port', type=int),
+                                tags=parse_tags(request.args.get('tags')))
+
+        # the page changes only if a matching row is added, removed or updated
+        count, max_id, max_updated_at = query.with_entities(
+            func.count(Server.id), func.max(Server.id), func.max(Server.updated_at)).one()
+        etag = hashlib.sha1('{}|{}|{}|{}'.format(
+            count, max_id, max_updated_at, request.query_string).encode()).hexdigest()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        if cursor is not None:
+            query = query.filter(Server.id > cursor)
+        if fields is not None:
+            query = query.options(load_only(*set(fields) - {'tags'} | {'id'}))
+        servers = query.order_by(Server.id).limit(limit + 1).all()
+
+        headers = {'ETag': '"{}"'.format(etag)}
+        if len(servers) > limit:
+            servers = servers[:limit]
+            args = request.args.to_dict()
+            args['cursor'] = servers[-1].id
+            headers['X-Next-Cursor'] = str(servers[-1].id)
+            headers['Link'] = '<{}>; rel="next"'.format(url_for(request.endpoint, **args))
+        if fields is None or 'tags' in fields:
+            Server.preload_labels(servers)
+
+        schema = server_schema(fields)
+        return schema.dump(servers, many=True).data, 200, headers
 
     def post(self):
         """创建 Redis 服务器
@@ -28,6 +127,160 @@ class ServerList(RestView):
         return {'ok': True}, 201
 
 
+class ServerBulk(RestView):
+    """ 批量导入、删除和导出服务器
+    """
+
+    def get(self):
+        """以 NDJSON 流式导出服务器
+
+        :query ids: 逗号分隔的服务器 id
+        :query name: 服务器名称，支持 * 通配
+        :query host: 服务器地址
+        :query port: 服务器端口
+        :query tags: 标签选择器
+        """
+        app = current_app._get_current_object()
+        filters = {
+            'ids': parse_ids(request.args.get('ids')),
+            'name': request.args.get('name'),
+            'host': request.args.get('host'),
+            'port': request.args.get('port', type=int),
+            'tags': parse_tags(request.args.get('tags')),
+        }
+
+        def generate():
+            with app.app_context():
+                for line in export_servers(Server.filtered(**filters)):
+                    yield line
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    def post(self):
+        """在一个事务中批量创建或更新服务器
+
+        请求体为 JSON 数组或 NDJSON，带 id 的条目更新对应服务器，其余条目创建新服务器
+
+        :query ping: 为 0 时不检查服务器是否可以连接
+        """
+        config = current_app.config
+        items = self.load_items()
+        results = import_servers(items,
+                                 ping=request.args.get('ping', 1, type=int) != 0,
+                                 timeout=config['HEALTH_CHECK_TIMEOUT'],
+                                 deadline=config['BULK_PING_DEADLINE'],
+                                 workers=config['HEALTH_CHECK_WORKERS'])
+        return self.summary(results)
+
+    def delete(self):
+        """在一个事务中批量删除服务器，请求体为 {"ids": [...]} 或 {"tags": "env=test"}
+        """
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise RestException(400, 'ids is required')
+        if isinstance(data.get('tags'), str):
+            tags = parse_tags(data['tags'])
+            if not tags:
+                raise RestException(400, 'an empty selector would delete every server')
+            ids = [server_id for server_id, in Server.filtered(tags=tags)
+                   .with_entities(Server.id).order_by(Server.id)]
+            return self.summary(delete_servers(ids))
+        if not isinstance(data.get('ids'), list):
+            raise RestException(400, 'ids is required')
+        return self.summary(delete_servers(data['ids']))
+
+    @staticmethod
+    def load_items():
+        if request.mimetype == 'application/x-ndjson':
+            lines = request.get_data(as_text=True).splitlines()
+            try:
+                items = [json.loads(line) for line in lines if line.strip()]
+            except ValueError:
+                raise RestException(400, 'invalid NDJSON body')
+        else:
+            items = request.get_json(silent=True)
+
+        if not isinstance(items, list):
+            raise RestException(400, 'a list of servers is required')
+        if len(items) > current_app.config['BULK_MAX_ITEMS']:
+            raise RestException(400, 'at most {} servers per request'.format(
+                current_app.config['BULK_MAX_ITEMS']))
+        return items
+
+    @staticmethod
+    def summary(results):
+        failed = sum(1 for result in results if not result['ok'])
+        return {
+            'ok': failed == 0,
+            'total': len(results),
+            'failed': failed,
+            'results': results,
+        }
+
+
+class ServerHealth(RestView):
+    """ 并发检查所有服务器的状态
+    """
+
+    probes = {
+        'ping': lambda server, timeout: server.ping(timeout),
+        'info': lambda server, timeout: server.get_metrics(timeout),
+    }
+
+    def get(self):
+        """ping 或 INFO 探测服务器，结果以 NDJSON 逐行返回
+
+        :query ids: 逗号分隔的服务器 id
+        :query name: 服务器名称，支持 * 通配
+        :query tags: 标签选择器
+        :query mode: ping 或 info
+        :query timeout: 单个探测的超时时间（秒）
+        :query deadline: 全部探测的超时时间（秒）
+        """
+        config = current_app.config
+        mode = request.args.get('mode', 'ping')
+        if mode not in self.probes:
+            raise RestException(400, 'invalid mode {}'.format(mode))
+
+        timeout = request.args.get('timeout', config['HEALTH_CHECK_TIMEOUT'], type=float)
+        deadline = min(request.args.get('deadline', config['HEALTH_CHECK_DEADLINE'], type=float),
+                       config['HEALTH_CHECK_DEADLINE'])
+        servers = Server.filtered(ids=parse_ids(request.args.get('ids')),
+                                  name=request.args.get('name'),
+                                  tags=parse_tags(request.args.get('tags'))).all()
+
+        # a probe gives up with its socket when fan_out stops waiting for it
+        probe = partial(self.probes[mode], timeout=timeout)
+        workers = config['HEALTH_CHECK_WORKERS']
+
+        def generate():
+            started = time.time()
+            counts = {'ok': 0, 'error': 0, 'timeout': 0}
+            for server, status, value, elapsed in fan_out(servers, probe, timeout, deadline, workers):
+                counts[status] += 1
+                result = {
+                    'id': server.id,
+                    'name': server.name,
+                    'host': server.host,
+                    'port': server.port,
+                    'status': status,
+                    'latency': round(elapsed * 1000, 3),
+                }
+                if status == 'error':
+                    result['message'] = getattr(value, 'message', str(value))
+                elif status == 'ok' and mode == 'info':
+                    result['info'] = {key: value.get(key) for key in
+                                      ('redis_version', 'role', 'uptime_in_seconds',
+                                       'connected_clients', 'used_memory')}
+                yield dumps(result) + '\n'
+
+            counts['total'] = len(servers)
+            counts['elapsed'] = round((time.time() - started) * 1000, 3)
+            yield dumps({'summary': counts}) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+
 class ServerDetail(RestView):
     """ 服务器信息
     """
@@ -37,7 +290,7 @@ class ServerDetail(RestView):
     def get(self, object_id):
         """ 获取服务器详情
         """
-        data, _ = ServerSchema().dump(g.instance)
+        data, _ = server_schema().dump(g.instance)
         return data
 
     def put(self, object_id):
@@ -62,14 +315,262 @@ class ServerDetail(RestView):
 
 
 class ServerMetrics(RestView):
+    """ 服务器监控数据
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
 
     def get(self, object_id):
         """
         获取服务器数据
         :param object_id: SQLAlchemy 对象的查询 id
+        :query sections: 逗号分隔的 INFO 段或命令名，给出时在一次 pipeline 中实时获取
+        :query series: 逗号分隔的指标名，给出时返回历史数据
+        :query from: 历史数据起始时间戳
+        :query to: 历史数据结束时间戳
         :return:
             查询成功 200：返回一个字典对象，包含了信息
             服务器不存在 404：
-            服务器无法连接 500：
+            服务器无法连接 400：
         """
-        pass
+        sections = request.args.get('sections')
+        if sections is not None:
+            try:
+                sections = parse_sections(sections)
+            except ValueError as e:
+                raise RestException(400, str(e))
+            return g.instance.snapshot(sections or current_app.config['SNAPSHOT_SECTIONS'])
+
+        series = request.args.get('series')
+        if series is None:
+            return collector.latest(g.instance)
+
+        names = [name for name in series.split(',') if name] or None
+        start = request.args.get('from', type=float)
+        end = request.args.get('to', type=float)
+        return collector.store.history(object_id, start, end, names)
+
+
+class ServerRates(RestView):
+    """ 服务器计数器的变化速率
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def get(self, object_id):
+        """
+        获取最近两次采样之间的每秒速率、增量和命中率
+        :param object_id: SQLAlchemy 对象的查询 id
+        :return:
+            查询成功 200：返回 rates, deltas, hit_ratio 等，首次采样时 interval 为 null
+            服务器不存在 404：
+            服务器无法连接 400：
+        """
+        return collector.rates(g.instance)
+
+
+class ServerKeyspace(RestView):
+    """ 服务器键空间分析
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def get(self, object_id):
+        """获取分析进度和占用内存最多的键模式
+
+        :query top: 返回多少个键模式，默认 50
+        """
+        job = analyzers.get(object_id)
+        if job is None:
+            raise RestException(404, 'keyspace analysis doesn\'t exist')
+        return job.report(request.args.get('top', 50, type=int))
+
+    def post(self, object_id):
+        """开始或继续分析，请求体可以指定 sample_rate, scan_count, ops_fraction, restart
+        """
+        data = request.get_json(silent=True) or {}
+        options = {}
+        for key, cast in (('sample_rate', float), ('scan_count', int), ('ops_fraction', float)):
+            if key in data:
+                try:
+                    options[key] = cast(data[key])
+                except (TypeError, ValueError):
+                    raise RestException(400, 'invalid {}'.format(key))
+        if not 0 < options.get('sample_rate', 1) <= 1:
+            raise RestException(400, 'sample_rate must be in (0, 1]')
+        if not 0 < options.get('ops_fraction', 1) <= 1:
+            raise RestException(400, 'ops_fraction must be in (0, 1]')
+        max_count = current_app.config['KEYSPACE_MAX_SCAN_COUNT']
+        if not 1 <= options.get('scan_count', 1) <= max_count:
+            raise RestException(400, 'scan_count must be in [1, {}]'.format(max_count))
+
+        job = g.instance.analyze_keyspace(restart=bool(data.get('restart')), **options)
+        return job.report(0), 202
+
+    def delete(self, object_id):
+        """暂停分析，之后可以从当前游标继续
+        """
+        job = analyzers.stop(object_id)
+        if job is None:
+            raise RestException(404, 'keyspace analysis doesn\'t exist')
+        return job.report(0)
+
+
+class ServerHistory(RestView):
+    """ 服务器的历史监控数据
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def get(self, object_id):
+        """按时间范围和步长查询历史数据
+
+        :query from: 起始时间戳，默认一小时前
+        :query to: 结束时间戳，默认当前时间
+        :query step: 步长（秒），60 秒以上读取分钟汇总，3600 秒以上读取小时汇总
+        :query metrics: 逗号分隔的指标名，默认全部
+        """
+        config = current_app.config
+        end = request.args.get('to', time.time(), type=float)
+        start = request.args.get('from', end - 3600, type=float)
+        step = request.args.get('step', type=int)
+        if start > end:
+            raise RestException(400, 'from must not be later than to')
+        if step is not None and step <= 0:
+            raise RestException(400, 'step must be positive')
+        if (end - start) / (step or 1) > config['HISTORY_MAX_POINTS']:
+            raise RestException(400, 'too many points, increase step')
+
+        metrics = request.args.get('metrics')
+        names = [name for name in metrics.split(',') if name] if metrics else history.names()
+        return history.query(object_id, names, start, end, step)
+
+
+class ServerTopology(RestView):
+    """ 集群和主从拓扑
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def get(self, object_id):
+        """获取从该服务器发现的节点，拓扑过期时重新发现
+
+        从节点的 lag, offset_lag, state 来自主节点最近一次 INFO，无需探测从节点
+
+        :query refresh: 为 1 时强制重新发现
+        """
+        server = g.instance
+        changes = None
+        if request.args.get('refresh', 0, type=int) or topology.stale(server.id):
+            changes = topology.refresh(server)
+        return self.report(server, changes)
+
+    def post(self, object_id):
+        """立即重新发现拓扑，返回新增、更新和删除的节点数
+        """
+        return self.report(g.instance, topology.refresh(g.instance))
+
+    @staticmethod
+    def report(server, changes):
+        nodes = ServerNodeSchema().dump(server.nodes, many=True).data
+        for node in nodes:
+            if node['role'] == 'replica':
+                node['replication'] = topology.replica_state(
+                    '{}:{}'.format(node['host'], node['port']))
+        return {'mode': topology.mode(server), 'changes': changes, 'nodes': nodes}
+
+
+class ServerSlowlog(RestView):
+    """ 慢查询命令模板
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def get(self, object_id):
+        """获取该服务器总耗时最多的命令模板，拉取过期时只传输新增的慢查询
+
+        :query top: 返回的模板数量
+        :query refresh: 为 1 时立即拉取
+        """
+        server = g.instance
+        if request.args.get('refresh', 0, type=int) or slowlogs.stale(server.id):
+            slowlogs.fetch(server)
+        limit = max(1, min(request.args.get('top', 20, type=int),
+                           current_app.config['SLOWLOG_CAPACITY']))
+        return slowlogs.report(server.id, limit)
+
+    def delete(self, object_id):
+        """清除该服务器已聚合的模板，下次拉取只聚合之后新增的慢查询
+        """
+        slowlogs.reset(g.instance.id)
+        return {'ok': True}
+
+
+class FleetSlowlog(RestView):
+    """ 所有服务器的慢查询命令模板
+    """
+
+    def get(self):
+        """并发拉取过期服务器新增的慢查询，返回所有服务器总耗时最多的命令模板
+
+        :query ids: 逗号分隔的服务器 id
+        :query name: 服务器名称，支持 * 通配
+        :query tags: 标签选择器
+        :query top: 返回的模板数量
+        :query template: 估计该模板的总耗时（微秒）
+        """
+        servers = Server.filtered(ids=parse_ids(request.args.get('ids')),
+                                  name=request.args.get('name'),
+                                  tags=parse_tags(request.args.get('tags'))).all()
+        errors = slowlogs.refresh(servers)
+        limit = max(1, min(request.args.get('top', 20, type=int),
+                           current_app.config['SLOWLOG_FLEET_CAPACITY']))
+        report = slowlogs.fleet_report(limit, request.args.get('template'))
+        report['errors'] = [{'id': server_id, 'message': message}
+                            for server_id, message in sorted(errors.items())]
+        return report
+
+
+class ServerCommand(RestView):
+    """ 在服务器上执行命令
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def post(self, object_id):
+        """执行白名单中的命令，结果以 NDJSON 逐行返回
+
+        集合类命令（SCAN, HGETALL, SMEMBERS, LRANGE 等）分页读取并逐页返回，
+        超过条数或字节上限时截断并给出继续读取的游标
+
+        :json command: 命令及参数，如 ["HGETALL", "user:1"]
+        :json commands: 批量执行的多条命令
+        :json timeout: 全部命令的超时时间（秒）
+        """
+        config = current_app.config
+        data = request.get_json()
+        commands = parse_commands(data, config['COMMAND_ADMIN_ENABLED'],
+                                  config['COMMAND_MAX_BATCH'])
+        timeout = data.get('timeout', config['COMMAND_TIMEOUT'])
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise RestException(400, 'invalid timeout {}'.format(timeout))
+
+        session = CommandSession(g.instance, min(timeout, config['COMMAND_TIMEOUT']),
+                                 config['COMMAND_MAX_BYTES'], config['COMMAND_MAX_ITEMS'],
+                                 config['COMMAND_PAGE_SIZE'])
+        # a server which cannot be reached fails before streaming starts
+        session.open()
+
+        def generate():
+            failed = True
+            try:
+                for line in session.run(commands):
+                    yield dumps(line) + '\n'
+                failed = False
+            finally:
+                session.close(failed)
+
+        response = Response(generate(), mimetype='application/x-ndjson')
+        # the connection goes back to the pool even if streaming never starts
+        response.call_on_close(session.close)
+        return response
@@ -0,0 +1,102 @@
+"""rmon.views.stream
+server-sent events of collected metrics
+"""
+
+import time
+
+from flask import request, g, current_app, Response
+from flask.json import dumps
+
+from rmon.collector import collector
+from rmon.common.decorators import ObjectMustExist
+from rmon.common.rest import RestView
+from rmon.models import Server
+from rmon.stream import hub
+from rmon.views.server import parse_ids, parse_tags
+
+
+def event_stream(server_ids):
+    """SSE response pushing the samples of server_ids as they are collected
+
+    :query fields: 逗号分隔的 INFO 字段，默认全部
+    :query count: 发送多少个事件后结束，默认不限
+    """
+    fields = request.args.get('fields')
+    fields = [field for field in fields.split(',') if field] if fields else None
+    count = request.args.get('count', type=int)
+    max_duration = current_app.config['STREAM_MAX_DURATION']
+
+    def event(subscription, server_id, timestamp, info, rates):
+        if fields is not None:
+            info = {field: info[field] for field in fields if field in info}
+        data = {
+            'server_id': server_id,
+            'timestamp': timestamp,
+            'info': info,
+            'rates': rates,
+            'dropped': subscription.dropped,
+        }
+        return 'id: {}\nevent: metrics\ndata: {}\n\n'.format(timestamp, dumps(data))
+
+    def generate():
+        # subscribed once the response is iterated, a response which is
+        # never sent leaves nothing behind
+        subscription = hub.subscribe(server_ids)
+        started = time.time()
+        sent = 0
+        try:
+            yield 'retry: {}\n\n'.format(int(collector.interval * 1000))
+
+            # start with the cached samples instead of waiting one interval
+            for server_id in server_ids:
+                sample = collector.store.latest(server_id)
+                if sample is not None and (count is None or sent < count):
+                    sent += 1
+                    yield event(subscription, server_id, sample[0], sample[1],
+                                collector.store.rates(server_id))
+
+            while count is None or sent < count:
+                if max_duration and time.time() - started > max_duration:
+                    return
+                messages = subscription.get(hub.heartbeat)
+                if not messages:
+                    yield ': keepalive\n\n'
+                    continue
+                for message in messages[:None if count is None else count - sent]:
+                    sent += 1
+                    yield event(subscription, *message)
+        finally:
+            hub.unsubscribe(subscription)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+
+class ServerMetricsStream(RestView):
+    """ 推送单个服务器的监控数据
+    """
+
+    method_decorators = (ObjectMustExist(Server),)
+
+    def get(self, object_id):
+        """以 server-sent events 推送新采集的监控数据
+        """
+        return event_stream([g.instance.id])
+
+
+class MetricsStream(RestView):
+    """ 推送多个服务器的监控数据
+    """
+
+    def get(self):
+        """以 server-sent events 推送新采集的监控数据
+
+        :query ids: 逗号分隔的服务器 id，默认全部服务器
+        :query tags: 标签选择器，在订阅时确定服务器
+        """
+        ids = parse_ids(request.args.get('ids'))
+        tags = parse_tags(request.args.get('tags'))
+        if ids is None or tags is not None:
+            ids = [server_id for server_id, in Server.filtered(ids=ids, tags=tags)
+                   .with_entities(Server.id)]
+        return event_stream(ids)
@@ -0,0 +1,27 @@
+""" rmon.views.tag
+tags of the registered servers
+"""
+
+from flask import request
+from sqlalchemy import func
+
+from rmon.common.rest import RestView
+from rmon.models import Tag, server_tag
+
+
+class TagList(RestView):
+    """ 服务器标签
+    """
+
+    def get(self):
+        """获取使用中的标签及带有该标签的服务器数量
+
+        :query key: 只返回该键的标签
+        """
+        query = Tag.query.join(server_tag, server_tag.c.tag_id == Tag.id) \
+            .with_entities(Tag.key, Tag.value, func.count(server_tag.c.server_id)) \
+            .group_by(Tag.id, Tag.key, Tag.value).order_by(Tag.key, Tag.value)
+        key = request.args.get('key')
+        if key is not None:
+            query = query.filter(Tag.key == key)
+        return [{'key': key, 'value': value, 'servers': count} for key, value, count in query]
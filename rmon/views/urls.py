@@ -4,8 +4,14 @@ defined urls for APIs
 
 from flask import Blueprint
 
+from rmon.views.alert import AlertList, AlertRuleDetail, AlertRuleList
 from rmon.views.index import IndexView
-from rmon.views.server import ServerList, ServerDetail, ServerMetrics
+from rmon.views.metrics import FleetAggregate, FleetMetrics, MetricsView, ProfileView
+from rmon.views.stream import MetricsStream, ServerMetricsStream
+from rmon.views.server import (ServerList, ServerBulk, ServerHealth, ServerDetail, ServerMetrics,
+                               ServerRates, ServerHistory, ServerKeyspace, ServerTopology,
+                               ServerSlowlog, FleetSlowlog, ServerCommand)
+from rmon.views.tag import TagList
 
 # 'api' is the Blueprint name
 api = Blueprint('api', __name__)
@@ -13,6 +19,27 @@ api = Blueprint('api', __name__)
 # IndexView will be used as 'index', 
 # for example, url_for('api.index')
 api.add_url_rule('/', view_func=IndexView.as_view('index'))
+api.add_url_rule('/metrics', view_func=MetricsView.as_view('metrics'))
+api.add_url_rule('/metrics/profile', view_func=ProfileView.as_view('profile'))
+api.add_url_rule('/alerts', view_func=AlertList.as_view('alert_list'))
+api.add_url_rule('/alerts/rules', view_func=AlertRuleList.as_view('alert_rule_list'))
+api.add_url_rule('/alerts/rules/<int:object_id>', view_func=AlertRuleDetail.as_view('alert_rule_detail'))
+api.add_url_rule('/tags', view_func=TagList.as_view('tag_list'))
 api.add_url_rule('/servers', view_func=ServerList.as_view('server_list'))
+api.add_url_rule('/servers/bulk', view_func=ServerBulk.as_view('server_bulk'))
+api.add_url_rule('/servers/metrics', view_func=FleetMetrics.as_view('fleet_metrics'))
+api.add_url_rule('/servers/aggregate', view_func=FleetAggregate.as_view('fleet_aggregate'))
+api.add_url_rule('/servers/metrics/stream', view_func=MetricsStream.as_view('metrics_stream'))
+api.add_url_rule('/servers/health', view_func=ServerHealth.as_view('server_health'))
+api.add_url_rule('/servers/slowlog', view_func=FleetSlowlog.as_view('fleet_slowlog'))
 api.add_url_rule('/servers/<int:object_id>', view_func=ServerDetail.as_view('server_detail'))
 api.add_url_rule('/servers/<int:object_id>/metrics', view_func=ServerMetrics.as_view('server_metrics'))
+api.add_url_rule('/servers/<int:object_id>/metrics/rates', view_func=ServerRates.as_view('server_rates'))
+api.add_url_rule('/servers/<int:object_id>/metrics/history',
+                 view_func=ServerHistory.as_view('server_history'))
+api.add_url_rule('/servers/<int:object_id>/metrics/stream',
+                 view_func=ServerMetricsStream.as_view('server_metrics_stream'))
+api.add_url_rule('/servers/<int:object_id>/keyspace', view_func=ServerKeyspace.as_view('server_keyspace'))
+api.add_url_rule('/servers/<int:object_id>/topology', view_func=ServerTopology.as_view('server_topology'))
+api.add_url_rule('/servers/<int:object_id>/slowlog', view_func=ServerSlowlog.as_view('server_slowlog'))
+api.add_url_rule('/servers/<int:object_id>/command', view_func=ServerCommand.as_view('server_command'))
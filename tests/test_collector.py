@@ -0,0 +1,427 @@
+import threading
+import time
+
+import pytest
+
+from rmon.collector import Collector, collector, flatten_info, MetricsStore, SharedMetricsStore
+from rmon.common import sharedmem
+from rmon.common.aioprobe import probes
+from rmon.common.timeseries import TimeSeries
+from rmon.exporter import FleetExporter
+from rmon.history import HistoryStore, history
+from rmon.models import Server
+from rmon.scheduler import Scheduler
+from rmon.stream import StreamHub, Subscription
+
+
+class TestTimeSeries:
+    """
+    test fixed size time series
+    """
+
+    def test_wrap_around(self):
+        series = TimeSeries(3)
+        for i in range(5):
+            series.append(i, {'a': i * 10})
+
+        assert len(series) == 3
+        data = series.range()
+        assert data['timestamps'] == [2, 3, 4]
+        assert data['series']['a'] == [20, 30, 40]
+        assert series.last() == (4, {'a': 40})
+
+    def test_range(self):
+        series = TimeSeries(10)
+        for i in range(10):
+            series.append(i, {'a': i})
+
+        data = series.range(3, 5)
+        assert data['timestamps'] == [3, 4, 5]
+        assert data['series']['a'] == [3, 4, 5]
+
+    def test_missing_column(self):
+        series = TimeSeries(4)
+        series.append(1, {'a': 1})
+        series.append(2, {'a': 2, 'b': 2})
+        series.append(3, {'b': 3})
+
+        data = series.range(names=['a', 'b', 'c'])
+        assert data['series'] == {'a': [1, 2, None], 'b': [None, 2, 3]}
+
+
+class TestCollector:
+    """
+    test background metrics collector
+    """
+
+    def test_flatten_info(self):
+        info = {'used_memory': 100, 'redis_version': '4.0.1',
+                'db0': {'keys': 3, 'expires': 1}}
+        assert flatten_info(info) == {'used_memory': 100.0, 'db0.keys': 3.0,
+                                      'db0.expires': 1.0}
+
+    def test_store_series_filter(self):
+        store = MetricsStore(capacity=2, series=['used_memory'])
+        store.record(1, {'used_memory': 1, 'connected_clients': 2}, timestamp=1)
+        assert store.history(1)['series'] == {'used_memory': [1]}
+        assert store.latest(1) == (1, {'used_memory': 1, 'connected_clients': 2})
+
+    def test_collect(self, server):
+        collector.collect()
+
+        timestamp, info = collector.store.latest(server.id)
+        assert info['arch_bits'] == 64
+        assert collector.store.history(server.id)['series']['used_memory']
+
+    def test_collect_discards_deleted_server(self, server):
+        collector.collect()
+        server_id = server.id
+        server.delete()
+        collector.collect()
+
+        assert collector.store.latest(server_id) is None
+
+    def test_latest_served_from_cache(self, server):
+        info = collector.latest(server)
+        assert collector.latest(server) is info
+
+    def test_latest_fresh_for_server_interval(self, server, monkeypatch):
+        collector.scheduler.sync([schedule_row(server.id, probe_interval=60)])
+        collector.store.record(server.id, {'used_memory': 1}, time.time() - 30)
+        monkeypatch.setattr(Server, 'get_metrics', lambda self: {'used_memory': 2})
+
+        assert collector.latest(server) == {'used_memory': 1}
+        collector.scheduler.clear()
+        assert collector.latest(server) == {'used_memory': 2}
+
+    def test_collect_with_async_engine(self, server):
+        probes.enabled = True
+        try:
+            collector.collect()
+        finally:
+            probes.enabled = False
+
+        assert collector.store.latest(server.id)[1]['arch_bits'] == 64
+
+
+class TestStreamHub:
+    """
+    test fan-out of samples to stream subscribers
+    """
+
+    def test_publish(self):
+        hub = StreamHub(Collector())
+        first = hub.subscribe([1])
+        second = hub.subscribe([1, 2])
+
+        hub.collector.record(1, {'used_memory': 1})
+        hub.collector.record(2, {'used_memory': 2})
+
+        assert [message[0] for message in first.get(0)] == [1]
+        assert [message[0] for message in second.get(0)] == [1, 2]
+
+        hub.unsubscribe(first)
+        hub.unsubscribe(second)
+        assert hub.subscribed() == []
+
+    def test_slow_subscriber_drops_oldest(self):
+        subscription = Subscription([1], size=2)
+        for i in range(5):
+            subscription.put(i)
+
+        assert subscription.get(0) == [3, 4]
+        assert subscription.dropped == 3
+
+
+class TestHistoryStore:
+    """
+    test persistent history with rollups
+    """
+
+    @staticmethod
+    def store():
+        store = HistoryStore()
+        store.enabled = True
+        return store
+
+    def test_raw_query(self):
+        store = self.store()
+        now = int(time.time())
+        for i in range(10):
+            store.append(1, now - 10 + i, {'used_memory': i, 'other': 1})
+
+        data = store.query(1, ['used_memory'], now - 10, now - 1, step=1)
+        assert data['resolution'] == 0
+        assert data['series']['used_memory'] == list(range(10))
+        assert list(data['series']) == ['used_memory']
+
+    def test_rollups(self):
+        store = self.store()
+        start = (int(time.time()) // 3600 - 3) * 3600
+        for i in range(0, 3 * 3600, 10):
+            store.append(1, start + i, {'used_memory': i // 3600})
+        store.flush()
+
+        minutes = store.query(1, ['used_memory'], start, start + 3 * 3600 - 1, step=60)
+        assert minutes['resolution'] == 60
+        assert len(minutes['timestamps']) == 180
+        assert minutes['series']['used_memory'][0] == 0
+        assert minutes['series']['used_memory'][-1] == 2
+
+        hours = store.query(1, ['used_memory'], start, start + 3 * 3600 - 1, step=3600)
+        assert hours['resolution'] == 3600
+        assert hours['series']['used_memory'] == [0, 1, 2]
+
+    def test_late_sample_rolled_up(self):
+        store = self.store()
+        start = (int(time.time()) // 3600 - 1) * 3600
+        store.append(1, start, {'used_memory': 1})
+        store.flush()
+        # buffered by a slower thread after its minute was rolled up
+        store.append(1, start + 30, {'used_memory': 3})
+        store.flush()
+
+        minutes = store.query(1, ['used_memory'], start, start + 59, step=60)
+        assert minutes['series']['used_memory'] == [2]
+        assert store.db.execute('SELECT count FROM sample WHERE resolution = 3600').fetchall() \
+            == [(2,)]
+
+    def test_retention(self):
+        store = self.store()
+        store.retention[0] = 60
+        start = (int(time.time()) // 3600 - 1) * 3600
+        for i in range(0, 600, 10):
+            store.append(1, start + i, {'used_memory': 1})
+        store.flush()
+
+        raw = store.query(1, ['used_memory'], start, start + 599, step=10)
+        assert set(raw['series']['used_memory']) == {None}
+        minutes = store.query(1, ['used_memory'], start, start + 599, step=60)
+        assert minutes['series']['used_memory'] == [1] * 10
+
+    def test_collected_samples(self, server):
+        history.enabled = True
+        collector.poll(server)
+
+        assert 'used_memory' in history.names()
+        now = time.time()
+        data = history.query(server.id, ['used_memory'], now - 60, now, step=60)
+        assert any(value is not None for value in data['series']['used_memory'])
+
+
+def schedule_row(server_id, probe_interval=None, boost_interval=None):
+    return (server_id, '127.0.0.1', 6379, None, probe_interval, boost_interval)
+
+
+class TestScheduler:
+    """
+    test per-server probe schedule
+    """
+
+    def test_first_probes_spread_over_interval(self):
+        scheduler = Scheduler(interval=10)
+        scheduler.sync([schedule_row(i) for i in range(1, 1001)], now=0)
+
+        assert len(scheduler.due(now=5)) > 300
+        assert len(scheduler.due(now=10)) > 300
+        assert scheduler.next_due() is None
+
+    def test_in_flight_not_due_again(self):
+        scheduler = Scheduler(interval=10)
+        scheduler.jitter = 0
+        scheduler.sync([schedule_row(1, probe_interval=2)], now=0)
+
+        assert [s.id for s in scheduler.due(now=2)] == [1]
+        assert scheduler.due(now=100) == []
+        assert scheduler.complete(1, True, {}, now=100) == 2
+        assert [s.id for s in scheduler.due(now=102)] == [1]
+
+    def test_backoff_and_boost(self):
+        scheduler = Scheduler(interval=10)
+        scheduler.jitter = 0
+        scheduler.backoff_max = 60
+        scheduler.thresholds = {'blocked_clients': 1}
+        scheduler.sync([schedule_row(1)], now=0)
+        scheduler.due(now=10)
+
+        delays = []
+        for _ in range(4):
+            delays.append(scheduler.complete(1, False, now=0))
+        assert delays == [20, 40, 60, 60]
+
+        assert scheduler.complete(1, True, {'blocked_clients': 3}, now=0) == 2
+        assert scheduler.state(1)['boosted']
+        assert scheduler.complete(1, True, None, now=0) == 2
+        assert scheduler.complete(1, True, {'blocked_clients': 0}, now=0) == 10
+
+    def test_effective_interval(self):
+        scheduler = Scheduler(interval=10)
+        scheduler.sync([schedule_row(1), schedule_row(2, probe_interval=60)], now=0)
+        assert scheduler.effective_intervals() == pytest.approx({1: 11, 2: 66})
+
+        scheduler.complete(1, False, now=0)
+        scheduler.complete(1, False, now=0)
+        assert scheduler.effective_interval(1) == pytest.approx(44)
+        assert scheduler.effective_interval(3) is None
+
+        # a skipped probe ages the sample by one more interval
+        scheduler.complete(2, True, {}, now=0)
+        assert scheduler.skip(2, now=0) == pytest.approx(60, rel=0.1)
+        scheduler.skip(2, now=0)
+        assert scheduler.effective_interval(2) == pytest.approx(198)
+        scheduler.complete(2, True, {}, now=0)
+        assert scheduler.effective_interval(2) == pytest.approx(66)
+
+    def test_sync_changes(self):
+        scheduler = Scheduler(interval=10)
+        scheduler.sync([schedule_row(1), schedule_row(2)], now=0)
+
+        assert scheduler.sync([schedule_row(1, probe_interval=1)], now=0) == [2]
+        # the shorter interval applies at once
+        assert [s.id for s in scheduler.due(now=1)] == [1]
+        assert scheduler.due(now=100) == []
+
+    def test_scheduled_collection(self, app, server):
+        collector.scheduler.jitter = 0
+        server.probe_interval = 1
+        server.save()
+        server_id = server.id
+
+        collector.start()
+        try:
+            deadline = time.time() + 5
+            while collector.store.latest(server_id) is None and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            collector.stop()
+
+        assert collector.store.latest(server_id) is not None
+        assert collector.scheduler.state(server_id)['interval'] == 1
+
+
+class TestSharedMetricsStore:
+    """
+    test samples shared by the collector process with API workers
+    """
+
+    def test_reader_sees_writer_samples(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(sharedmem, 'RESCAN_INTERVAL', 0)
+        path = str(tmpdir.join('samples'))
+        writer = SharedMetricsStore(path, writer=True, capacity=3, series=['used_memory'],
+                                    slots=2)
+        reader = SharedMetricsStore(path)
+        for index in range(4):
+            writer.record(7, {'used_memory': index, 'role': 'master',
+                              'total_commands_processed': 10 * index}, timestamp=index)
+
+        assert reader.latest(7) == (3, {'used_memory': 3, 'role': 'master',
+                                        'total_commands_processed': 30})
+        assert reader.rates(7)['rates']['total_commands_processed'] == 10
+        assert reader.history(7, start=2) == {'timestamps': [2, 3],
+                                              'series': {'used_memory': [2, 3]}}
+        assert reader.history(7)['timestamps'] == [1, 2, 3]
+        assert reader.server_ids() == [7]
+
+        reader.record(8, {'used_memory': 1})
+        assert reader.latest(8) is None
+
+        writer.discard(7)
+        assert reader.latest(7) is None
+
+    def test_reader_maps_new_file(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(sharedmem, 'RESCAN_INTERVAL', 0)
+        path = str(tmpdir.join('samples'))
+        reader = SharedMetricsStore(path)
+        assert reader.latest(1) is None
+
+        SharedMetricsStore(path, writer=True).record(1, {'used_memory': 1}, timestamp=1)
+        assert reader.latest(1) == (1, {'used_memory': 1})
+        SharedMetricsStore(path, writer=True).record(1, {'used_memory': 2}, timestamp=2)
+        assert reader.latest(1) == (2, {'used_memory': 2})
+
+    def test_slots_exhausted(self, tmpdir):
+        store = SharedMetricsStore(str(tmpdir.join('samples')), writer=True, slots=1,
+                                   slot_size=256)
+        store.record(1, {'used_memory': 1})
+        store.record(2, {'used_memory': 1})
+        store.record(1, {'used_memory': 1, 'padding': 'x' * 256})
+
+        assert store.latest(1)[1] == {'used_memory': 1}
+        assert store.latest(2) is None
+
+    def test_concurrent_writers(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(sharedmem, 'RESCAN_INTERVAL', 0)
+        path = str(tmpdir.join('samples'))
+        writer = SharedMetricsStore(path, writer=True, slots=64, series=['used_memory'])
+
+        def record(server_id):
+            for index in range(50):
+                writer.record(server_id, {'used_memory': server_id}, timestamp=index)
+
+        threads = [threading.Thread(target=record, args=(server_id,))
+                   for server_id in range(1, 33)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        reader = SharedMetricsStore(path)
+        assert sorted(reader.server_ids()) == list(range(1, 33))
+        for server_id in range(1, 33):
+            assert reader.latest(server_id) == (49, {'used_memory': server_id})
+            assert set(reader.history(server_id)['series']['used_memory']) == {server_id}
+
+    def test_collector_process(self, app, server, tmpdir, monkeypatch):
+        monkeypatch.setattr(sharedmem, 'RESCAN_INTERVAL', 0)
+        app.config['SHARED_STORE_PATH'] = str(tmpdir.join('samples'))
+        process = Collector(app)
+        process.scheduler.jitter = 0
+        server.probe_interval = 1
+        server.save()
+        server_id = server.id
+
+        thread = threading.Thread(target=process.serve)
+        thread.start()
+        try:
+            worker = Collector(app)
+            deadline = time.time() + 5
+            while worker.store.latest(server_id) is None and time.time() < deadline:
+                time.sleep(0.05)
+
+            assert worker.running
+            timestamp = worker.store.latest(server_id)[0]
+            # served from the shared sample, the worker does not probe
+            worker.latest(server)
+            assert worker.store.latest(server_id)[0] == timestamp
+        finally:
+            process.stop()
+            thread.join()
+
+    def test_exported_by_published_interval(self, app, server, tmpdir, monkeypatch):
+        monkeypatch.setattr(sharedmem, 'RESCAN_INTERVAL', 0)
+        app.config['SHARED_STORE_PATH'] = str(tmpdir.join('samples'))
+        process = Collector(app)
+        process.scheduler.jitter = 0
+        server.probe_interval = 3600
+        server.save()
+        server_id = server.id
+        servers = [(server_id, server.name, server.host, server.port)]
+
+        thread = threading.Thread(target=process.serve)
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while not process.store.writable and time.time() < deadline:
+                time.sleep(0.05)
+            # older than 3 COLLECTOR_INTERVAL, not than 3 probe intervals
+            process.store.record(server_id, {'used_memory': 1}, timestamp=time.time() - 60)
+
+            worker = Collector(app)
+            while server_id not in worker.effective_intervals() and time.time() < deadline:
+                time.sleep(0.05)
+            assert worker.effective_intervals()[server_id] == pytest.approx(3600)
+            text = FleetExporter(worker).render(servers)
+            assert 'redis_up{{name="{}",host="{}",port="{}"}} 1'.format(*servers[0][1:]) in text
+        finally:
+            process.stop()
+            thread.join()
@@ -0,0 +1,388 @@
+import gzip
+import json
+import time
+import zlib
+from datetime import datetime
+
+import pytest
+from flask import url_for
+
+from rmon.collector import MetricsStore
+from rmon.common.aggregate import Columns, parse_stats, percentile, summarize
+from rmon.common.cache import ObjectCache, TTLCache, object_cache
+from rmon.common.expressions import Sample, compile_condition, split_duration
+from rmon.common.fanout import fan_out
+from rmon.common.labels import Requirement, parse_selector, validate_labels
+from rmon.common.metrics import Registry
+from rmon.common.rates import RateCalculator
+from rmon.common.serializers import get_backend, serializer
+from rmon.common.sketches import CountMinSketch, SpaceSaving
+from rmon.models import db, Server
+
+
+class TestFanOut:
+    """
+    test concurrent fan-out with deadlines
+    """
+
+    def test_results(self):
+        def func(item):
+            if item == 2:
+                raise ValueError('bad item')
+            return item * 10
+
+        results = {item: (status, value) for item, status, value, _ in
+                   fan_out([1, 2, 3], func, timeout=1, deadline=1, workers=3)}
+
+        assert results[1] == ('ok', 10)
+        assert results[3] == ('ok', 30)
+        assert results[2][0] == 'error'
+        assert isinstance(results[2][1], ValueError)
+
+    def test_slow_call_does_not_stall_others(self):
+        def func(item):
+            time.sleep(item)
+            return item
+
+        started = time.time()
+        results = {item: status for item, status, _, _ in
+                   fan_out([0, 0, 2], func, timeout=0.2, deadline=1, workers=3)}
+
+        assert time.time() - started < 1
+        assert results == {0: 'ok', 2: 'timeout'}
+
+    def test_deadline(self):
+        started = time.time()
+        results = [status for _, status, _, _ in
+                   fan_out([1, 1, 1], time.sleep, timeout=5, deadline=0.2, workers=1)]
+
+        assert time.time() - started < 0.5
+        assert results == ['timeout'] * 3
+
+
+class TestRateCalculator:
+    """
+    test rates derived from INFO counters
+    """
+
+    def test_rates(self):
+        calculator = RateCalculator()
+        first = calculator.update(1, 100, {'run_id': 'a', 'uptime_in_seconds': 10,
+                                           'keyspace_hits': 10, 'keyspace_misses': 10,
+                                           'total_commands_processed': 100})
+        assert first['interval'] is None
+        assert first['hit_ratio'] == 0.5
+
+        result = calculator.update(1, 110, {'run_id': 'a', 'uptime_in_seconds': 20,
+                                            'keyspace_hits': 40, 'keyspace_misses': 20,
+                                            'total_commands_processed': 600})
+        assert result['interval'] == 10
+        assert result['reset'] is False
+        assert result['deltas']['total_commands_processed'] == 500
+        assert result['rates']['total_commands_processed'] == 50
+        assert result['interval_hit_ratio'] == 0.75
+
+    def test_restart(self):
+        calculator = RateCalculator()
+        calculator.update(1, 100, {'run_id': 'a', 'uptime_in_seconds': 1000,
+                                   'total_commands_processed': 5000})
+        result = calculator.update(1, 110, {'run_id': 'b', 'uptime_in_seconds': 4,
+                                            'total_commands_processed': 40})
+        assert result['reset'] is True
+        assert result['deltas']['total_commands_processed'] == 40
+        assert result['rates']['total_commands_processed'] == 10
+
+    def test_counter_goes_backwards(self):
+        calculator = RateCalculator()
+        calculator.update(1, 100, {'expired_keys': 50})
+        result = calculator.update(1, 105, {'expired_keys': 5})
+        assert result['reset'] is True
+        assert result['deltas']['expired_keys'] == 5
+
+
+class TestObjectCache:
+    """
+    test read-through cache of ObjectMustExist
+    """
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=30)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert len(cache) == 2
+
+        cache.ttl = 0
+        cache.set('d', 4)
+        assert cache.get('d') is None
+
+    def test_read_through(self, server):
+        server_id = server.id
+        assert object_cache.get(Server, server_id) is not None
+
+        # the cached row is served without querying the database
+        db.session.execute(Server.__table__.update().values(name='changed'))
+        db.session.commit()
+        assert object_cache.get(Server, server_id).name == 'redis test'
+
+    def test_invalidated_on_save(self, server):
+        object_cache.get(Server, server.id)
+        server.name = 'renamed'
+        server.save()
+
+        assert object_cache.get(Server, server.id).name == 'renamed'
+
+    def test_invalidated_on_delete(self, server):
+        server_id = server.id
+        object_cache.get(Server, server_id)
+        server.delete()
+
+        assert object_cache.get(Server, server_id) is None
+
+    def test_disabled_with_shared_store(self, app, server, tmpdir):
+        app.config['SHARED_STORE_PATH'] = str(tmpdir.join('samples'))
+        cache = ObjectCache(app)
+        server_id = server.id
+        cache.get(Server, server_id)
+
+        # a row changed by another worker is read again
+        db.session.execute(Server.__table__.update().values(name='changed'))
+        db.session.commit()
+        assert not cache.enabled
+        assert cache.get(Server, server_id).name == 'changed'
+
+
+class TestResponseSerializer:
+    """
+    test JSON encoding of RestView responses
+    """
+
+    def test_encode(self, app):
+        with app.app_context():
+            data = {'ok': True, 'message': '中文', 'values': [1, 2.5, None]}
+            assert json.loads(serializer.encode(data).decode()) == data
+            assert serializer.encode(data).endswith(b'\n')
+
+    @pytest.mark.parametrize('name', ['orjson', 'ujson'])
+    def test_backend_matches_flask_encoder(self, app, name):
+        pytest.importorskip(name)
+        data = {'b': 1, 'a': {2: 'x', 1: '中文'}, 'c': [{'z': None, 'y': 2.5}], 'd': True}
+        if name == 'orjson':
+            data['e'] = datetime(2020, 1, 2, 3, 4, 5)
+
+        def pairs(encoded):
+            return json.loads(encoded.decode(), object_pairs_hook=list)
+
+        with app.app_context():
+            assert pairs(get_backend(name)[1](data)) == pairs(get_backend('json')[1](data))
+
+    def test_unknown_backend(self):
+        try:
+            get_backend('missing')
+        except ValueError as e:
+            assert 'missing' in str(e)
+        else:
+            assert False
+
+    def test_gzip(self, server, client):
+        resp = client.get(url_for('api.server_metrics', object_id=server.id),
+                          headers={'Accept-Encoding': 'gzip'})
+
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert json.loads(gzip.decompress(resp.data).decode())['arch_bits'] == 64
+
+    def test_small_body_not_compressed(self, server, client):
+        resp = client.get(url_for('api.server_detail', object_id=server.id),
+                          headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.json['name'] == server.name
+
+    def test_streamed_list(self, server, client):
+        Server(name='redis 2', host='127.0.0.1').save()
+        serializer.stream_threshold = 1
+        serializer.chunk_size = 1
+
+        resp = client.get(url_for('api.server_list'), headers={'Accept-Encoding': 'deflate'})
+
+        assert resp.headers['Content-Encoding'] == 'deflate'
+        servers = json.loads(zlib.decompress(resp.data).decode())
+        assert [h['name'] for h in servers] == ['redis test', 'redis 2']
+
+
+class TestMetrics:
+    """
+    test Prometheus exposition of counters, gauges and histograms
+    """
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('latency_seconds', 'Latency.', ('view',), buckets=(0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(5, 'a')
+
+        lines = registry.render().splitlines()
+        assert '# TYPE latency_seconds histogram' in lines
+        assert 'latency_seconds_bucket{view="a",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{view="a",le="1"} 2' in lines
+        assert 'latency_seconds_bucket{view="a",le="+Inf"} 3' in lines
+        assert 'latency_seconds_sum{view="a"} 5.55' in lines
+        assert 'latency_seconds_count{view="a"} 3' in lines
+
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        counter = registry.counter('errors_total', 'Errors.', ('server',))
+        counter.inc('a "b"')
+        counter.inc('a "b"', amount=2)
+        registry.gauge('pools', 'Pools.', callback=lambda: {(): 4})
+
+        lines = registry.render().splitlines()
+        assert 'errors_total{server="a \\"b\\""} 3' in lines
+        assert 'pools 4' in lines
+
+
+class TestSketches:
+    """
+    test heavy hitters and count-min estimates
+    """
+
+    def test_space_saving_keeps_heaviest(self):
+        counters = SpaceSaving(2)
+        counters.add('a', 10, count=1, max=10)
+        counters.add('a', 5, count=1, max=5)
+        counters.add('b', 3)
+        counters.add('c', 1)
+
+        assert len(counters) == 2
+        top = counters.top(2)
+        assert top[0][0] == 'a'
+        assert (top[0][1]['weight'], top[0][1]['count'], top[0][1]['max']) == (15, 2, 10)
+        # c took the counter of b and inherited its weight as error
+        assert top[1][0] == 'c'
+        assert (top[1][1]['weight'], top[1][1]['error']) == (4, 3)
+
+    def test_count_min_never_underestimates(self):
+        sketch = CountMinSketch(width=16, depth=3)
+        for index in range(100):
+            sketch.add('key{}'.format(index), index)
+
+        assert sketch.total == sum(range(100))
+        assert all(sketch.estimate('key{}'.format(index)) >= index for index in range(100))
+        sketch.clear()
+        assert sketch.estimate('key1') == 0
+
+
+class TestExpressions:
+    """
+    test alert conditions
+    """
+
+    def test_compile(self):
+        code, fields = compile_condition('used_memory / maxmemory > 0.9 and db0.keys > 1')
+        sample = Sample(10, {'used_memory': 95, 'maxmemory': 100, 'db0': {'keys': 2}})
+
+        assert fields == {'used_memory', 'maxmemory', 'db0.keys'}
+        assert sample.evaluate(code) is True
+        # division by zero and missing fields cannot be evaluated
+        assert Sample(10, {'used_memory': 1, 'maxmemory': 0}).evaluate(code) is None
+
+    def test_rate(self):
+        code, fields = compile_condition('connected_clients rate > 1')
+        previous = (0, {'connected_clients': 10})
+
+        assert fields == {'connected_clients'}
+        assert Sample(5, {'connected_clients': 20}, previous).evaluate(code) is True
+        assert Sample(5, {'connected_clients': 12}, previous).evaluate(code) is False
+        assert Sample(5, {'connected_clients': 20}).evaluate(code) is None
+
+        code, fields = compile_condition('used_memory > 1 or rate(connected_clients) > 1')
+        assert fields == {'used_memory', 'connected_clients'}
+
+    def test_rejected(self):
+        for condition in ('__import__("os")', 'used_memory.__class__()', 'lambda: 1',
+                          '[used_memory]', 'rate(1)', 'used_memory >'):
+            with pytest.raises(ValueError):
+                compile_condition(condition)
+
+    def test_rejected_expensive(self):
+        """no power and no strings, a condition must stay cheap on every sample
+        """
+        for condition in ('used_memory ** used_memory > 1', 'pow(used_memory, 2) > 1',
+                          '"a" * 1000000000 > used_memory', 'role == "master"'):
+            with pytest.raises(ValueError):
+                compile_condition(condition)
+
+    def test_split_duration(self):
+        assert split_duration('used_memory > 1 for 5m') == ('used_memory > 1', 300)
+        assert split_duration('used_memory > 1') == ('used_memory > 1', None)
+
+
+class TestAggregate:
+    """
+    test statistics across servers
+    """
+
+    def test_summarize(self):
+        values = [1.0, float('nan'), 3.0, 2.0, 4.0]
+        summary = summarize(values, parse_stats('count,sum,avg,min,max,p50,p100'))
+
+        assert summary == {'count': 4, 'sum': 10, 'avg': 2.5, 'min': 1, 'max': 4,
+                           'p50': 2.5, 'p100': 4}
+        assert percentile([1, 2, 3, 4, 5], 90) == 4.6
+        assert summarize([], ['count', 'max']) == {'count': 0, 'max': None}
+        with pytest.raises(ValueError):
+            parse_stats('sum,p101')
+
+    def test_columns(self):
+        store = MetricsStore()
+        store.record(1, {'role': 'master', 'used_memory': 10, 'db0': {'keys': 5}})
+        store.record(2, {'role': 'slave', 'used_memory': 30})
+        store.record(3, {'role': 'master', 'used_memory': 20, 'db0': {'keys': 7}})
+        servers = [(1, 'a', 'h1', None), (2, 'b', 'h1', None), (3, 'c', 'h2', None),
+                   (4, 'd', 'h2', None)]
+
+        columns = Columns(servers, ['used_memory', 'db0.keys'], store, 'role')
+
+        assert columns.missing == [4]
+        assert columns.summary(['sum'])['used_memory'] == {'sum': 60}
+        assert columns.groups(['max']) == [
+            {'key': 'master', 'servers': 2,
+             'summary': {'used_memory': {'max': 20}, 'db0.keys': {'max': 7}}},
+            {'key': 'slave', 'servers': 1,
+             'summary': {'used_memory': {'max': 30}, 'db0.keys': {'max': None}}}]
+        assert columns.matrix()['values']['db0.keys'] == [5, None, 7]
+
+
+class TestLabels:
+    """
+    test tag validation and selectors
+    """
+
+    def test_parse_selector(self):
+        requirements = parse_selector('env=prod, role!=cache,team in (b, a),tier notin (x),'
+                                      'backup,!legacy')
+
+        assert requirements == [
+            Requirement('env', False, ('prod',)),
+            Requirement('role', True, ('cache',)),
+            Requirement('team', False, ('a', 'b')),
+            Requirement('tier', True, ('x',)),
+            Requirement('backup', False, None),
+            Requirement('legacy', True, None),
+        ]
+        assert parse_selector('') == []
+        for text in ('env=a b', 'team in ()', 'env=(prod)', '=prod'):
+            with pytest.raises(ValueError):
+                parse_selector(text)
+
+    def test_validate_labels(self):
+        validate_labels({'env': 'prod', 'backup': ''})
+        for labels in (['env'], {'env': 1}, {'bad key': 'x'}, {'env': 'a b'}):
+            with pytest.raises(ValueError):
+                validate_labels(labels)
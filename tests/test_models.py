@@ -1,5 +1,26 @@
-from rmon.models import Server 
+import socket
+import threading
+import time
+from itertools import combinations
+
+import pytest
+from redis import RedisError
+from sqlalchemy import create_engine, event, inspect
+
+from rmon import migrations, models
+from rmon.alerts import AlertEngine
+from rmon.app import create_app
+from rmon.collector import Collector, collector, SharedMetricsStore
+from rmon.models import (db as database, AlertRule, AlertRuleSchema, MAX_SCHEMAS, Server,
+                         ServerSchema, Tag, server_schema)
+from rmon.common.aioprobe import probes
+from rmon.common.clients import clients
+from rmon.common.labels import parse_selector
 from rmon.common.rest import RestException
+from rmon.keyspace import key_pattern, PrefixTree
+from rmon import topology as topology_module
+from rmon.slowlog import SlowlogAggregator, command_template
+from rmon.topology import parse_cluster_nodes, replicas_of, topology
 
 
 class TestServer:
@@ -58,5 +79,548 @@ class TestServer:
         except RestException as e:
             assert e.code == 400
             assert e.message == 'cannot connect to redis server {}'.format(server.host)
-        
-        
\ No newline at end of file
+
+    def test_snapshot(self, server):
+        snapshot = server.snapshot(['memory', 'commandstats', 'dbsize', 'config',
+                                    'slowlog', 'client_list', 'latency'])
+
+        assert 'used_memory' in snapshot['info']['memory']
+        assert 'arch_bits' not in snapshot['info']['memory']
+        assert isinstance(snapshot['info']['commandstats'], dict)
+        assert isinstance(snapshot['dbsize'], int)
+        assert 'maxmemory' in snapshot['config']
+        assert isinstance(snapshot['slowlog'], list)
+        assert snapshot['client_list']['total'] >= 1
+        assert isinstance(snapshot['latency'], list)
+
+    def test_snapshot_failure(self, db):
+        server = Server(name='test', host='127.0.0.1', port=6399)
+        try:
+            server.snapshot(['memory'])
+        except RestException as e:
+            assert e.code == 400
+
+
+    def test_schema_cache_bounded(self):
+        assert server_schema(['name', 'id']) is server_schema(('id', 'name', 'id'))
+        assert server_schema() is not server_schema(['id'])
+
+        names = ('id', 'name', 'description', 'host', 'port', 'created_at', 'updated_at')
+        for only in combinations(names, 3):
+            server_schema(only)
+        assert len(models._schemas.schemas) == MAX_SCHEMAS
+
+
+class TestRedisClients:
+    """
+    test pooled redis clients behind Server.redis
+    """
+
+    def test_client_is_cached(self, server):
+        assert server.redis is server.redis
+
+    def test_client_invalidated_on_update(self, server):
+        client = server.redis
+        schema = ServerSchema(context={'instance': server})
+        server, errors = schema.load({'port': 6380}, partial=True)
+        assert not errors
+        assert server.redis is not client
+
+    def test_client_invalidated_on_delete(self, server):
+        server.redis
+        assert len(clients) > 0
+        server.delete()
+        assert all(key[0] != server.id for key in clients._clients)
+
+    def test_probe_timeout(self, server):
+        client = clients.get(server, 0.5)
+        assert clients.get(server, 0.5) is client
+        assert client.connection_pool.connection_kwargs['socket_timeout'] == 0.5
+        # both pools are kept, they point at the same address
+        assert server.redis is not client
+        assert clients.get(server, 0.5) is client
+
+    @pytest.mark.parametrize('engine', [False, True])
+    def test_probe_gives_up_after_timeout(self, db, engine):
+        # accepts connections but never replies
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        probes.enabled = engine
+        try:
+            server = Server(name='silent', host='127.0.0.1', port=listener.getsockname()[1])
+            server.save()
+            started = time.time()
+            with pytest.raises(RestException):
+                server.ping(timeout=0.2)
+            # instead of the 3 and 5 second socket timeouts of the config
+            assert time.time() - started < 1
+        finally:
+            probes.enabled = False
+            listener.close()
+
+    def test_evict_idle(self, server):
+        server.redis
+        idle_timeout = clients.idle_timeout
+        clients.idle_timeout = 0
+        try:
+            clients.evict_idle()
+        finally:
+            clients.idle_timeout = idle_timeout
+        assert len(clients) == 0
+
+
+class TestAsyncProbeEngine:
+    """
+    test Server.ping and Server.get_metrics on the asyncio engine
+    """
+
+    def test_ping(self, server):
+        assert probes.ping(server) is True
+
+    def test_info(self, server):
+        assert probes.info(server)['arch_bits'] == 64
+
+    def test_info_many(self, server):
+        down = Server(name='down', host='127.0.0.1', port=6398)
+        up, error = probes.info_many([server, down])
+        assert up['arch_bits'] == 64
+        assert isinstance(error, RedisError)
+
+    def test_backoff(self, db):
+        server = Server(name='down', host='127.0.0.1', port=6397)
+        try:
+            probes.ping(server)
+        except RedisError:
+            pass
+
+        try:
+            probes.ping(server)
+        except RedisError as e:
+            assert 'retry in' in str(e)
+
+    def test_server_uses_engine(self, server):
+        probes.enabled = True
+        try:
+            assert server.ping() is True
+            assert server.get_metrics()['arch_bits'] == 64
+        finally:
+            probes.enabled = False
+
+
+class TestKeyspaceAnalyzer:
+    """
+    test SCAN based keyspace analysis
+    """
+
+    def test_key_pattern(self):
+        assert key_pattern('user:1024:profile') == ('user', '*', 'profile')
+        assert key_pattern('session:9f86d081884c7d65') == ('session', '*')
+        assert key_pattern('a:b:c:d:e:f', max_depth=3) == ('a', 'b', 'c')
+
+    def test_prefix_tree_bounded(self):
+        tree = PrefixTree(max_nodes=2)
+        tree.add(('user', '*'), 'hash', 100, -1)
+        tree.add(('user', 'x'), 'string', 10, 30)
+
+        assert len(tree.nodes) == 2
+        top = tree.top(10)
+        assert top[0]['pattern'] == 'user'
+        assert top[0]['keys'] == 2
+        assert top[0]['bytes'] == 110
+        assert top[0]['ttl'] == {'none': 1, '<1h': 1}
+
+    def test_analyze(self, server):
+        redis = server.redis
+        redis.flushdb()
+        for i in range(200):
+            redis.set('rmon:test:{}'.format(i), 'x' * 100)
+        redis.hset('rmon:hash', 'field', 'value')
+
+        job = server.analyze_keyspace(sample_rate=1, scan_count=50, min_rate=100000)
+        job._thread.join(10)
+
+        report = job.report()
+        assert report['status'] == 'done'
+        assert report['scanned'] == 201
+        patterns = {pattern['pattern']: pattern for pattern in report['patterns']}
+        assert patterns['rmon:test:*']['keys'] == 200
+        assert patterns['rmon:test:*']['types'] == {'string': 200}
+        assert patterns['rmon']['keys'] == 201
+        redis.flushdb()
+
+
+CLUSTER_NODES = """\
+07c37dfeb235213a872192d90877d0cd55635b91 127.0.0.1:30004@31004 slave e7d1eecce10fd6bb5eb35b9f99a514335d9ba9ca 0 1426238317239 4 connected
+67ed2db8d677e59ec4a4cefb06858cf2a1a89fa1 127.0.0.1:30002@31002 master - 0 1426238316232 2 connected 5461-10922
+e7d1eecce10fd6bb5eb35b9f99a514335d9ba9ca :30001@31001 myself,master - 0 0 1 connected 0-5460
+"""
+
+
+class TestTopology:
+    """
+    test cluster and replication topology discovery
+    """
+
+    def test_parse_cluster_nodes(self):
+        nodes = parse_cluster_nodes(CLUSTER_NODES, '10.0.0.1')
+
+        assert [(n['host'], n['port'], n['role']) for n in nodes] == [
+            ('127.0.0.1', 30004, 'replica'), ('127.0.0.1', 30002, 'master'),
+            ('10.0.0.1', 30001, 'master')]
+        assert nodes[0]['master'] == '10.0.0.1:30001'
+        assert nodes[1]['slots'] == '5461-10922'
+        assert nodes[2]['flags'] == 'master'
+
+    def test_replicas_of(self):
+        info = {'role': 'master', 'connected_slaves': 1, 'master_repl_offset': 100,
+                'slave0': {'ip': '10.0.0.2', 'port': 6380, 'state': 'online',
+                           'offset': 90, 'lag': 1}}
+
+        assert replicas_of(info) == {'10.0.0.2:6380': {
+            'state': 'online', 'offset': 90, 'lag': 1, 'offset_lag': 10}}
+
+    def test_refresh_incremental(self, server, monkeypatch):
+        nodes = [{'host': '127.0.0.1', 'port': 6379, 'role': 'master'},
+                 {'host': '10.0.0.2', 'port': 6380, 'role': 'replica',
+                  'master': '127.0.0.1:6379', 'link_state': 'online'}]
+        monkeypatch.setattr(topology_module, 'discover',
+                            lambda s: ('replication', [dict(n) for n in nodes], {}))
+
+        assert topology.refresh(server) == {'added': 2, 'updated': 0, 'removed': 0}
+        assert topology.refresh(server) == {'added': 0, 'updated': 0, 'removed': 0}
+
+        nodes[1]['link_state'] = 'wait_bgsave'
+        nodes.append({'host': '10.0.0.3', 'port': 6380, 'role': 'replica'})
+        assert topology.refresh(server) == {'added': 1, 'updated': 1, 'removed': 0}
+
+        del nodes[1:]
+        assert topology.refresh(server) == {'added': 0, 'updated': 0, 'removed': 2}
+        assert [node.port for node in server.nodes] == [6379]
+
+    def test_forgotten_on_delete(self, server, monkeypatch):
+        info = {'role': 'master', 'connected_slaves': 1,
+                'slave0': {'ip': '10.0.0.2', 'port': 6380}}
+        monkeypatch.setattr(topology_module, 'discover', lambda s: ('replication', [], info))
+        topology.on_sample(server.id, time.time(), info)
+        topology.refresh(server)
+        assert not topology.stale(server.id)
+        assert topology.replicas(server.id)
+
+        server_id = server.id
+        server.delete()
+        # a server created next gets the same id
+        assert topology.stale(server_id)
+        assert topology.replicas(server_id) == {}
+
+    def test_replicas_probed_less_often(self, server, monkeypatch):
+        replica = Server(name='redis replica', host='10.0.0.2', port=6380)
+        replica.save()
+        server.probe_interval = replica.probe_interval = 1
+        server.save()
+        master_id, replica_id = server.id, replica.id
+        master_info = {'role': 'master', 'connected_slaves': 1, 'master_repl_offset': 10,
+                       'slave0': {'ip': '10.0.0.2', 'port': 6380, 'state': 'online',
+                                  'offset': 10}}
+        probed = []
+
+        def get_metrics(probe):
+            probed.append(probe.id)
+            return master_info if probe.id == master_id else {'role': 'slave'}
+
+        class Executor:
+            def submit(self, fn, *args):
+                fn(*args)
+
+        clock = [1000.0]
+        monkeypatch.setattr(Server, 'get_metrics', get_metrics)
+        monkeypatch.setattr(time, 'time', lambda: clock[0])
+        collector.scheduler.jitter = 0
+        collector.scheduler.sync()
+        # master and replica each keep their own random first due time
+        ages = []
+        for _ in range(240):
+            clock[0] += 0.25
+            due = collector.scheduler.due()
+            if due:
+                collector._dispatch(Executor(), due)
+            sample = collector.store.latest(replica_id)
+            if sample is not None:
+                ages.append((clock[0] - sample[0]) / collector.interval_of(replica_id))
+
+        assert probed.count(master_id) == 60
+        assert 10 <= probed.count(replica_id) <= 12
+        # the export of a skipped replica does not go stale in between
+        assert max(ages) < 1
+        topology.discard(master_id)
+        topology.discard(replica_id)
+
+
+class TestSlowlog:
+    """
+    test slowlog templates and incremental fetches
+    """
+
+    def test_command_template(self):
+        assert command_template(b'HSET user:1024:profile name x') == 'HSET user:*:profile ...'
+        assert command_template(b'get session:abcdef0123456789abcd') == 'GET session:*'
+        assert command_template(b'CONFIG SET slowlog-log-slower-than 0') == 'CONFIG SET ...'
+        assert command_template(b'KEYS *') == 'KEYS ...'
+        assert command_template(b'PING') == 'PING'
+
+    def test_fetch_only_new_entries(self, server):
+        r = server.redis
+        slower_than = r.config_get('slowlog-log-slower-than')['slowlog-log-slower-than']
+        r.config_set('slowlog-log-slower-than', 0)
+        try:
+            r.slowlog_reset()
+            for index in range(3):
+                r.set('slowlog:test:{}'.format(index), index)
+            slowlogs = SlowlogAggregator()
+
+            assert slowlogs.fetch(server) >= 3
+            cursor = slowlogs.get(server.id).cursor
+            r.get('slowlog:test:0')
+            r.get('slowlog:test:1')
+            # the GETs and the commands of the previous fetch
+            assert 2 <= slowlogs.fetch(server) <= 5
+            assert slowlogs.get(server.id).cursor > cursor
+            templates = {pattern['template']: pattern
+                         for pattern in slowlogs.report(server.id)['patterns']}
+            assert templates['SET slowlog:test:* ...']['count'] == 3
+            assert templates['GET slowlog:test:*']['count'] == 2
+            assert slowlogs.fleet_report()['patterns']
+
+            slowlogs.reset(server.id)
+            assert slowlogs.report(server.id)['patterns'] == []
+            assert slowlogs.stale(server.id)
+            # entries aggregated before the reset are not counted again
+            slowlogs.fetch(server)
+            fleet = {pattern['template']: pattern
+                     for pattern in slowlogs.fleet_report()['patterns']}
+            assert fleet['SET slowlog:test:* ...']['count'] == 3
+            assert slowlogs._sketch.estimate('SET slowlog:test:* ...') \
+                == fleet['SET slowlog:test:* ...']['total_us']
+        finally:
+            r.config_set('slowlog-log-slower-than', slower_than)
+            r.delete(*['slowlog:test:{}'.format(index) for index in range(3)])
+
+
+class TestAlertEngine:
+    """
+    test incremental alert evaluation
+    """
+
+    def engine(self, *rules):
+        engine = AlertEngine(Collector())
+        events = []
+        engine.sinks = [events.append]
+        engine.load(rules)
+        return engine, events
+
+    def test_fire_after_duration_and_resolve(self):
+        rule = AlertRule(id=1, name='memory', condition='used_memory / maxmemory > 0.9',
+                         duration=60, enabled=True)
+        engine, events = self.engine(rule)
+
+        engine.on_sample(1, 0, {'used_memory': 95, 'maxmemory': 100})
+        assert engine.active()[0]['state'] == 'pending'
+        engine.on_sample(1, 30, {'used_memory': 96, 'maxmemory': 100})
+        assert events == []
+        engine.on_sample(1, 60, {'used_memory': 97, 'maxmemory': 100})
+        engine.on_sample(1, 65, {'used_memory': 97, 'maxmemory': 100})
+        assert [event['state'] for event in events] == ['firing']
+        assert events[0]['values'] == {'used_memory': 97, 'maxmemory': 100}
+
+        # a sample missing a field keeps the alert firing
+        engine.on_sample(1, 70, {'used_memory': 10})
+        engine.on_sample(1, 75, {'used_memory': 10, 'maxmemory': 100})
+        assert [event['state'] for event in events] == ['firing', 'resolved']
+        assert engine.active() == []
+
+    def test_rules_indexed_by_server(self):
+        engine, events = self.engine(
+            AlertRule(id=1, name='one', server_id=1, condition='blocked_clients > 0', enabled=True),
+            AlertRule(id=2, name='every', condition='connected_clients rate > 1', enabled=True),
+            AlertRule(id=3, name='off', condition='uptime_in_seconds > 0', enabled=False))
+
+        engine.on_sample(2, 0, {'blocked_clients': 1, 'connected_clients': 1})
+        engine.on_sample(2, 1, {'blocked_clients': 1, 'connected_clients': 10})
+        engine.on_sample(1, 1, {'blocked_clients': 1, 'connected_clients': 1})
+        assert [(event['rule'], event['server_id']) for event in events] == [
+            ('every', 2), ('one', 1)]
+
+        # deleting a rule resolves its alerts
+        engine.load([])
+        assert [event['state'] for event in events[2:]] == ['resolved', 'resolved']
+
+    def test_shared_with_api_workers(self, tmpdir):
+        path = str(tmpdir.join('samples'))
+        rule = AlertRule(id=1, name='blocked', condition='blocked_clients > 0', duration=0,
+                         enabled=True)
+        engine, events = self.engine(rule)
+        engine.collector.store = SharedMetricsStore(path, writer=True)
+        worker = AlertEngine(Collector())
+        worker.collector.store = SharedMetricsStore(path)
+        for instance in (engine, worker):
+            instance.share_path = path + '.alerts'
+
+        assert worker.active() == []
+        engine.on_sample(1, 0, {'blocked_clients': 1})
+        engine.on_sample(2, 0, {'blocked_clients': 0})
+        assert worker.active() == engine.active()
+        assert [(alert['server_id'], alert['state']) for alert in worker.active()] == \
+            [(1, 'firing')]
+        assert worker.active(server_id=2) == []
+
+        engine.on_sample(1, 10, {'blocked_clients': 0})
+        assert worker.active() == []
+
+    def test_schema(self, db):
+        rule, errors = AlertRuleSchema().load({'name': 'memory',
+                                               'condition': 'used_memory > 1 for 5m'})
+        assert errors == {}
+        assert (rule.condition, rule.duration) == ('used_memory > 1', 300)
+
+        _, errors = AlertRuleSchema().load({'name': 'bad', 'condition': 'open("x")'})
+        assert 'condition' in errors
+
+
+class TestTags:
+    """
+    test server tags and selectors resolved in SQL
+    """
+
+    def create(self, name, **labels):
+        server, errors = ServerSchema().load({'name': name, 'host': '127.0.0.1', 'tags': labels})
+        assert errors == {}
+        server.save()
+        return server
+
+    def test_tags_shared(self, db):
+        self.create('redis a', env='prod', role='cache')
+        self.create('redis b', env='prod')
+
+        assert Tag.query.count() == 2
+        assert Server.query.filter_by(name='redis a').one().labels == \
+            {'env': 'prod', 'role': 'cache'}
+
+    def test_filtered(self, db):
+        self.create('redis a', env='prod', role='cache')
+        self.create('redis b', env='prod', role='queue')
+        self.create('redis c', env='test', role='cache', legacy='')
+
+        def names(selector):
+            query = Server.filtered(tags=parse_selector(selector)).order_by(Server.id)
+            return [server.name for server in query]
+
+        assert names('env=prod') == ['redis a', 'redis b']
+        assert names('env=prod,role!=cache') == ['redis b']
+        assert names('role in (cache,queue),!legacy') == ['redis a', 'redis b']
+        assert names('legacy') == ['redis c']
+        assert names('env notin (prod)') == ['redis c']
+        assert names('team=x') == []
+
+    def test_update_tags(self, db):
+        server = self.create('redis a', env='prod')
+        updated_at = server.updated_at
+
+        schema = ServerSchema(context={'instance': server})
+        server, errors = schema.load({'tags': {'env': 'test'}}, partial=True)
+        server.save()
+
+        assert server.labels == {'env': 'test'}
+        assert server.updated_at > updated_at
+
+    def test_preload_labels(self, db, monkeypatch):
+        for name in ('redis a', 'redis b', 'redis c'):
+            self.create(name, env=name[-1])
+        servers = Server.query.filter(Server.name != 'redis b').order_by(Server.id).all()
+        parameters = []
+        monkeypatch.setattr(models, 'LABEL_IDS', 1)
+
+        def before_execute(conn, cursor, statement, params, context, executemany):
+            parameters.append(params)
+
+        event.listen(database.engine, 'before_cursor_execute', before_execute)
+        try:
+            Server.preload_labels(servers)
+        finally:
+            event.remove(database.engine, 'before_cursor_execute', before_execute)
+
+        assert [server.labels for server in servers] == [{'env': 'a'}, {'env': 'c'}]
+        # the ids of the page only, LABEL_IDS of them per query
+        assert parameters == [(servers[0].id,), (servers[1].id,)]
+
+
+class TestMigrations:
+    """
+    test schema migrations and the sqlite engine options
+    """
+
+    def test_schema_matches_models(self):
+        engine = create_engine('sqlite://')
+
+        applied = migrations.upgrade(engine)
+
+        assert [version for version, _ in applied] == \
+            [migration.VERSION for migration in migrations.MIGRATIONS]
+        inspector = inspect(engine)
+        for table in database.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            assert columns == {column.name for column in table.columns}
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            assert {index.name for index in table.indexes} <= indexes
+        assert migrations.upgrade(engine) == []
+
+    def test_adopt_created_schema(self):
+        engine = create_engine('sqlite://')
+        database.metadata.create_all(engine)
+
+        migrations.upgrade(engine)
+
+        with engine.connect() as connection:
+            assert migrations.current_version(connection) == migrations.MIGRATIONS[-1].VERSION
+
+    def test_upgrade_first_release(self):
+        engine = create_engine('sqlite://')
+        migrations.upgrade(engine, target=1)
+        engine.execute("INSERT INTO redis_server (name, host, port) VALUES ('a', '127.0.0.1', 6379)")
+
+        assert migrations.upgrade(engine, target=2) == [(2, 'nodes_and_alerts')]
+        rows = engine.execute('SELECT name, probe_interval FROM redis_server').fetchall()
+        assert rows == [('a', None)]
+        assert [version for version, _ in migrations.upgrade(engine)] == [3]
+
+    def test_sqlite_file(self, tmpdir, monkeypatch):
+        """pooled connections in WAL mode shared by concurrent writers
+        """
+        monkeypatch.setenv('RMON_DATABASE_URL', 'sqlite:///{}'.format(tmpdir.join('rmon.db')))
+        app = create_app()
+
+        with app.app_context():
+            assert database.schema_version() == (migrations.MIGRATIONS[-1].VERSION, [])
+            assert database.engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert database.engine.execute('PRAGMA foreign_keys').scalar() == 1
+
+        errors = []
+
+        def write(worker):
+            with app.app_context():
+                try:
+                    for index in range(20):
+                        Server(name='redis {}-{}'.format(worker, index), host='127.0.0.1').save()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    database.session.remove()
+
+        threads = [threading.Thread(target=write, args=(worker,)) for worker in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        with app.app_context():
+            assert Server.query.count() == 80
@@ -1,7 +1,16 @@
 import json
+import time
 
 from flask import url_for
 
+from rmon import models
+from rmon.collector import collector
+from rmon.history import history
+from rmon.instrument import instrument
+from rmon.keyspace import analyzers
+from rmon.models import Server
+from rmon.stream import hub
+
 
 class TestServerList:
     """测试 Redis 服务器列表 API
@@ -34,6 +43,54 @@ class TestServerList:
         assert 'updated_at' in h
         assert 'created_at' in h
 
+    def test_get_servers_paginated(self, db, client):
+        """按 id 游标分页获取服务器列表
+        """
+        for i in range(5):
+            Server(name='redis {}'.format(i), host='127.0.0.1', port=6379 + i).save()
+
+        resp = client.get(url_for(self.endpoint, limit=2))
+        assert [h['name'] for h in resp.json] == ['redis 0', 'redis 1']
+        cursor = resp.headers['X-Next-Cursor']
+        assert 'rel="next"' in resp.headers['Link']
+
+        resp = client.get(url_for(self.endpoint, limit=2, cursor=cursor))
+        assert [h['name'] for h in resp.json] == ['redis 2', 'redis 3']
+
+        resp = client.get(url_for(self.endpoint, limit=2, cursor=resp.headers['X-Next-Cursor']))
+        assert [h['name'] for h in resp.json] == ['redis 4']
+        assert 'X-Next-Cursor' not in resp.headers
+
+    def test_get_servers_filtered(self, db, client):
+        """按名称、地址、端口过滤并只返回指定字段
+        """
+        Server(name='cache 1', host='127.0.0.1', port=6379).save()
+        Server(name='cache 2', host='127.0.0.2', port=6380).save()
+        Server(name='queue', host='127.0.0.1', port=6380).save()
+
+        resp = client.get(url_for(self.endpoint, name='cache*', fields='name'))
+        assert resp.json == [{'name': 'cache 1'}, {'name': 'cache 2'}]
+
+        resp = client.get(url_for(self.endpoint, host='127.0.0.1', port=6380))
+        assert [h['name'] for h in resp.json] == ['queue']
+
+        resp = client.get(url_for(self.endpoint, fields='name,secret'))
+        assert resp.status_code == 400
+
+    def test_get_servers_not_modified(self, server, client):
+        """If-None-Match 与 ETag 相同时返回 304
+        """
+        resp = client.get(url_for(self.endpoint))
+        etag = resp.headers['ETag']
+
+        resp = client.get(url_for(self.endpoint), headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+
+        server.description = 'changed'
+        server.save()
+        resp = client.get(url_for(self.endpoint), headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+
     def test_create_server_success(self, db, client):
         """ 测试创建 Redis 服务器成功
         """
@@ -230,3 +287,721 @@ class TestServerDetail:
         assert resp.headers['Content-Type'] == 'application/json; charset=utf-8'
         assert resp.json['ok'] is False
         assert resp.json['message'] == 'object doesn\'t exist'
+
+
+class TestServerMetrics:
+    """测试 Redis 服务器监控数据 API
+    """
+
+    endpoint = 'api.server_metrics'
+
+    def test_get_metrics(self, server, client):
+        """获取最新的监控数据
+        """
+        resp = client.get(url_for(self.endpoint, object_id=server.id))
+
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'] == 'application/json; charset=utf-8'
+        assert resp.json['arch_bits'] == 64
+
+    def test_get_metrics_history(self, server, client):
+        """获取历史监控数据
+        """
+        client.get(url_for(self.endpoint, object_id=server.id))
+        resp = client.get(url_for(self.endpoint, object_id=server.id, series='used_memory'))
+
+        assert resp.status_code == 200
+        assert len(resp.json['timestamps']) == 1
+        assert list(resp.json['series']) == ['used_memory']
+
+    def test_get_metrics_sections(self, server, client):
+        """一次 pipeline 获取指定的 INFO 段和命令
+        """
+        resp = client.get(url_for(self.endpoint, object_id=server.id, sections='memory,dbsize'))
+
+        assert resp.status_code == 200
+        assert list(resp.json['info']) == ['memory']
+        assert 'used_memory' in resp.json['info']['memory']
+        assert 'dbsize' in resp.json
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, sections='memory;flushall'))
+        assert resp.status_code == 400
+
+    def test_get_metrics_failed(self, db, client):
+        """获取不存在的服务器的监控数据失败
+        """
+        resp = client.get(url_for(self.endpoint, object_id=0))
+
+        assert resp.status_code == 404
+        assert resp.json['ok'] is False
+
+
+class TestServerHealth:
+    """测试批量健康检查 API
+    """
+
+    endpoint = 'api.server_health'
+
+    def test_health(self, server, client):
+        """并发探测所有服务器
+        """
+        Server(name='redis down', host='127.0.0.1', port=6399).save()
+
+        resp = client.get(url_for(self.endpoint))
+
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'] == 'application/x-ndjson'
+        lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+        results = {line['name']: line for line in lines[:-1]}
+
+        assert results['redis test']['status'] == 'ok'
+        assert results['redis down']['status'] == 'error'
+        assert lines[-1]['summary']['total'] == 2
+        assert lines[-1]['summary']['ok'] == 1
+
+    def test_health_filter(self, server, client):
+        """按名称过滤并用 INFO 探测
+        """
+        Server(name='other', host='127.0.0.1', port=6399).save()
+
+        resp = client.get(url_for(self.endpoint, name='redis*', mode='info'))
+
+        lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+        assert len(lines) == 2
+        assert lines[0]['name'] == 'redis test'
+        assert lines[0]['info']['role'] == 'master'
+
+    def test_health_invalid_mode(self, db, client):
+        resp = client.get(url_for(self.endpoint, mode='shutdown'))
+
+        assert resp.status_code == 400
+        assert resp.json['ok'] is False
+
+
+class TestServerRates:
+    """测试计数器速率 API
+    """
+
+    endpoint = 'api.server_rates'
+
+    def test_get_rates(self, server, client):
+        """两次采样后返回速率
+        """
+        resp = client.get(url_for(self.endpoint, object_id=server.id))
+
+        assert resp.status_code == 200
+        assert resp.json['interval'] is None
+
+        collector.store.record(server.id, dict(server.get_metrics()), timestamp=time.time() + 1)
+        resp = client.get(url_for(self.endpoint, object_id=server.id))
+
+        assert resp.status_code == 200
+        assert resp.json['interval'] > 0
+        assert 'total_commands_processed' in resp.json['rates']
+
+
+class TestServerBulk:
+    """测试批量导入、删除和导出 API
+    """
+
+    endpoint = 'api.server_bulk'
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+
+    def test_import(self, server, client):
+        """批量创建和更新服务器，逐条报告错误
+        """
+        data = [
+            {'name': 'redis a', 'host': '127.0.0.1', 'port': 6379},
+            {'id': server.id, 'description': 'updated'},
+            {'name': 'redis test', 'host': '127.0.0.1'},
+            {'name': 'redis down', 'host': '127.0.0.1', 'port': 6399},
+            {'name': 'redis a', 'host': '127.0.0.1'},
+            {'id': 100, 'name': 'missing'},
+        ]
+        resp = client.post(url_for(self.endpoint), data=json.dumps(data), headers=self.headers)
+
+        assert resp.status_code == 200
+        assert resp.json['ok'] is False
+        assert resp.json['failed'] == 4
+        results = resp.json['results']
+        assert results[0]['action'] == 'created'
+        assert results[1] == {'ok': True, 'action': 'updated', 'id': server.id}
+        assert results[2]['message'] == 'name: Redis server already exists'
+        assert results[3]['message'] == 'cannot connect to redis server 127.0.0.1'
+        assert results[4]['message'] == 'name: Redis server already exists'
+        assert results[5]['message'] == 'object doesn\'t exist'
+
+        assert Server.query.count() == 2
+        assert Server.query.get(server.id).description == 'updated'
+
+    def test_import_invalid_types(self, server, client):
+        """id 或 name 类型错误只影响该条目
+        """
+        data = [{'id': [server.id], 'description': 'x'}, {'name': {}, 'host': '127.0.0.1'},
+                {'id': True}, {'name': 'redis b', 'host': '127.0.0.1'}]
+        resp = client.post(url_for(self.endpoint), data=json.dumps(data), headers=self.headers)
+
+        assert resp.status_code == 200
+        assert [result.get('message') for result in resp.json['results']] == [
+            'id: Not a valid integer.', 'name: Not a valid string.', 'id: Not a valid integer.',
+            None]
+
+        resp = client.delete(url_for(self.endpoint), data=json.dumps({'ids': [[1], {}]}),
+                             headers=self.headers)
+        assert resp.status_code == 200
+        assert [result['ok'] for result in resp.json['results']] == [False, False]
+
+    def test_import_ndjson_without_ping(self, db, client):
+        """NDJSON 请求体，跳过连接检查
+        """
+        lines = '\n'.join(json.dumps({'name': 'redis {}'.format(i), 'host': '127.0.0.1',
+                                      'port': 7000 + i}) for i in range(3))
+        resp = client.post(url_for(self.endpoint, ping=0), data=lines,
+                           headers={'Content-Type': 'application/x-ndjson'})
+
+        assert resp.json['ok'] is True
+        assert Server.query.count() == 3
+
+    def test_delete(self, server, client, monkeypatch):
+        """批量删除服务器，并像删除单个服务器一样清除其状态
+        """
+        server_id = server.id
+        discarded = []
+        monkeypatch.setattr(models, 'discards', [discarded.append])
+        job = analyzers.start(server, scan_count=1, min_rate=1)
+        resp = client.delete(url_for(self.endpoint), data=json.dumps({'ids': [server_id, 100]}),
+                             headers=self.headers)
+
+        assert resp.json['results'] == [
+            {'ok': True, 'id': server_id},
+            {'ok': False, 'id': 100, 'message': 'object doesn\'t exist'},
+        ]
+        assert Server.query.count() == 0
+        assert discarded == [server_id]
+        assert analyzers.get(server_id) is None
+        assert not job.running
+
+    def test_export(self, server, client):
+        """以 NDJSON 导出服务器
+        """
+        resp = client.get(url_for(self.endpoint))
+
+        assert resp.headers['Content-Type'] == 'application/x-ndjson'
+        lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+        assert [line['name'] for line in lines] == ['redis test']
+
+
+class TestMetricsStream:
+    """测试监控数据推送 API
+    """
+
+    endpoint = 'api.server_metrics_stream'
+
+    @staticmethod
+    def events(resp):
+        return [json.loads(line[len('data: '):]) for line in resp.data.decode().splitlines()
+                if line.startswith('data: ')]
+
+    def test_stream_cached_sample(self, server, client):
+        """先推送已缓存的数据
+        """
+        collector.poll(server)
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, count=1, fields='arch_bits'))
+
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'].startswith('text/event-stream')
+        events = self.events(resp)
+        assert len(events) == 1
+        assert events[0]['server_id'] == server.id
+        assert events[0]['info'] == {'arch_bits': 64}
+
+    def test_stream_polls_subscribed_servers(self, server, client):
+        """后台采集未运行时，由推送中心轮询被订阅的服务器
+        """
+        interval = collector.interval
+        collector.interval = 0.1
+        try:
+            resp = client.get(url_for('api.metrics_stream', ids=server.id, count=2))
+            events = self.events(resp)
+        finally:
+            collector.interval = interval
+
+        assert len(events) == 2
+        assert events[1]['timestamp'] > events[0]['timestamp']
+        assert hub.subscribed() == []
+
+    def test_stream_closed_early(self, server, client):
+        """未发送或提前关闭的推送不留下订阅
+        """
+        url = url_for(self.endpoint, object_id=server.id)
+        resp = client.get(url, buffered=False)
+        assert hub.subscribed() == []
+        resp.close()
+
+        resp = client.get(url, buffered=False)
+        next(iter(resp.response))
+        assert hub.subscribed() == [server.id]
+        resp.close()
+        assert hub.subscribed() == []
+
+
+class TestServerKeyspace:
+    """测试键空间分析 API
+    """
+
+    endpoint = 'api.server_keyspace'
+
+    def test_keyspace(self, server, client):
+        """开始分析并获取结果
+        """
+        resp = client.get(url_for(self.endpoint, object_id=server.id))
+        assert resp.status_code == 404
+
+        resp = client.post(url_for(self.endpoint, object_id=server.id),
+                           data=json.dumps({'sample_rate': 1, 'restart': True}),
+                           headers={'Content-Type': 'application/json; charset=utf-8'})
+        assert resp.status_code == 202
+        assert resp.json['status'] in ('running', 'done')
+
+        analyzers.get(server.id)._thread.join(10)
+        resp = client.get(url_for(self.endpoint, object_id=server.id))
+        assert resp.status_code == 200
+        assert resp.json['status'] == 'done'
+
+    def test_keyspace_invalid_sample_rate(self, server, client):
+        resp = client.post(url_for(self.endpoint, object_id=server.id),
+                           data=json.dumps({'sample_rate': 2}),
+                           headers={'Content-Type': 'application/json; charset=utf-8'})
+        assert resp.status_code == 400
+
+    def test_keyspace_invalid_options(self, server, client):
+        """SCAN 数量和命令比例超出范围时不开始分析
+        """
+        for options in ({'scan_count': 0}, {'scan_count': 10000000}, {'ops_fraction': 0},
+                        {'ops_fraction': -0.5}, {'ops_fraction': 2}):
+            resp = client.post(url_for(self.endpoint, object_id=server.id),
+                               data=json.dumps(options),
+                               headers={'Content-Type': 'application/json; charset=utf-8'})
+            assert resp.status_code == 400, options
+
+
+class TestServerHistory:
+    """测试历史监控数据 API
+    """
+
+    endpoint = 'api.server_history'
+
+    def test_get_history(self, server, client):
+        """按步长查询历史数据
+        """
+        collector.poll(server)
+        resp = client.get(url_for(self.endpoint, object_id=server.id, metrics='used_memory',
+                                  step=60))
+
+        assert resp.status_code == 200
+        assert resp.json['step'] == 60
+        assert len(resp.json['timestamps']) == 61
+        assert list(resp.json['series']) == ['used_memory']
+
+    def test_history_of_deleted_server(self, server, client):
+        """删除服务器后其历史数据不会出现在复用同一 id 的新服务器上
+        """
+        server_id = server.id
+        history.append(server_id, int(time.time()) - 5, {'used_memory': 123})
+        history.flush()
+        assert client.delete(url_for('api.server_detail', object_id=server_id)).json['ok']
+
+        data = {'name': 'redis new', 'host': '127.0.0.1', 'port': 6379}
+        client.post(url_for('api.server_list'), data=json.dumps(data),
+                    headers={'Content-Type': 'application/json; charset=utf-8'})
+        assert Server.query.one().id == server_id
+
+        resp = client.get(url_for(self.endpoint, object_id=server_id, metrics='used_memory'))
+        assert set(resp.json['series']['used_memory']) == {None}
+
+    def test_get_history_too_many_points(self, server, client):
+        resp = client.get(url_for(self.endpoint, object_id=server.id, step=1, **{'from': 0}))
+
+        assert resp.status_code == 400
+        assert resp.json['ok'] is False
+
+
+class TestMetricsView:
+    """测试 rmon 自身的 Prometheus 指标
+    """
+    endpoint = 'api.metrics'
+
+    def test_get_metrics(self, server, client):
+        """请求延迟、SQL 查询数和 Redis 命令延迟
+        """
+        client.get(url_for('api.server_detail', object_id=server.id))
+        server.ping()
+
+        resp = client.get(url_for(self.endpoint))
+
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        lines = resp.data.decode().splitlines()
+        assert any(line.startswith('rmon_http_request_seconds_count{view="api.server_detail",'
+                                   'method="GET"}') for line in lines)
+        assert any(line.startswith('rmon_http_request_sql_queries_count{view="api.server_detail"')
+                   for line in lines)
+        assert any(line.startswith('rmon_redis_command_seconds_count{command="PING"}')
+                   for line in lines)
+        assert any(line.startswith('rmon_redis_server_commands_total{server="127.0.0.1:6379"}')
+                   for line in lines)
+        assert 'rmon_collector_lag_seconds 0' in lines
+
+    def test_profile_disabled(self, client):
+        """未开启采样分析时返回 404
+        """
+        resp = client.get(url_for('api.profile'))
+
+        assert resp.status_code == 404
+
+    def test_profile(self, app, client):
+        """开启 PROFILER_ENABLED 后返回折叠格式的调用栈
+        """
+        app.config['PROFILER_ENABLED'] = True
+        app.config['PROFILER_INTERVAL'] = 0.001
+        instrument.init_app(app)
+        try:
+            time.sleep(0.05)
+            resp = client.get(url_for('api.profile'))
+        finally:
+            instrument.profiler.stop()
+            instrument.profiler = None
+
+        assert resp.status_code == 200
+        stacks = resp.data.decode().splitlines()
+        assert stacks and all(int(line.rsplit(' ', 1)[1]) > 0 for line in stacks)
+
+
+class TestFleetMetrics:
+    """测试所有服务器指标的 Prometheus 导出
+    """
+    endpoint = 'api.fleet_metrics'
+
+    def test_get_fleet_metrics(self, server, client):
+        """从缓存样本生成，未采集的服务器 redis_up 为 0
+        """
+        other = Server(name='redis "2"', host='10.0.0.2')
+        other.save()
+        collector.poll(server)
+
+        resp = client.get(url_for(self.endpoint))
+
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        lines = resp.data.decode().splitlines()
+        labels = 'name="redis test",host="127.0.0.1",port="6379"'
+        assert 'redis_up{{{}}} 1'.format(labels) in lines
+        assert 'redis_up{name="redis \\"2\\"",host="10.0.0.2",port="6379"} 0' in lines
+        assert '# TYPE redis_total_commands_processed_total counter' in lines
+        assert any(line.startswith('redis_connected_clients{{{}}} '.format(labels))
+                   for line in lines)
+        assert any(line.startswith('redis_instance_info{{{},version='.format(labels))
+                   for line in lines)
+
+    def test_openmetrics(self, server, client):
+        """Accept 为 application/openmetrics-text 时返回 OpenMetrics 格式
+        """
+        collector.poll(server)
+
+        resp = client.get(url_for(self.endpoint, name='redis*'),
+                          headers={'Accept': 'application/openmetrics-text'})
+
+        assert resp.headers['Content-Type'].startswith('application/openmetrics-text')
+        lines = resp.data.decode().splitlines()
+        assert lines[-1] == '# EOF'
+        assert '# TYPE redis_total_commands_processed counter' in lines
+        assert any(line.startswith('redis_total_commands_processed_total{') for line in lines)
+
+
+class TestServerTopology:
+    """测试拓扑发现 API
+    """
+    endpoint = 'api.server_topology'
+
+    def test_get_topology(self, server, client):
+        """独立部署的服务器只有一个主节点
+        """
+        resp = client.get(url_for(self.endpoint, object_id=server.id))
+
+        assert resp.status_code == 200
+        assert resp.json['mode'] in ('standalone', 'replication')
+        master = resp.json['nodes'][0]
+        assert (master['host'], master['port'], master['role']) == ('127.0.0.1', 6379, 'master')
+
+    def test_refresh_topology(self, server, client):
+        """重新发现时只写入变化的节点
+        """
+        client.post(url_for(self.endpoint, object_id=server.id))
+        resp = client.post(url_for(self.endpoint, object_id=server.id))
+
+        assert resp.status_code == 200
+        assert resp.json['changes'] == {'added': 0, 'updated': 0, 'removed': 0}
+
+
+class TestSlowlog:
+    """测试慢查询模板 API
+    """
+
+    def test_server_slowlog(self, server, client):
+        """首次请求拉取慢查询并返回游标
+        """
+        resp = client.get(url_for('api.server_slowlog', object_id=server.id, top=5))
+
+        assert resp.status_code == 200
+        assert resp.json['fetched_at'] is not None
+        assert len(resp.json['patterns']) <= 5
+
+        resp = client.delete(url_for('api.server_slowlog', object_id=server.id))
+        assert resp.json == {'ok': True}
+
+    def test_fleet_slowlog(self, server, client):
+        """汇总所有服务器并估计指定模板的总耗时
+        """
+        resp = client.get(url_for('api.fleet_slowlog', template='PING'))
+
+        assert resp.status_code == 200
+        assert resp.json['servers'] >= 1
+        assert resp.json['errors'] == []
+        assert resp.json['estimate']['template'] == 'PING'
+
+
+class TestAlertRules:
+    """测试告警规则 API
+    """
+
+    def test_create_and_evaluate(self, server, client):
+        """创建规则后采样立即按规则计算
+        """
+        resp = client.post(url_for('api.alert_rule_list'), data=json.dumps(
+            {'name': 'up', 'condition': 'uptime_in_seconds >= 0', 'server_id': server.id,
+             'severity': 'critical'}), content_type='application/json')
+        assert resp.status_code == 201
+        rule_id = resp.json['id']
+
+        collector.poll(server)
+        resp = client.get(url_for('api.alert_list', server_id=server.id))
+        assert [(alert['rule'], alert['state']) for alert in resp.json] == [('up', 'firing')]
+
+        resp = client.put(url_for('api.alert_rule_detail', object_id=rule_id),
+                          data=json.dumps({'enabled': False}), content_type='application/json')
+        assert resp.json == {'ok': True}
+        assert client.get(url_for('api.alert_list')).json == []
+
+        resp = client.delete(url_for('api.alert_rule_detail', object_id=rule_id))
+        assert resp.json == {'ok': True}
+        assert client.get(url_for('api.alert_rule_list')).json == []
+
+    def test_invalid_rule(self, server, client):
+        """条件不合法时返回 400
+        """
+        resp = client.post(url_for('api.alert_rule_list'), data=json.dumps(
+            {'name': 'bad', 'condition': 'used_memory >'}), content_type='application/json')
+
+        assert resp.status_code == 400
+        assert resp.json['ok'] is False
+        assert resp.json['message'].startswith('invalid condition')
+
+
+class TestServerCommand:
+    """测试命令执行 API
+    """
+
+    endpoint = 'api.server_command'
+
+    def run(self, client, server, body):
+        resp = client.post(url_for(self.endpoint, object_id=server.id), data=json.dumps(body),
+                           content_type='application/json')
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/x-ndjson'
+        return [json.loads(line) for line in resp.data.decode().splitlines()]
+
+    def test_batch(self, server, client):
+        """批量执行，集合命令分页返回
+        """
+        r = server.redis
+        r.delete('command:test')
+        r.hmset('command:test', {'field{}'.format(index): index for index in range(5)})
+        client.application.config['COMMAND_PAGE_SIZE'] = 2
+        try:
+            lines = self.run(client, server, {'commands': [
+                ['hgetall', 'command:test'], ['TYPE', 'command:test'], ['GET', 'missing:key']]})
+        finally:
+            r.delete('command:test')
+
+        pages = [line for line in lines if 'items' in line]
+        assert sorted(tuple(item) for page in pages for item in page['items']) == [
+            ('field{}'.format(index), str(index)) for index in range(5)]
+        done = [line for line in lines if line.get('done')][0]
+        assert (done['index'], done['count'], done['truncated']) == (0, 5, False)
+        assert {'index': 1, 'command': 'TYPE', 'result': 'hash'} in lines
+        assert {'index': 2, 'command': 'GET', 'result': None} in lines
+        assert lines[-1]['summary']['errors'] == 0
+
+    def test_caps(self, server, client):
+        """超过条数上限时截断并返回游标
+        """
+        r = server.redis
+        r.delete('command:list')
+        r.rpush('command:list', *range(10))
+        client.application.config.update(COMMAND_PAGE_SIZE=3, COMMAND_MAX_ITEMS=5)
+        try:
+            lines = self.run(client, server, {'command': ['LRANGE', 'command:list', 0, -1]})
+        finally:
+            r.delete('command:list')
+
+        assert [line['items'] for line in lines if 'items' in line] == [['0', '1', '2']]
+        done = lines[-2]
+        assert (done['count'], done['truncated'], done['cursor']) == (3, True, 3)
+        assert lines[-1]['summary']['truncated'] is True
+
+    def test_oversized_page(self, server, client):
+        """单页超过上限时返回部分结果，无法拆分的 SCAN 页返回 413
+        """
+        r = server.redis
+        r.delete('command:list', 'command:set')
+        r.rpush('command:list', *['x' * 100] * 10)
+        r.sadd('command:set', *range(50))
+        client.application.config.update(COMMAND_PAGE_SIZE=5, COMMAND_MAX_BYTES=250,
+                                         COMMAND_MAX_ITEMS=20)
+        try:
+            lines = self.run(client, server, {'commands': [
+                ['LRANGE', 'command:list', 0, -1], ['SSCAN', 'command:set', 0]]})
+        finally:
+            r.delete('command:list', 'command:set')
+
+        assert [len(line['items']) for line in lines if 'items' in line] == [2]
+        done = lines[1]
+        assert (done['count'], done['truncated'], done['cursor']) == (2, True, 2)
+        assert lines[2]['index'] == 1
+        assert lines[2]['error'].startswith('a page of 50 items')
+
+    def test_scan_count_capped(self, server, client):
+        """SCAN 的 COUNT 不超过分页大小
+        """
+        r = server.redis
+        r.delete('command:set')
+        r.sadd('command:set', *['member{}'.format(index) for index in range(300)])
+        client.application.config['COMMAND_PAGE_SIZE'] = 10
+        try:
+            lines = self.run(client, server, {'command': [
+                'SSCAN', 'command:set', 0, 'COUNT', 100000]})
+        finally:
+            r.delete('command:set')
+
+        pages = [line['items'] for line in lines if 'items' in line]
+        assert len({item for page in pages for item in page}) == 300
+        assert max(len(page) for page in pages) < 30
+
+    def test_not_allowed(self, server, client):
+        """不在白名单或未开启的管理命令被拒绝
+        """
+        for command in (['FLUSHALL'], ['KEYS', '*'], ['CONFIG', 'SET', 'maxmemory', '1']):
+            resp = client.post(url_for(self.endpoint, object_id=server.id),
+                               data=json.dumps({'command': command}),
+                               content_type='application/json')
+            assert resp.status_code == 403
+            assert resp.json['ok'] is False
+
+
+class TestFleetAggregate:
+    """测试多服务器聚合 API
+    """
+    endpoint = 'api.fleet_aggregate'
+
+    def test_aggregate(self, server, client):
+        """由缓存样本计算，未采集的服务器列在 missing 中
+        """
+        other = Server(name='redis other', host='10.0.0.2')
+        other.save()
+        collector.poll(server)
+
+        resp = client.get(url_for(self.endpoint, fields='used_memory,uptime_in_seconds',
+                                  stats='count,max,p99', matrix=1))
+
+        assert resp.status_code == 200
+        assert resp.json['servers'] == 2
+        assert resp.json['missing'] == [other.id]
+        assert resp.json['summary']['used_memory']['count'] == 1
+        assert resp.json['matrix']['ids'] == [server.id]
+
+        resp = client.get(url_for(self.endpoint, fields='used_memory', group_by='role'))
+        assert [group['key'] for group in resp.json['groups']] == ['master']
+
+    def test_invalid(self, client):
+        """缺少字段或统计量不合法时返回 400
+        """
+        assert client.get(url_for(self.endpoint)).status_code == 400
+        resp = client.get(url_for(self.endpoint, fields='used_memory', stats='median'))
+        assert resp.status_code == 400
+
+
+class TestServerTags:
+    """测试服务器标签和标签选择器
+    """
+
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+
+    def load(self, client):
+        data = [{'name': 'redis {}'.format(index), 'host': '127.0.0.1', 'tags': tags}
+                for index, tags in enumerate(({'env': 'prod', 'role': 'cache'},
+                                              {'env': 'prod', 'role': 'queue'},
+                                              {'env': 'test', 'role': 'cache'}))]
+        resp = client.post(url_for('api.server_bulk', ping=0), data=json.dumps(data),
+                           headers=self.headers)
+        assert resp.json['ok'] is True
+
+    def test_list(self, db, client):
+        """按标签选择服务器，返回服务器的标签
+        """
+        self.load(client)
+
+        resp = client.get(url_for('api.server_list', tags='env=prod,role!=queue'))
+        assert [server['name'] for server in resp.json] == ['redis 0']
+        assert resp.json[0]['tags'] == {'env': 'prod', 'role': 'cache'}
+
+        resp = client.get(url_for('api.server_list', tags='role in (cache)', fields='name,tags'))
+        assert resp.json == [{'name': 'redis 0', 'tags': {'env': 'prod', 'role': 'cache'}},
+                             {'name': 'redis 2', 'tags': {'env': 'test', 'role': 'cache'}}]
+
+        assert client.get(url_for('api.server_list', tags='env=(x)')).status_code == 400
+
+    def test_tag_list(self, db, client):
+        """标签及其服务器数量
+        """
+        self.load(client)
+
+        resp = client.get(url_for('api.tag_list', key='env'))
+        assert resp.json == [{'key': 'env', 'value': 'prod', 'servers': 2},
+                             {'key': 'env', 'value': 'test', 'servers': 1}]
+
+    def test_bulk_delete(self, db, client):
+        """按标签批量删除服务器
+        """
+        self.load(client)
+
+        resp = client.delete(url_for('api.server_bulk'), data=json.dumps({'tags': 'env=test'}),
+                             headers=self.headers)
+        assert resp.json['total'] == 1
+        assert Server.query.count() == 2
+
+        resp = client.delete(url_for('api.server_bulk'), data=json.dumps({'tags': ''}),
+                             headers=self.headers)
+        assert resp.status_code == 400
+
+    def test_aggregate_by_tag(self, db, client):
+        """按标签的值分组聚合
+        """
+        self.load(client)
+        for server in Server.query:
+            collector.store.record(server.id, {'used_memory': server.id * 100})
+
+        resp = client.get(url_for('api.fleet_aggregate', fields='used_memory', stats='sum',
+                                  tags='role=cache', group_by='tag.env'))
+        assert [(group['key'], group['summary']['used_memory']['sum'])
+                for group in resp.json['groups']] == [('prod', 100), ('test', 300)]